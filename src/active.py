@@ -0,0 +1,241 @@
+import argparse
+import csv
+import dataclasses
+import labelstore
+import numpy
+import online
+import parse
+import profiling
+import scipy.sparse
+import spectral
+import sys
+
+# Active labeling on top of an existing dataset: every task starts with a few
+# labels, then each round spends a batch of labels on the tasks the current
+# aggregation is least sure about, drawing each task's next worker from those
+# who labelled it in the dataset. Aggregations are updated incrementally from
+# round to round (the online aggregators, or a warm-started leading vector for
+# SVD). EM's per-task log-odds margins are kept up to date in place: new
+# labels are added in, and only the labels of workers whose weight moved are
+# reweighed. SVD rebuilds its scaled matrix every round, since the solver
+# passes over every drawn label several times anyway, so SVD rounds take time
+# linear in the labels drawn so far.
+#
+#   python src/active.py --strategy em --budget 4 --baseline
+
+# Strategy --> how uncertainty is measured
+STRATEGIES = {
+    "majority": "margin of the majority vote",
+    "em": "posterior log-odds under the EM worker weights",
+    "svd": "magnitude of the task's leading vector entry, with workers' columns normalized"
+}
+INITIAL_SIZE = 1
+# Labels per round, as a fraction of the tasks
+BATCH_FRACTION = 0.1
+# Worker weights are clipped this far from +-1 before taking log-odds
+WEIGHT_MARGIN = 1e-3
+
+@dataclasses.dataclass
+class BudgetPoint:
+    labels: int
+    error: float
+
+class ActiveSimulator:
+    # `store` supplies the worker pool and gold labels. With `uniform`, each
+    # round labels the tasks with the fewest labels instead, which spreads
+    # the budget like `generate_subsample` and serves as the baseline.
+    def __init__(self, store: labelstore.LabelStore, strategy: str = "majority",
+                 initial_size: int = INITIAL_SIZE, batch_size: int | None = None,
+                 uniform: bool = False, rng: numpy.random.Generator | int | None = None,
+                 spectral_method: str = "power") -> None:
+        assert strategy in STRATEGIES, f"Unknown strategy {strategy}"
+        assert initial_size >= 1, "Every task needs a label to start from"
+        self.store = store
+        self.strategy = strategy
+        self.uniform = uniform
+        self.rng = numpy.random.default_rng(rng)
+        self.batch_size = batch_size if batch_size is not None else max(1, int(BATCH_FRACTION * store.num_tasks))
+
+        # Each task's workers in the random order they will be asked in
+        by_task = store.by_task()
+        self.indptr = by_task.indptr
+        rows = numpy.repeat(numpy.arange(store.num_tasks), numpy.diff(by_task.indptr))
+        order = numpy.lexsort((self.rng.random(len(rows)), rows))
+        self.pool_workers = by_task.indices[order]
+        self.pool_labels = by_task.labels[order]
+        # Task index --> labels drawn so far
+        self.drawn = numpy.zeros(store.num_tasks, dtype=numpy.int64)
+        self.available = numpy.diff(by_task.indptr)
+
+        # Every label drawn so far, by store index
+        self.tasks = numpy.zeros(0, dtype=numpy.int32)
+        self.workers = numpy.zeros(0, dtype=numpy.int32)
+        self.labels = numpy.zeros(0, dtype=numpy.int8)
+        self.num_labels = 0
+        # Task index --> sum of drawn labels
+        self.sums = numpy.zeros(store.num_tasks, dtype=numpy.int64)
+        # Worker index --> labels drawn from them
+        self.worker_counts = numpy.zeros(store.num_workers, dtype=numpy.int64)
+
+        self.aggregator: online.OnlineAggregator | None = None
+        if strategy == "majority":
+            self.aggregator = online.OnlineMajorityVoteAggregator()
+        elif strategy == "em":
+            self.aggregator = online.OnlineEstimationMaximizationAggregator(self.rng)
+        self.solver: spectral.WarmStart | None = None
+        if strategy == "svd":
+            self.solver = spectral.WarmStart(spectral_method)
+        # Store task index --> aggregator task index, once every task has a label
+        self.positions: numpy.ndarray | None = None
+        # Aggregator worker index --> store worker index
+        self.aggregator_workers = numpy.zeros(0, dtype=numpy.int64)
+        # Task index --> EM log-odds margin of its drawn labels, summed with
+        # the worker log-odds below
+        self.margins = numpy.zeros(store.num_tasks)
+        self.log_odds = numpy.zeros(store.num_workers)
+        # Drawn labels grouped by worker (the rows of these TaskLabels are workers)
+        self.labels_by_worker = online.TaskLabels()
+        # Task index --> SVD leading vector entry
+        self.vector: numpy.ndarray | None = None
+
+        for _ in range(initial_size):
+            self.request(numpy.flatnonzero(self.drawn < self.available))
+
+    # Ask one more worker about each of `tasks` and fold in their labels
+    def request(self, tasks: numpy.ndarray) -> None:
+        entries = self.indptr[tasks] + self.drawn[tasks]
+        self.drawn[tasks] += 1
+        (workers, labels) = (self.pool_workers[entries], self.pool_labels[entries])
+
+        size = self.num_labels + len(tasks)
+        self.tasks = online.grow(self.tasks, size)
+        self.workers = online.grow(self.workers, size)
+        self.labels = online.grow(self.labels, size)
+        self.tasks[self.num_labels:size] = tasks
+        self.workers[self.num_labels:size] = workers
+        self.labels[self.num_labels:size] = labels
+        self.num_labels = size
+        numpy.add.at(self.sums, tasks, labels)
+        numpy.add.at(self.worker_counts, workers, 1)
+
+        with profiling.phase(f"active {self.strategy}"):
+            if self.aggregator is not None:
+                (worker_ids, task_ids) = (self.store.worker_ids, self.store.task_ids)
+                self.aggregator.add_labels((worker_ids[worker], task_ids[task], label)
+                                           for (worker, task, label) in zip(workers.tolist(), tasks.tolist(), labels.tolist()))
+                if self.positions is None and self.aggregator.num_tasks == self.store.num_tasks:
+                    self.positions = numpy.fromiter((self.aggregator.task_index[task_id] for task_id in self.store.task_ids),
+                                                    dtype=numpy.int64, count=self.store.num_tasks)
+                if self.strategy == "em":
+                    self.update_margins(tasks, workers, labels)
+            else:
+                self.vector = self.solver.solve(self.matrix()).vector
+
+    # Add new labels to the EM margins at the current log-odds, then move the
+    # labels of every worker whose weight changed to their new log-odds
+    def update_margins(self, tasks: numpy.ndarray, workers: numpy.ndarray, labels: numpy.ndarray) -> None:
+        numpy.add.at(self.margins, tasks, labels * self.log_odds[workers])
+        self.labels_by_worker.append(workers, tasks, labels, self.store.num_workers)
+
+        known = len(self.aggregator_workers)
+        if self.aggregator.num_workers > known:
+            worker_index = self.store.worker_index
+            added = [worker_index[worker_id] for worker_id in self.aggregator.worker_ids[known:]]
+            self.aggregator_workers = numpy.concatenate([self.aggregator_workers, numpy.array(added, dtype=numpy.int64)])
+
+        # Worker weights are 2 * accuracy - 1, so this is each label's log-odds
+        weights = numpy.clip(self.aggregator.worker_weights[:self.aggregator.num_workers], WEIGHT_MARGIN - 1, 1 - WEIGHT_MARGIN)
+        log_odds = numpy.zeros(self.store.num_workers)
+        log_odds[self.aggregator_workers] = numpy.log1p(weights) - numpy.log1p(-weights)
+        changed = numpy.flatnonzero(log_odds != self.log_odds)
+        (changed_workers, changed_tasks, changed_labels) = self.labels_by_worker.for_tasks(changed)
+        numpy.add.at(self.margins, changed_tasks, changed_labels * (log_odds - self.log_odds)[changed_workers])
+        self.log_odds = log_odds
+
+    # Tasks x workers matrix of every drawn label, each worker's column scaled
+    # by 1 / sqrt(their label count). Unscaled, the few workers asked most
+    # dominate the leading vector whether or not they are any good, and its
+    # entries say more about who labelled a task than how clear-cut it is.
+    def matrix(self) -> scipy.sparse.csr_matrix:
+        count = self.num_labels
+        (workers, labels) = (self.workers[:count], self.labels[:count])
+        data = labels / numpy.sqrt(self.worker_counts[workers])
+        return scipy.sparse.csr_matrix((data, (self.tasks[:count], workers)), shape=(self.store.num_tasks, self.store.num_workers))
+
+    # Task index --> aggregation (0 on ties, which count as half an error)
+    def estimates(self) -> numpy.ndarray:
+        if self.aggregator is not None:
+            return self.aggregator.estimates()[self.positions]
+        # The leading vector's sign is arbitrary; orient it to agree with the
+        # majority vote rather than with gold labels
+        estimates = numpy.sign(self.vector).astype(numpy.int8)
+        return estimates if numpy.dot(estimates, numpy.sign(self.sums)) >= 0 else -estimates
+
+    # Task index --> how certain the current aggregation is; lower is less sure
+    def certainty(self) -> numpy.ndarray:
+        if self.uniform:
+            return self.drawn.astype(numpy.float64)
+        if self.strategy == "majority":
+            return numpy.abs(self.sums).astype(numpy.float64)
+        if self.strategy == "em":
+            return numpy.abs(self.margins)
+        return numpy.abs(self.vector)
+
+    def error(self) -> float:
+        estimates = self.estimates()
+        return float(numpy.where(estimates == 0, 0.5, estimates != self.store.true_labels).mean())
+
+    # Spend labels a batch at a time until `budget` labels in total have been
+    # drawn or no task has workers left. Returns the error after the initial
+    # labels and after every round.
+    def run(self, budget: int) -> list[BudgetPoint]:
+        points = [BudgetPoint(self.num_labels, self.error())]
+        while self.num_labels < budget:
+            candidates = numpy.flatnonzero(self.drawn < self.available)
+            if len(candidates) == 0:
+                break
+            # Least certain first, ties in random order
+            certainty = self.certainty()[candidates]
+            order = numpy.lexsort((self.rng.random(len(candidates)), certainty))
+            chosen = candidates[order[:min(self.batch_size, budget - self.num_labels)]]
+            profiling.count("active rounds")
+            self.request(numpy.sort(chosen))
+            points.append(BudgetPoint(self.num_labels, self.error()))
+        return points
+
+def write_csv(results: dict[str, list[BudgetPoint]], num_tasks: int, file) -> None:
+    writer = csv.writer(file)
+    writer.writerow(["run", "labels", "labels_per_task", "error"])
+    for (name, points) in results.items():
+        for point in points:
+            writer.writerow([name, point.labels, point.labels / num_tasks, point.error])
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description="Simulate spending a labeling budget on the least certain tasks.")
+    arguments.add_argument("--dataset", default="rte.standardized.tsv")
+    arguments.add_argument("--strategy", default="majority", choices=list(STRATEGIES))
+    arguments.add_argument("--initial-size", type=int, default=INITIAL_SIZE, help="Labels every task starts with")
+    arguments.add_argument("--budget", type=float, default=5, help="Average labels per task to spend in total")
+    arguments.add_argument("--batch-size", type=int, default=None, help="Labels per round (default: a tenth of the tasks)")
+    arguments.add_argument("--extrapolated", action="store_true", help="Draw workers from the extrapolated dataset")
+    arguments.add_argument("--baseline", action="store_true", help="Also spend the budget evenly, for comparison")
+    arguments.add_argument("--seed", type=int, default=None)
+    options = arguments.parse_args()
+
+    parser = parse.RTEParser()
+    parser.parse_cached(options.dataset)
+    store = parser.store
+    if options.extrapolated:
+        import evaluate
+        evaluator = evaluate.Evaluator(parser, options.seed)
+        evaluator.generate_extrapolated_dataset()
+        store = labelstore.LabelStore.from_dicts(evaluator.extrapolated_dataset, evaluator.answers)
+
+    seed = options.seed if options.seed is not None else int(numpy.random.SeedSequence().generate_state(1)[0])
+    budget = int(options.budget * store.num_tasks)
+    results = {options.strategy: ActiveSimulator(store, options.strategy, options.initial_size, options.batch_size,
+                                                 rng=seed).run(budget)}
+    if options.baseline:
+        results["uniform"] = ActiveSimulator(store, options.strategy, options.initial_size, options.batch_size,
+                                             uniform=True, rng=seed).run(budget)
+    write_csv(results, store.num_tasks, sys.stdout)
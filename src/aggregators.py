@@ -1,10 +1,56 @@
 import abc
+import dataclasses
 import random
 import numpy
 import parse
+import profiling
 import sys
 
+# SciPy, the spectral solvers and the precompute cache are imported inside the
+# methods that use them, so majority vote and dictionary EM runs never load them
+
 MAX_ITERATIONS = 20
+# Weighted votes closer to 0 than this count as ties. Summing the same floats
+# in a different order can leave a tiny residue instead of an exact 0.
+TIE_TOLERANCE = 1e-9
+
+# Dawid-Skene stops once the log-likelihood improves by less than this fraction
+DAWID_SKENE_TOLERANCE = 1e-6
+DAWID_SKENE_MAX_ITERATIONS = 100
+# Pseudo-count added to every confusion matrix cell and class prior
+DAWID_SKENE_SMOOTHING = 0.01
+
+# A subsample flattened into parallel arrays, one entry per (task, worker) label
+@dataclasses.dataclass
+class SubsampleArrays:
+    # Index --> ID
+    task_ids: list[str]
+    worker_ids: list[str]
+    tasks: numpy.ndarray
+    workers: numpy.ndarray
+    labels: numpy.ndarray
+
+    def from_dicts(data_by_worker: dict[str, dict[str, int]],
+                   subsample: dict[str, set[str]]) -> "SubsampleArrays":
+        worker_index: dict[str, int] = {}
+        tasks: list[int] = []
+        workers: list[int] = []
+        labels: list[int] = []
+        for (task, task_id) in enumerate(subsample):
+            # Sorted, since set order follows the string hash seed
+            for worker_id in sorted(subsample[task_id]):
+                worker = worker_index.get(worker_id)
+                if worker is None:
+                    worker = len(worker_index)
+                    worker_index[worker_id] = worker
+                tasks.append(task)
+                workers.append(worker)
+                labels.append(data_by_worker[worker_id][task_id])
+
+        return SubsampleArrays(list(subsample), list(worker_index),
+                               numpy.array(tasks, dtype=numpy.int32),
+                               numpy.array(workers, dtype=numpy.int32),
+                               numpy.array(labels, dtype=numpy.int8))
 
 class Aggregator(abc.ABC):
     # Returns dictionary of Task ID --> Aggregation
@@ -52,12 +98,14 @@ class EstimationMaximizationAggregator(Aggregator):
         while(iterations < MAX_ITERATIONS):
             estimate = EstimationMaximizationAggregator.weighted_majority(data_by_worker, subsample, worker_weights)
             if EstimationMaximizationAggregator.has_converged(old_estimate, estimate):
+                profiling.record("EstimationMaximizationAggregator", iterations=iterations, converged=True)
                 return estimate
             else:
                 old_estimate = estimate
                 worker_weights = EstimationMaximizationAggregator.update_weights(data_by_worker, subsample, estimate)
                 iterations += 1
         
+        profiling.record("EstimationMaximizationAggregator", iterations=iterations, converged=False)
         return old_estimate
     
     def has_converged(old_estimate: dict[str, int], new_estimate: dict[str, int]) -> bool:
@@ -106,9 +154,9 @@ class EstimationMaximizationAggregator(Aggregator):
             for worker in workers:
                 aggregate += data_by_worker[worker][task_id] * weights[worker]
             
-            if aggregate > 0:
+            if aggregate > TIE_TOLERANCE:
                 aggregations[task_id] = 1
-            elif aggregate < 0:
+            elif aggregate < -TIE_TOLERANCE:
                 aggregations[task_id] = -1
             # Actually manifest random label
             elif random.uniform(0, 1) < 0.5:
@@ -118,10 +166,172 @@ class EstimationMaximizationAggregator(Aggregator):
         
         return aggregations
 
+# Same algorithm as EstimationMaximizationAggregator, with each iteration done
+# as array operations over a sparse tasks x workers matrix
+class VectorizedEstimationMaximizationAggregator(Aggregator):
+    def aggregate(data_by_worker: dict[str, dict[str, int]],
+                  subsample: dict[str, set[str]],
+                  rng: numpy.random.Generator | int | None = None) -> dict[str, int]:
+        arrays = SubsampleArrays.from_dicts(data_by_worker, subsample)
+        estimate = VectorizedEstimationMaximizationAggregator.aggregate_arrays(
+            arrays.tasks, arrays.workers, arrays.labels, len(arrays.task_ids), len(arrays.worker_ids), rng)
+        return dict(zip(arrays.task_ids, estimate.tolist()))
+
+    # Returns Task index --> aggregation
+    def aggregate_arrays(tasks: numpy.ndarray,
+                         workers: numpy.ndarray,
+                         labels: numpy.ndarray,
+                         num_tasks: int,
+                         num_workers: int,
+                         rng: numpy.random.Generator | int | None = None) -> numpy.ndarray:
+        import scipy.sparse
+        rng = numpy.random.default_rng(rng)
+        matrix = scipy.sparse.csr_matrix((labels.astype(numpy.float64), (tasks, workers)),
+                                         shape=(num_tasks, num_workers))
+        worker_weights = numpy.ones(num_workers)
+        old_estimate = numpy.zeros(num_tasks, dtype=numpy.int8)
+
+        iterations = 0
+        while(iterations < MAX_ITERATIONS):
+            estimate = VectorizedEstimationMaximizationAggregator.weighted_majority(matrix, worker_weights, rng)
+            if numpy.array_equal(old_estimate, estimate):
+                profiling.record("VectorizedEstimationMaximizationAggregator", iterations=iterations, converged=True)
+                return estimate
+            else:
+                old_estimate = estimate
+                worker_weights = VectorizedEstimationMaximizationAggregator.update_weights(
+                    tasks, workers, labels, estimate, num_workers)
+                iterations += 1
+
+        profiling.record("VectorizedEstimationMaximizationAggregator", iterations=iterations, converged=False)
+        return old_estimate
+
+    # Worker index --> 2 * (proportion agreeing with the estimate) - 1
+    def update_weights(tasks: numpy.ndarray,
+                       workers: numpy.ndarray,
+                       labels: numpy.ndarray,
+                       estimate: numpy.ndarray,
+                       num_workers: int) -> numpy.ndarray:
+        correct = numpy.bincount(workers, weights=labels == estimate[tasks], minlength=num_workers)
+        total = numpy.bincount(workers, minlength=num_workers)
+        # Workers without labels in the subsample never vote, so their weight is irrelevant
+        accuracy = numpy.divide(correct, total, out=numpy.zeros(num_workers), where=total > 0)
+        return 2 * accuracy - 1
+
+    def weighted_majority(matrix: "scipy.sparse.csr_matrix",
+                          weights: numpy.ndarray,
+                          rng: numpy.random.Generator) -> numpy.ndarray:
+        votes = matrix @ weights
+        aggregations = numpy.sign(votes).astype(numpy.int8)
+
+        # Actually manifest random label
+        ties = numpy.flatnonzero(numpy.abs(votes) <= TIE_TOLERANCE)
+        aggregations[ties] = numpy.where(rng.random(len(ties)) < 0.5, -1, 1)
+        return aggregations
+
+@dataclasses.dataclass
+class DawidSkeneResult:
+    # Task index --> class index --> posterior probability
+    posteriors: numpy.ndarray
+    # Worker index --> true class index --> given class index --> probability
+    confusion: numpy.ndarray
+    # Class index --> prior probability
+    priors: numpy.ndarray
+    log_likelihood: float
+    iterations: int
+    converged: bool
+
+# Multi-class Dawid-Skene: one confusion matrix per worker and soft posteriors
+# per task, estimated by EM in log space. Labels can be any integers; they are
+# mapped onto class indices in sorted order.
+class DawidSkeneAggregator(Aggregator):
+    def aggregate(data_by_worker: dict[str, dict[str, int]],
+                  subsample: dict[str, set[str]]) -> dict[str, int]:
+        arrays = SubsampleArrays.from_dicts(data_by_worker, subsample)
+        (classes, codes) = numpy.unique(arrays.labels, return_inverse=True)
+        result = DawidSkeneAggregator.aggregate_arrays(arrays.tasks, arrays.workers, codes.astype(numpy.int32),
+                                                       len(arrays.task_ids), len(arrays.worker_ids), len(classes))
+        estimates = classes[numpy.argmax(result.posteriors, axis=1)]
+        return dict(zip(arrays.task_ids, estimates.tolist()))
+
+    def aggregate_arrays(tasks: numpy.ndarray,
+                         workers: numpy.ndarray,
+                         labels: numpy.ndarray,
+                         num_tasks: int,
+                         num_workers: int,
+                         num_classes: int,
+                         tolerance: float = DAWID_SKENE_TOLERANCE,
+                         max_iterations: int = DAWID_SKENE_MAX_ITERATIONS) -> DawidSkeneResult:
+        # The result needs at least one M-step to have confusion matrices
+        assert max_iterations >= 1
+        # Start from the (soft) majority vote
+        posteriors = numpy.zeros((num_tasks, num_classes))
+        numpy.add.at(posteriors, (tasks, labels), 1)
+        posteriors = DawidSkeneAggregator.normalize_rows(posteriors + DAWID_SKENE_SMOOTHING)
+
+        log_likelihood = -numpy.inf
+        for iteration in range(1, max_iterations + 1):
+            (log_priors, log_confusion) = DawidSkeneAggregator.maximization(tasks, workers, labels, posteriors, num_workers, num_classes)
+            (posteriors, new_log_likelihood) = DawidSkeneAggregator.expectation(tasks, workers, labels, log_priors, log_confusion, num_tasks)
+
+            converged = abs(new_log_likelihood - log_likelihood) <= tolerance * abs(new_log_likelihood)
+            log_likelihood = new_log_likelihood
+            if converged:
+                break
+
+        profiling.record("DawidSkeneAggregator", iterations=iteration, converged=bool(converged),
+                         log_likelihood=float(log_likelihood))
+        return DawidSkeneResult(posteriors, numpy.exp(log_confusion), numpy.exp(log_priors),
+                                float(log_likelihood), iteration, bool(converged))
+
+    # Returns (log class priors, log confusion matrices) given task posteriors
+    def maximization(tasks: numpy.ndarray,
+                     workers: numpy.ndarray,
+                     labels: numpy.ndarray,
+                     posteriors: numpy.ndarray,
+                     num_workers: int,
+                     num_classes: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        priors = posteriors.sum(axis=0) + DAWID_SKENE_SMOOTHING
+        log_priors = numpy.log(priors / priors.sum())
+
+        # counts[w, j, l] = expected number of times worker w said l when the truth was j
+        cell = workers.astype(numpy.int64) * num_classes + labels
+        counts = numpy.empty((num_workers, num_classes, num_classes))
+        for true_class in range(num_classes):
+            counts[:, true_class, :] = numpy.bincount(cell, weights=posteriors[tasks, true_class],
+                                                      minlength=num_workers * num_classes).reshape(num_workers, num_classes)
+        counts += DAWID_SKENE_SMOOTHING
+        return (log_priors, numpy.log(counts / counts.sum(axis=2, keepdims=True)))
+
+    # Returns (task posteriors, log-likelihood) given priors and confusion matrices
+    def expectation(tasks: numpy.ndarray,
+                    workers: numpy.ndarray,
+                    labels: numpy.ndarray,
+                    log_priors: numpy.ndarray,
+                    log_confusion: numpy.ndarray,
+                    num_tasks: int) -> tuple[numpy.ndarray, float]:
+        num_classes = len(log_priors)
+        # log P(labels of t, truth j) = log prior_j + sum over t's labels of log confusion[w, j, l]
+        log_joint = numpy.empty((num_tasks, num_classes))
+        label_terms = log_confusion[workers, :, labels]
+        for true_class in range(num_classes):
+            log_joint[:, true_class] = numpy.bincount(tasks, weights=label_terms[:, true_class], minlength=num_tasks)
+        log_joint += log_priors
+
+        # Normalize in log space
+        peak = log_joint.max(axis=1, keepdims=True)
+        log_evidence = peak[:, 0] + numpy.log(numpy.exp(log_joint - peak).sum(axis=1))
+        return (numpy.exp(log_joint - log_evidence[:, None]), float(log_evidence.sum()))
+
+    def normalize_rows(matrix: numpy.ndarray) -> numpy.ndarray:
+        return matrix / matrix.sum(axis=1, keepdims=True)
+
 class SVDAggregator(Aggregator):
+    # The first worker, in `data_by_worker` order, who is right on more than
+    # half of their subsample labels, or None if nobody is
     def find_good_worker(data_by_worker: dict[str, dict[str, int]],
                          data_by_task: dict[str, parse.TaskEntry],
-                         subsample: dict[str, set[str]]) -> str:
+                         subsample: dict[str, set[str]]) -> str | None:
         worker_correct: dict[str, int] = {}
         worker_total: dict[str, int] = {}
 
@@ -135,72 +345,105 @@ class SVDAggregator(Aggregator):
                     worker_correct[worker_id] += 1
                 worker_total[worker_id] += 1
         
-        for worker_id in worker_correct:
-            if worker_correct[worker_id] * 2 > worker_total[worker_id]:
+        for worker_id in data_by_worker:
+            if worker_id in worker_correct and worker_correct[worker_id] * 2 > worker_total[worker_id]:
                 return worker_id
+        return None
 
+    # Without a `good_worker` the leading vector's sign is kept as found
     def aggregate(data_by_worker: dict[str, dict[str, int]],
                   subsample: dict[str, set[str]],
-                  good_worker: str) -> dict[str, int]:
+                  good_worker: str | None,
+                  method: str = "auto",
+                  solver: "spectral.WarmStart | None" = None) -> dict[str, int]:
+        import spectral
         # Calculate the top eigenvector
-        (_, tasks, matrix) = SVDAggregator.convert_to_matrix(data_by_worker, subsample)
-        symmetrical_matrix = numpy.matmul(matrix, numpy.transpose(matrix))
-        (eigenvalues, eigenvectors) = numpy.linalg.eig(symmetrical_matrix)
-
-        # Find the maximal eigenvalue
-        max_index = 0
-        for index in range(len(eigenvalues)):
-            if eigenvalues[index] > eigenvalues[max_index]:
-                max_index = index
-
-        estimates: list[int] = []
-        numpy.set_printoptions(threshold=20)
-        for task in range(len(tasks)):
-            value = eigenvectors[task][max_index]
-            if value > 0:
-                estimates.append(1)
-            elif value < 0:
-                estimates.append(-1)
-            elif random.uniform(1, 0) < 0.5:
-                estimates.append(-1)
-            else:
-                estimates.append(1)
+        with profiling.phase("convert_to_matrix"):
+            (_, tasks, matrix) = SVDAggregator.convert_to_sparse_matrix(data_by_worker, subsample)
+        profiling.record("SVD matrix", tasks=matrix.shape[0], workers=matrix.shape[1], labels=matrix.nnz)
+        with profiling.phase("leading_vector"):
+            result = spectral.leading_vector(matrix, method) if solver is None else solver.solve(matrix)
+        profiling.record("SVD leading vector", method=result.method, iterations=result.iterations, converged=result.converged)
+        estimates = SVDAggregator.sign_estimates(result.vector)
 
         # Compare against the good worker
         aggregate = 0
-        for task_id in data_by_worker[good_worker]:
-            aggregate += data_by_worker[good_worker][task_id] * estimates[tasks[task_id]]
+        for task_id in data_by_worker[good_worker] if good_worker is not None else []:
+            if task_id in tasks:
+                aggregate += data_by_worker[good_worker][task_id] * estimates[tasks[task_id]]
         
         # Return properly signed estimate
+        sign = 1 if aggregate >= 0 else -1
         result: dict[str, int] = {}
         for task in tasks:
-            if aggregate >= 0:
-                result[task] = estimates[tasks[task]]
-            else:
-                result[task] = -estimates[tasks[task]]
+            result[task] = sign * estimates[tasks[task]]
         
         return result
 
+    # Same as `aggregate` for a subsample flattened by `cache.subsample_indices`,
+    # reusing the dataset's index maps and matrix buffers across trials. With a
+    # `solver`, its method and warm start are used instead of `method`;
+    # otherwise `start` is an optional initial guess at the leading vector.
+    def aggregate_cached(cache: "precompute.DatasetCache",
+                         tasks: numpy.ndarray,
+                         rows: numpy.ndarray,
+                         workers: numpy.ndarray,
+                         good_worker: str | None,
+                         method: str = "auto",
+                         solver: "spectral.WarmStart | None" = None,
+                         start: numpy.ndarray | None = None) -> dict[str, int]:
+        import spectral
+        with profiling.phase("convert_to_matrix"):
+            labels = cache.labels(tasks[rows], workers)
+            matrix = cache.matrix(rows, workers, labels, len(tasks))
+        profiling.record("SVD matrix", tasks=matrix.shape[0], workers=matrix.shape[1], labels=matrix.nnz)
+        with profiling.phase("leading_vector"):
+            result = spectral.leading_vector(matrix, method, start=start) if solver is None else solver.solve(matrix)
+        profiling.record("SVD leading vector", method=result.method, iterations=result.iterations, converged=result.converged)
+        estimates = numpy.array(SVDAggregator.sign_estimates(result.vector), dtype=numpy.int8)
+
+        # Compare against the good worker on every subsample task they labelled
+        aggregate = 0
+        if good_worker is not None:
+            (good_tasks, good_labels) = cache.worker_labels(good_worker)
+            positions = numpy.full(cache.store.num_tasks, -1)
+            positions[tasks] = numpy.arange(len(tasks))
+            mine = positions[good_tasks]
+            aggregate = int(numpy.dot(good_labels[mine >= 0].astype(numpy.int64), estimates[mine[mine >= 0]]))
+
+        # Return properly signed estimate
+        sign = 1 if aggregate >= 0 else -1
+        task_ids = cache.store.task_ids
+        return dict(zip([task_ids[task] for task in tasks.tolist()], (sign * estimates).tolist()))
+
+    # Task index --> sign of the eigenvector entry, with zeros broken randomly
+    def sign_estimates(vector: numpy.ndarray) -> list[int]:
+        import spectral
+        estimates = numpy.sign(vector).astype(numpy.int8)
+        estimates[numpy.abs(vector) <= spectral.ZERO_TOLERANCE] = 0
+        estimates = estimates.tolist()
+        for task in range(len(estimates)):
+            if estimates[task] != 0:
+                continue
+            elif random.uniform(0, 1) < 0.5:
+                estimates[task] = -1
+            else:
+                estimates[task] = 1
+        return estimates
+
     def convert_to_matrix(data_by_worker: dict[str, dict[str, int]],
-                          subsample: dict[str, set[str]]) -> tuple[dict[str, int], dict[str, int], numpy.matrix]:
+                          subsample: dict[str, set[str]]) -> tuple[dict[str, int], dict[str, int], numpy.ndarray]:
+        (workers, tasks, matrix) = SVDAggregator.convert_to_sparse_matrix(data_by_worker, subsample)
+        return (workers, tasks, matrix.toarray())
+
+    # Same as `convert_to_matrix`, but built in one step as a sparse tasks x workers matrix
+    def convert_to_sparse_matrix(data_by_worker: dict[str, dict[str, int]],
+                                 subsample: dict[str, set[str]]) -> tuple[dict[str, int], dict[str, int], "scipy.sparse.csr_matrix"]:
+        import scipy.sparse
+        arrays = SubsampleArrays.from_dicts(data_by_worker, subsample)
         # Create mapping between rows and workers as well as columns and tasks
-        tasks: dict[str, int] = {}
-        workers: dict[str, int] = {}
-        w_index = 0
-        t_index = 0
-        for task in subsample:
-            if task not in tasks:
-                tasks[task] = t_index
-                t_index += 1
-            for worker in subsample[task]:
-                if worker not in workers:
-                    workers[worker] = w_index
-                    w_index += 1
-
-        # Put the values into the matrix
-        matrix = numpy.zeros((len(tasks), len(workers)))
-        for task in tasks:
-            for worker in subsample[task]:
-                matrix.itemset((tasks[task], workers[worker]), data_by_worker[worker][task])
-                
-        return (workers, tasks, matrix)
\ No newline at end of file
+        workers = {worker_id: index for index, worker_id in enumerate(arrays.worker_ids)}
+        tasks = {task_id: index for index, task_id in enumerate(arrays.task_ids)}
+        matrix = scipy.sparse.csr_matrix((arrays.labels.astype(numpy.float64), (arrays.tasks, arrays.workers)),
+                                         shape=(len(tasks), len(workers)))
+        return (workers, tasks, matrix)
@@ -0,0 +1,181 @@
+import aggregators
+import argparse
+import dataclasses
+import json
+import multiprocessing
+import numpy
+import os
+import parse
+import platform
+import profiling
+import sys
+import synthetic
+import tempfile
+import time
+
+# Wall time, peak memory and throughput of the parser and aggregators on
+# synthetic datasets that can be scaled well past RTE's 800 tasks x 164 workers.
+
+CASES = [
+    "parse",
+    "generate_subsample",
+    "generate_extrapolated_dataset",
+    "MajorityVoteAggregator",
+    "EstimationMaximizationAggregator",
+    "VectorizedEstimationMaximizationAggregator",
+    "SVDAggregator"
+]
+# A case is a regression when it is this much slower than the baseline
+REGRESSION_THRESHOLD = 0.2
+
+@dataclasses.dataclass
+class BenchmarkResult:
+    case: str
+    tasks: int
+    workers: int
+    redundancy: int
+    # Labels the case had to process
+    labels: int
+    # Fastest of the repeats
+    seconds: float
+    # Peak resident set size of the process that ran the case, setup included
+    peak_rss_mb: float | None
+    labels_per_second: float
+
+    def key(self) -> tuple[str, int, int, int]:
+        return (self.case, self.tasks, self.workers, self.redundancy)
+
+# Write an RTE-style TSV in which every task is labelled by `redundancy` distinct workers
+def write_synthetic_tsv(filepath: str, tasks: int, workers: int, redundancy: int, seed: int = 0) -> None:
+    synthetic.CrowdSimulator(tasks, workers, redundancy, seed=seed).write_tsv(filepath)
+
+# Returns (labels processed, fastest seconds) for one case
+def time_case(case: str, filepath: str, redundancy: int, repeat: int, seed: int) -> tuple[int, float]:
+    parser = parse.RTEParser()
+    parser.parse(filepath)
+    subsample = parser.indices_to_subsample(parser.generate_subsample_indices(redundancy, rng=seed))
+    num_labels = parser.store.num_tasks * redundancy
+
+    def run() -> None:
+        if case == "parse":
+            parse.RTEParser().parse(filepath)
+        elif case == "generate_subsample":
+            parser.generate_subsample(min(redundancy, 10))
+        elif case == "generate_extrapolated_dataset":
+            parser.generate_extrapolated_dataset()
+        elif case == "SVDAggregator":
+            good_worker = aggregators.SVDAggregator.find_good_worker(parser.data_by_worker, parser.data_by_task, subsample)
+            aggregators.SVDAggregator.aggregate(parser.data_by_worker, subsample, good_worker)
+        else:
+            getattr(aggregators, case).aggregate(parser.data_by_worker, subsample)
+
+    if case == "generate_subsample":
+        num_labels = parser.store.num_tasks * min(redundancy, 10)
+    elif case == "generate_extrapolated_dataset":
+        num_labels = parser.store.num_tasks * parser.store.num_workers
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return (num_labels, best)
+
+def run_case_in_child(connection, case: str, filepath: str, redundancy: int, repeat: int, seed: int) -> None:
+    try:
+        (num_labels, seconds) = time_case(case, filepath, redundancy, repeat, seed)
+        connection.send((num_labels, seconds, profiling.peak_rss_mb(), None))
+    except Exception as error:
+        connection.send((0, 0.0, None, repr(error)))
+    finally:
+        connection.close()
+
+# Each case runs in its own forked process so its peak RSS is not inflated by
+# earlier cases. Without fork the cases run in this process instead.
+def run_case(case: str, filepath: str, tasks: int, workers: int, redundancy: int,
+             repeat: int = 1, seed: int = 0) -> BenchmarkResult:
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        (receiver, sender) = context.Pipe(duplex=False)
+        process = context.Process(target=run_case_in_child, args=(sender, case, filepath, redundancy, repeat, seed))
+        process.start()
+        sender.close()
+        (num_labels, seconds, peak, error) = receiver.recv()
+        process.join()
+        if error is not None:
+            raise RuntimeError(f"Benchmark {case} failed: {error}")
+    else:
+        (num_labels, seconds) = time_case(case, filepath, redundancy, repeat, seed)
+        peak = profiling.peak_rss_mb()
+
+    return BenchmarkResult(case, tasks, workers, redundancy, num_labels, seconds, peak,
+                           num_labels / seconds if seconds > 0 else float("inf"))
+
+def run_benchmarks(task_counts: list[int], workers: int, redundancy: int,
+                   cases: list[str] = CASES, repeat: int = 1, seed: int = 0) -> list[BenchmarkResult]:
+    results: list[BenchmarkResult] = []
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+        for tasks in task_counts:
+            filepath = os.path.join(directory, f"synthetic-{tasks}.tsv")
+            write_synthetic_tsv(filepath, tasks, workers, redundancy, seed)
+            for case in cases:
+                results.append(run_case(case, filepath, tasks, workers, redundancy, repeat, seed))
+    return results
+
+def to_json(results: list[BenchmarkResult]) -> dict:
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor()
+        },
+        "results": [dataclasses.asdict(result) for result in results]
+    }
+
+# Returns a description of every case that got slower than the baseline by more than `threshold`
+def find_regressions(results: list[BenchmarkResult], baseline: dict,
+                     threshold: float = REGRESSION_THRESHOLD) -> list[str]:
+    previous: dict[tuple[str, int, int, int], BenchmarkResult] = {}
+    for entry in baseline["results"]:
+        result = BenchmarkResult(**entry)
+        previous[result.key()] = result
+
+    regressions: list[str] = []
+    for result in results:
+        if result.key() not in previous:
+            continue
+        old = previous[result.key()]
+        if result.seconds > old.seconds * (1 + threshold):
+            regressions.append(f"{result.case} ({result.tasks} tasks x {result.workers} workers, k = {result.redundancy}): "
+                               f"{old.seconds:.4f}s -> {result.seconds:.4f}s")
+    return regressions
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description="Benchmark the parser and aggregators on synthetic datasets.")
+    arguments.add_argument("--tasks", type=int, nargs="+", default=[800, 8000], help="Task counts to scale through")
+    arguments.add_argument("--workers", type=int, default=164)
+    arguments.add_argument("--redundancy", type=int, default=10, help="Labels per task (k)")
+    arguments.add_argument("--cases", nargs="+", default=CASES, choices=CASES)
+    arguments.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest is reported")
+    arguments.add_argument("--seed", type=int, default=0)
+    arguments.add_argument("--output", help="Write the JSON results here instead of stdout")
+    arguments.add_argument("--baseline", help="JSON results to compare against; exits with 1 on regressions")
+    arguments.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    options = arguments.parse_args()
+
+    results = run_benchmarks(options.tasks, options.workers, options.redundancy, options.cases, options.repeat, options.seed)
+    report = json.dumps(to_json(results), indent=2)
+    if options.output is None:
+        print(report)
+    else:
+        with open(options.output, "w") as file:
+            file.write(report + "\n")
+
+    if options.baseline is not None:
+        with open(options.baseline) as file:
+            regressions = find_regressions(results, json.load(file), options.threshold)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
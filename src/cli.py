@@ -0,0 +1,140 @@
+import argparse
+import confidence
+import csv
+import defaults
+import json
+import sys
+
+# Command line entry point for evaluation sweeps. Nothing heavy is imported at
+# module load: the evaluator (and with it NumPy) is loaded once the arguments
+# are valid, and SciPy and the spectral solvers only when SVD is selected.
+# Checks that need the dataset run once the evaluator has loaded it.
+#
+#   python src/cli.py --methods majority em --sizes 1 3 5 --repetitions 20 --format csv
+
+# Command line name --> evaluate.METHODS key
+METHODS = {
+    "majority": "Majority Vote",
+    "em": "Estimation Maximization",
+    "svd": "SVD"
+}
+FORMATS = ("csv", "json")
+
+def argument_parser() -> argparse.ArgumentParser:
+    arguments = argparse.ArgumentParser(description="Run aggregation trials over a grid of methods and k values.")
+    arguments.add_argument("--dataset", default=defaults.DATASET, help="RTE-style TSV to evaluate on")
+    arguments.add_argument("--methods", nargs="+", default=list(METHODS), choices=list(METHODS))
+    arguments.add_argument("--sizes", type=int, nargs="+", default=defaults.SIZES, help="k values: labels per task in each subsample")
+    arguments.add_argument("--extrapolated-sizes", type=int, nargs="*", default=[],
+                           help="k values for SVD on the extrapolated dataset (needs --methods svd)")
+    arguments.add_argument("--repetitions", type=int, default=defaults.REPITITIONS, help="Trials per method and k")
+    arguments.add_argument("--target-width", type=float, default=None,
+                           help="Run trials until each confidence interval is at most this wide, instead of --repetitions")
+    arguments.add_argument("--min-repetitions", type=int, default=defaults.MIN_REPETITIONS, help="First round of trials with --target-width")
+    arguments.add_argument("--max-repetitions", type=int, default=defaults.MAX_REPETITIONS, help="Trial budget per method and k with --target-width")
+    arguments.add_argument("--interval", default="t", choices=confidence.INTERVALS, help="Student t (Welford) or bootstrap confidence intervals")
+    arguments.add_argument("--level", type=float, default=confidence.LEVEL, help="Confidence level of the intervals")
+    arguments.add_argument("--seed", type=int, default=None, help="Base seed for every trial's RNG")
+    arguments.add_argument("--jobs", type=int, default=1, help="Number of worker processes to run trials on")
+    arguments.add_argument("--spectral-method", default="auto", help="Solver for the SVD leading vector, one of spectral.METHODS")
+    arguments.add_argument("--warm-start", action="store_true", help="Start each SVD trial's solver from the whole dataset's leading vector")
+    arguments.add_argument("--cache", metavar="PATH", help="SQLite file of trial results to reuse and extend")
+    arguments.add_argument("--cache-max-mb", type=float, default=None, help="Evict least recently used results beyond this size")
+    arguments.add_argument("--cache-shared", action="store_true", help="Let other processes use the cache at the same time")
+    arguments.add_argument("--format", default="csv", choices=FORMATS)
+    arguments.add_argument("--output", help="Write results here instead of stdout")
+    return arguments
+
+def parse_arguments(argv: list[str] | None = None) -> argparse.Namespace:
+    arguments = argument_parser()
+    options = arguments.parse_args(argv)
+
+    if options.repetitions < 1:
+        arguments.error("--repetitions must be at least 1")
+    if options.target_width is not None and options.target_width <= 0:
+        arguments.error("--target-width must be positive")
+    if options.target_width is not None and not 2 <= options.min_repetitions <= options.max_repetitions:
+        arguments.error("--target-width needs 2 <= --min-repetitions <= --max-repetitions")
+    if not 0 < options.level < 1:
+        arguments.error("--level must be between 0 and 1")
+    if any(not 1 <= size <= defaults.MAX_SIZE for size in options.sizes):
+        arguments.error(f"--sizes must be between 1 and {defaults.MAX_SIZE}")
+    if options.extrapolated_sizes and "svd" not in options.methods:
+        arguments.error("--extrapolated-sizes only applies to --methods svd")
+
+    # The spectral solvers (and SciPy) are only loaded when SVD will run
+    if "svd" in options.methods:
+        import spectral
+        if options.spectral_method not in spectral.METHODS:
+            arguments.error(f"--spectral-method must be one of {', '.join(spectral.METHODS)}")
+        if options.warm_start and options.spectral_method not in spectral.WARM_METHODS:
+            arguments.error(f"--warm-start needs --spectral-method {', '.join(spectral.WARM_METHODS)}")
+    return options
+
+# Exits with a usage error if `options` ask for more than `store` can give
+def check_dataset(options: argparse.Namespace, store: "labelstore.LabelStore") -> None:
+    num_workers = store.num_workers
+    if any(not defaults.MAX_SIZE < size <= num_workers for size in options.extrapolated_sizes):
+        argument_parser().error(f"--extrapolated-sizes must be between {defaults.MAX_SIZE + 1} and {num_workers}, the number of workers")
+
+# Returns the sweep's configuration and results as one JSON-ready dictionary
+def run(options: argparse.Namespace) -> dict:
+    import evaluate
+
+    cache = None
+    if options.cache is not None:
+        import resultcache
+        max_mb = resultcache.DEFAULT_MAX_MB if options.cache_max_mb is None else options.cache_max_mb
+        cache = resultcache.ResultCache(options.cache, max_mb, options.cache_shared)
+    try:
+        evaluator = evaluate.Evaluator(seed=options.seed, spectral_method=options.spectral_method, warm_start=options.warm_start,
+                                       methods=[METHODS[method] for method in options.methods],
+                                       repetitions=options.repetitions, dataset=options.dataset, cache=cache,
+                                       target_width=options.target_width, min_repetitions=options.min_repetitions,
+                                       max_repetitions=options.max_repetitions, interval=options.interval, level=options.level)
+        check_dataset(options, evaluator.parser.store)
+        evaluator.run(options.sizes, options.extrapolated_sizes, options.jobs)
+    finally:
+        if cache is not None:
+            cache.close()
+    return {
+        "dataset": options.dataset,
+        "seed": evaluator.seed,
+        "repetitions": options.repetitions,
+        "target_width": options.target_width,
+        "level": options.level,
+        "errors": evaluator.errors,
+        "average_errors": evaluator.average_errors,
+        "confidence_intervals": evaluator.confidence_intervals,
+        "extrapolated_errors": {"SVD": evaluator.extrapolated_errors} if evaluator.extrapolated_errors else {},
+        "average_extrapolated_errors": {"SVD": evaluator.average_extrapolated_errors} if evaluator.extrapolated_errors else {},
+        "extrapolated_confidence_intervals": {"SVD": evaluator.extrapolated_confidence_intervals} if evaluator.extrapolated_errors else {}
+    }
+
+# One CSV row per trial: method, k, extrapolated, trial, error
+def write_csv(report: dict, file) -> None:
+    writer = csv.writer(file)
+    writer.writerow(["method", "k", "extrapolated", "trial", "error"])
+    for (key, extrapolated) in [("errors", False), ("extrapolated_errors", True)]:
+        for method in report[key]:
+            for size in report[key][method]:
+                for (trial, error) in enumerate(report[key][method][size]):
+                    writer.writerow([method, size, int(extrapolated), trial, error])
+
+def main(argv: list[str] | None = None) -> None:
+    options = parse_arguments(argv)
+    report = run(options)
+
+    file = sys.stdout if options.output is None else open(options.output, "w", newline="")
+    try:
+        if options.format == "json":
+            json.dump(report, file, indent=2)
+            file.write("\n")
+        else:
+            write_csv(report, file)
+    finally:
+        if file is not sys.stdout:
+            file.close()
+
+if __name__ == "__main__":
+    main()
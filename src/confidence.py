@@ -0,0 +1,109 @@
+import dataclasses
+import math
+import statistics
+
+# Confidence intervals for the mean error of repeated trials. `RunningStats`
+# keeps Welford's running mean and variance, so a cell's Student t interval is
+# updated in constant time per trial; `bootstrap_interval` resamples the
+# errors instead and makes no normality assumption, at the cost of keeping
+# them all. Only the bootstrap needs NumPy, and it imports it itself, so the
+# command line can read INTERVALS and LEVEL from here without loading it.
+
+INTERVALS = ("t", "bootstrap")
+LEVEL = 0.95
+BOOTSTRAP_SAMPLES = 2000
+# Newton refinements of the Cornish-Fisher t quantile
+NEWTON_STEPS = 4
+
+@dataclasses.dataclass
+class RunningStats:
+    count: int = 0
+    mean: float = 0.0
+    # Sum of squared deviations from the running mean
+    squares: float = 0.0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.squares += delta * (value - self.mean)
+
+    def extend(self, values: list[float]) -> None:
+        for value in values:
+            self.add(value)
+
+    # Sample variance, 0 until there are two values
+    def variance(self) -> float:
+        return self.squares / (self.count - 1) if self.count > 1 else 0.0
+
+    # Student t interval for the mean, None until there are two values
+    def interval(self, level: float = LEVEL) -> tuple[float, float] | None:
+        if self.count < 2:
+            return None
+        half_width = t_quantile((1 + level) / 2, self.count - 1) * math.sqrt(self.variance() / self.count)
+        return (self.mean - half_width, self.mean + half_width)
+
+# Quantile of Student's t distribution: exact for one and two degrees of
+# freedom, otherwise the Cornish-Fisher expansion around the normal quantile
+# (Abramowitz & Stegun 26.7.5), polished by Newton steps on `t_cdf`. This
+# keeps SciPy out of runs that do not otherwise need it.
+def t_quantile(probability: float, degrees: int) -> float:
+    if degrees == 1:
+        return math.tan(math.pi * (probability - 0.5))
+    if degrees == 2:
+        return (2 * probability - 1) / math.sqrt(2 * probability * (1 - probability))
+    z = statistics.NormalDist().inv_cdf(probability)
+    terms = [
+        (z ** 3 + z) / 4,
+        (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96,
+        (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384,
+        (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+    ]
+    quantile = z + sum(term / degrees ** power for (power, term) in enumerate(terms, 1))
+
+    # The expansion is already within 0.2% at 95%, so a few steps reach full precision
+    scale = math.exp(math.lgamma((degrees + 1) / 2) - math.lgamma(degrees / 2)) / math.sqrt(degrees * math.pi)
+    for _ in range(NEWTON_STEPS):
+        density = scale * (1 + quantile ** 2 / degrees) ** (-(degrees + 1) / 2)
+        step = (t_cdf(quantile, degrees) - probability) / density
+        quantile -= step
+        if abs(step) <= 1e-12 * abs(quantile):
+            break
+    return quantile
+
+# Student's t CDF for integer degrees of freedom by the finite series of
+# Abramowitz & Stegun 26.7.3 and 26.7.4
+def t_cdf(value: float, degrees: int) -> float:
+    theta = math.atan(value / math.sqrt(degrees))
+    (sine, cosine) = (math.sin(theta), math.cos(theta))
+    if degrees % 2 == 1:
+        # theta + sin(theta) (cos(theta) + 2/3 cos^3(theta) + ... + cos^(degrees - 2)(theta) terms)
+        term = sine * cosine if degrees > 1 else 0.0
+        total = term
+        for power in range(3, degrees - 1, 2):
+            term *= (power - 1) / power * cosine ** 2
+            total += term
+        central = 2 / math.pi * (theta + total)
+    else:
+        # sin(theta) (1 + 1/2 cos^2(theta) + ... + cos^(degrees - 2)(theta) terms)
+        term = sine
+        total = term
+        for power in range(2, degrees - 1, 2):
+            term *= (power - 1) / power * cosine ** 2
+            total += term
+        central = total
+    # `central` is P(-|value| < T < |value|), signed like `value`
+    return (1 + central) / 2
+
+# Percentile bootstrap interval for the mean of `values`, None until there are two
+def bootstrap_interval(values: list[float], level: float = LEVEL,
+                       rng: "numpy.random.Generator | int | None" = None,
+                       samples: int = BOOTSTRAP_SAMPLES) -> tuple[float, float] | None:
+    import numpy
+    if len(values) < 2:
+        return None
+    rng = numpy.random.default_rng(rng)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    means = values[rng.integers(0, len(values), (samples, len(values)))].mean(axis=1)
+    (low, high) = numpy.quantile(means, [(1 - level) / 2, (1 + level) / 2])
+    return (float(low), float(high))
@@ -0,0 +1,13 @@
+# Evaluation defaults shared by evaluate.py and cli.py. Nothing is imported
+# here, so the command line can read them without loading NumPy.
+
+DATASET = "rte.standardized.tsv"
+REPITITIONS = 10
+# Trials per (method, k) in adaptive mode: the first round, and the budget
+MIN_REPETITIONS = 5
+MAX_REPETITIONS = 100
+# Labels per RTE task. Regular subsamples draw at most this many; extrapolated
+# ones keep this many real labels and go beyond it, up to one from every worker.
+MAX_SIZE = 10
+SIZES = list(range(1, MAX_SIZE + 1))
+EXTRAPOLATED_SIZES = [11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 22, 24, 26, 28, 30, 35, 40, 50, 60, 80, 100]
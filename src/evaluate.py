@@ -1,31 +1,118 @@
+import argparse
+import concurrent.futures
+import confidence
+import cProfile
+import dataclasses
+import defaults
+import json
+import labelstore
+import numpy
+import os
 import parse
 import aggregators
+import profiling
+import random
+import shutil
+import tempfile
 
-REPITITIONS = 10
 METHODS: dict[str, aggregators.Aggregator] = {
     "Majority Vote": aggregators.MajorityVoteAggregator,
     "Estimation Maximization": aggregators.EstimationMaximizationAggregator,
     "SVD": aggregators.SVDAggregator
 }
+# Bump a method's version whenever a change alters its results, so cached
+# trials from the old code are recomputed
+METHOD_VERSIONS: dict[str, str] = {
+    "Majority Vote": "1",
+    "Estimation Maximization": "1",
+    "SVD": "1"
+}
+# Methods `run_batched_trials` can score as one tensor operation
+BATCHED_METHODS = ("Majority Vote", "Weighted Vote")
+
+# One independent trial. Its RNG seed only depends on the evaluator's seed and
+# these fields, so results do not change with the number of worker processes.
+@dataclasses.dataclass(frozen=True)
+class Trial:
+    size: int
+    iteration: int
+    extrapolated: bool = False
+
+    def seed(self, base_seed: int) -> int:
+        sequence = numpy.random.SeedSequence([base_seed, int(self.extrapolated), self.size, self.iteration])
+        return int(sequence.generate_state(1)[0])
 
 class Evaluator:
-    def __init__(self) -> None:
-        self.parser = parse.RTEParser()
-        self.parser.parse("rte.standardized.tsv")
+    # `spectral_method` picks the SVD solver; with `warm_start` each SVD trial
+    # starts from the leading vector of the whole dataset, which is the same
+    # for every trial, so results do not depend on trial order or processes.
+    # `methods` are keys of METHODS, run on every trial's subsample. With a
+    # `cache`, trials already in it are not run again. With a `target_width`,
+    # each (method, k) runs between `min_repetitions` and `max_repetitions`
+    # trials, stopping once its `level` confidence interval is that narrow;
+    # otherwise each runs `repetitions`. `interval` is one of confidence.INTERVALS.
+    def __init__(self, parser: parse.RTEParser | None = None, seed: int | None = None,
+                 spectral_method: str = "auto", warm_start: bool = False,
+                 methods: list[str] | None = None, repetitions: int = defaults.REPITITIONS,
+                 dataset: str = defaults.DATASET, cache=None,
+                 target_width: float | None = None, min_repetitions: int = defaults.MIN_REPETITIONS,
+                 max_repetitions: int = defaults.MAX_REPETITIONS, interval: str = "t",
+                 level: float = confidence.LEVEL) -> None:
+        if parser is None:
+            parser = parse.RTEParser()
+            with profiling.phase("parse"):
+                cached = parser.parse_cached(dataset)
+            profiling.record("parse", dataset=dataset, cached=cached, labels=len(parser.store))
+        self.parser = parser
+        self.seed: int = seed if seed is not None else random.randrange(2 ** 32)
+        self.methods: list[str] = list(METHODS) if methods is None else methods
+        for method in self.methods:
+            assert method in METHODS, f"Unknown method {method}"
+        self.repetitions = repetitions
+        assert target_width is None or 2 <= min_repetitions <= max_repetitions, "Adaptive mode needs 2 <= min <= max repetitions"
+        assert interval in confidence.INTERVALS, f"Unknown interval {interval}"
+        self.target_width = target_width
+        self.min_repetitions = min_repetitions
+        self.max_repetitions = max_repetitions
+        self.interval_method = interval
+        self.level = level
+        # resultcache.ResultCache that trial results are read from and written to
+        self.cache = cache
+        self._fingerprint: str | None = None
+        self.spectral_method = spectral_method
+        self.warm_start = warm_start
+        # Extrapolated? --> Task index --> entry of the whole dataset's leading vector
+        self.warm_starts: dict[bool, numpy.ndarray] = {}
+        if warm_start:
+            import spectral
+            assert spectral_method in spectral.WARM_METHODS, f"Spectral method {spectral_method} cannot be warm-started"
 
         # Task ID --> Answer
         self.answers: dict[str, int] = {}
         for task_id in self.parser.data_by_task:
             self.answers[task_id] = self.parser.data_by_task[task_id].true_label
 
+        # Worker ID --> Task ID --> Label for every (worker, task) pair
+        self.extrapolated_dataset: dict[str, dict[str, int]] | None = None
+
         # Method --> k (size) --> trial iteration errors
         self.errors: dict[str, dict[int, list[float]]] = {}
         # Method --> k (size) --> average error
         self.average_errors: dict[str, dict[int, float]] = {}
+        # Method --> k (size) --> confidence interval of the average error (None below two trials)
+        self.confidence_intervals: dict[str, dict[int, tuple[float, float] | None]] = {}
 
-        for method in METHODS:
+        for method in self.methods:
             self.errors[method]: dict[int, list[float]] = {}
             self.average_errors[method]: dict[int, float] = {}
+            self.confidence_intervals[method]: dict[int, tuple[float, float] | None] = {}
+
+        # Extrapolated k (size) --> trial iteration SVD errors
+        self.extrapolated_errors: dict[int, list[float]] = {}
+        # Extrapolated k (size) --> average SVD error
+        self.average_extrapolated_errors: dict[int, float] = {}
+        # Extrapolated k (size) --> confidence interval of the average SVD error
+        self.extrapolated_confidence_intervals: dict[int, tuple[float, float] | None] = {}
 
     # Return the error (incorrect / total) for a certain determination
     def evaluate(self, aggregations: dict[str, int]) -> float:
@@ -36,66 +123,446 @@ class Evaluator:
                 incorrect += 0.5
             elif self.answers[task_id] != aggregations[task_id]:
                 incorrect += 1
-        
+
         return incorrect / len(aggregations)
 
-    def run_trials(self, size: int) -> None:
-        # Run REPITITIONS # of trials
-        for _ in range(REPITITIONS):
-            subsample = self.parser.generate_subsample(size)
-
-            # Run this subsample on every method
-            for method in METHODS:
-                if method == "SVD":
-                    good_worker = aggregators.SVDAggregator.find_good_worker(self.parser.data_by_worker, self.parser.data_by_task, subsample)
-                    aggregations = aggregators.SVDAggregator.aggregate(self.parser.data_by_worker, subsample, good_worker)
-                else:
-                    aggregations = METHODS[method].aggregate(self.parser.data_by_worker, subsample)
-                error = self.evaluate(aggregations)
-                if size not in self.errors[method]:
-                    self.errors[method][size] = []
-                self.errors[method][size].append(error)
-        
+    # Returns Method --> error for a single trial. Only `methods` run if given
+    # (SVD alone for extrapolated trials); with `aggregations`, each method's
+    # Task ID --> Aggregation is stored there as well. The subsample comes from
+    # the batched index sampler with a generator seeded by the trial, and every
+    # method breaks ties from the same `random` state, so its result does not
+    # depend on which other methods ran.
+    def run_trial(self, trial: Trial, methods: list[str] | None = None,
+                  aggregations: dict[str, dict[str, int]] | None = None) -> dict[str, float]:
+        # Generated from the evaluator's seed alone, so a pool worker started
+        # without it builds the same dataset as every other process
+        if trial.extrapolated and self.extrapolated_dataset is None:
+            self.generate_extrapolated_dataset()
+        seed = trial.seed(self.seed)
+        profiling.count("trials")
+        if methods is None:
+            methods = ["SVD"] if trial.extrapolated else self.methods
+
+        with profiling.phase("subsample"):
+            rng = numpy.random.default_rng(seed)
+            if trial.extrapolated:
+                workers = self.parser.generate_extrapolated_subsample_indices(trial.size, rng=rng)
+            else:
+                workers = self.parser.generate_subsample_indices(trial.size, rng=rng)
+            subsample = self.parser.indices_to_subsample(workers)
+        data_by_worker = self.extrapolated_dataset if trial.extrapolated else self.parser.data_by_worker
+        random.seed(seed)
+        state = random.getstate()
+        errors: dict[str, float] = {}
+
+        # Run this subsample on every method
+        for method in methods:
+            random.setstate(state)
+            if method == "SVD":
+                cache = self.dataset_cache(data_by_worker)
+                with profiling.phase("find_good_worker"):
+                    (tasks, rows, workers) = cache.subsample_indices(subsample)
+                    good_worker = cache.find_good_worker(tasks, rows, workers)
+                with profiling.phase("Extrapolated SVD" if trial.extrapolated else method):
+                    start = self.warm_start_vector(trial.extrapolated)[tasks] if self.warm_start else None
+                    result = aggregators.SVDAggregator.aggregate_cached(cache, tasks, rows, workers, good_worker,
+                                                                        self.spectral_method, start=start)
+            else:
+                with profiling.phase(method):
+                    result = METHODS[method].aggregate(data_by_worker, subsample)
+            with profiling.phase("evaluate"):
+                errors[method] = self.evaluate(result)
+            if aggregations is not None:
+                aggregations[method] = result
+
+        return errors
+
+    # Precomputed index maps and buffers for one of the evaluator's datasets.
+    # Like SciPy and the spectral solvers, it is only imported once an SVD
+    # trial runs, so sweeps over the other methods start faster.
+    def dataset_cache(self, data_by_worker: dict[str, dict[str, int]]):
+        import precompute
+        return precompute.get(data_by_worker, self.parser.data_by_task)
+
+    # Leading vector of every real label in the dataset, computed once and used
+    # to start each SVD trial's solver. Extrapolated subsamples keep all their
+    # real labels, so they start from the same vector, in their store's task order.
+    def warm_start_vector(self, extrapolated: bool) -> numpy.ndarray:
+        if extrapolated not in self.warm_starts:
+            if extrapolated:
+                task_index = self.parser.store.task_index
+                task_ids = self.dataset_cache(self.extrapolated_dataset).store.task_ids
+                self.warm_starts[True] = self.warm_start_vector(False)[[task_index[task_id] for task_id in task_ids]]
+            else:
+                import scipy.sparse
+                import spectral
+                store = self.parser.store
+                matrix = scipy.sparse.csr_matrix((store.labels.astype(numpy.float64), (store.tasks, store.workers)),
+                                                 shape=(store.num_tasks, store.num_workers))
+                with profiling.phase("warm_start_vector"):
+                    self.warm_starts[False] = spectral.leading_vector(matrix, self.spectral_method).vector
+        return self.warm_starts[extrapolated]
+
+    # Run trials in this process, or spread them over `pool` if one is given.
+    # `methods` optionally lists the methods to run on each trial.
+    def map_trials(self, trials: list[Trial],
+                   pool: concurrent.futures.Executor | None = None,
+                   methods: list[list[str]] | None = None) -> list[dict[str, float]]:
+        if methods is None:
+            methods = [None] * len(trials)
+        if pool is None:
+            return [self.run_trial(trial, trial_methods) for (trial, trial_methods) in zip(trials, methods)]
+        # Exceptions raised in a worker are re-raised here
+        return list(pool.map(run_pooled_trial, trials, methods))
+
+    # Same as `map_trials`, but with a result cache only the (trial, method)
+    # cells it lacks are run, and their errors and aggregations are stored
+    def map_cached_trials(self, trials: list[Trial],
+                          pool: concurrent.futures.Executor | None = None,
+                          methods: list[list[str]] | None = None) -> list[dict[str, float]]:
+        if self.cache is None:
+            return self.map_trials(trials, pool, methods)
+        import resultcache
+
+        if methods is None:
+            methods = [["SVD"] if trial.extrapolated else self.methods for trial in trials]
+        cells = [{method: self.cell(trial, method) for method in trial_methods} for (trial, trial_methods) in zip(trials, methods)]
+        stored = self.cache.get_many([cell for trial_cells in cells for cell in trial_cells.values()])
+        results = [{method: stored[cell].error for (method, cell) in trial_cells.items() if cell in stored} for trial_cells in cells]
+
+        requests = [(trial, [method for method in trial_methods if method not in result])
+                    for (trial, trial_methods, result) in zip(trials, methods, results)]
+        missing = [index for (index, (_, request_methods)) in enumerate(requests) if request_methods]
+        profiling.count("cached cells", len(stored))
+        profiling.count("computed cells", sum(len(requests[index][1]) for index in missing))
+
+        if pool is None:
+            computed = [self.run_trial_request(requests[index]) for index in missing]
+        else:
+            computed = list(pool.map(run_pooled_request, [requests[index] for index in missing]))
+        new_cells: dict = {}
+        for (index, (errors, aggregations)) in zip(missing, computed):
+            results[index].update(errors)
+            for method in errors:
+                new_cells[cells[index][method]] = resultcache.CellResult(errors[method], aggregations[method])
+        if new_cells:
+            self.cache.put_many(new_cells)
+
+        # Keep each trial's methods in their usual order
+        return [{method: result[method] for method in trial_methods} for (trial_methods, result) in zip(methods, results)]
+
+    # Returns (Method --> error, Method --> Task ID --> Aggregation)
+    def run_trial_request(self, request: tuple[Trial, list[str]]) -> tuple[dict[str, float], dict[str, dict[str, int]]]:
+        aggregations: dict[str, dict[str, int]] = {}
+        errors = self.run_trial(request[0], request[1], aggregations)
+        return (errors, aggregations)
+
+    # Result cache cell of one method on one trial
+    def cell(self, trial: Trial, method: str):
+        import resultcache
+        if self._fingerprint is None:
+            self._fingerprint = resultcache.fingerprint_store(self.parser.store)
+        version = METHOD_VERSIONS[method]
+        if method == "SVD":
+            version += f"/{self.spectral_method}" + ("/warm-start" if self.warm_start else "")
+        return resultcache.Cell(self._fingerprint, method, version, trial.size, trial.extrapolated, self.seed, trial.iteration)
+
+    def run_trials(self, size: int, pool: concurrent.futures.Executor | None = None) -> None:
+        (errors, intervals) = self.collect_trials([size], False, pool)
+
         # Calculate the average errors for each method
-        for method in METHODS:
+        for method in self.methods:
+            self.errors[method][size] = errors[size][method]
             average = 0
             for error in self.errors[method][size]:
                 average += error
-            self.average_errors[method][size] = average / REPITITIONS
-    
-    def main(self) -> None:
-        for size in range(1, 11):
-            self.run_trials(size)
+            self.average_errors[method][size] = average / len(self.errors[method][size])
+            self.confidence_intervals[method][size] = intervals[size][method]
+
+    # Perform SVD on extrapolated samples of each size
+    def run_extrapolated_trials(self, sizes: list[int], pool: concurrent.futures.Executor | None = None) -> None:
+        (errors, intervals) = self.collect_trials(sizes, True, pool)
+
+        for size in sizes:
+            self.extrapolated_errors[size] = errors[size]["SVD"]
+            total_error = 0
+            for error in self.extrapolated_errors[size]:
+                total_error += error
+            self.average_extrapolated_errors[size] = total_error / len(self.extrapolated_errors[size])
+            self.extrapolated_confidence_intervals[size] = intervals[size]["SVD"]
+
+    # Returns (k (size) --> Method --> trial iteration errors, k (size) -->
+    # Method --> confidence interval). In adaptive mode trials run in rounds:
+    # after each one, a cell whose interval is still wider than the target
+    # asks for as many trials as that width suggests, at most doubling.
+    def collect_trials(self, sizes: list[int], extrapolated: bool,
+                       pool: concurrent.futures.Executor | None = None) -> tuple[dict, dict]:
+        methods = ["SVD"] if extrapolated else self.methods
+        errors = {size: {method: [] for method in methods} for size in sizes}
+        stats = {size: {method: confidence.RunningStats() for method in methods} for size in sizes}
+        intervals = {size: {method: None for method in methods} for size in sizes}
+        # k (size) --> Method --> number of trials to have after this round
+        wanted = {size: {method: self.repetitions if self.target_width is None else self.min_repetitions
+                         for method in methods} for size in sizes}
+
+        while True:
+            trials: list[Trial] = []
+            trial_methods: list[list[str]] = []
+            for size in sizes:
+                for iteration in range(min(map(len, errors[size].values())), max(wanted[size].values())):
+                    needed = [method for method in methods if len(errors[size][method]) <= iteration < wanted[size][method]]
+                    if needed:
+                        trials.append(Trial(size, iteration, extrapolated))
+                        trial_methods.append(needed)
+            if not trials:
+                break
+            profiling.count("trial rounds")
+
+            for (trial, result) in zip(trials, self.map_cached_trials(trials, pool, trial_methods)):
+                for method in result:
+                    errors[trial.size][method].append(result[method])
+                    stats[trial.size][method].add(result[method])
+            for size in sizes:
+                for method in methods:
+                    intervals[size][method] = self.interval(errors[size][method], stats[size][method], Trial(size, 0, extrapolated))
+                    if self.target_width is not None:
+                        wanted[size][method] = self.next_repetitions(len(errors[size][method]), intervals[size][method])
+        return (errors, intervals)
+
+    # Confidence interval of the mean of one cell's `errors`
+    def interval(self, errors: list[float], stats: confidence.RunningStats, trial: Trial) -> tuple[float, float] | None:
+        if self.interval_method == "bootstrap":
+            return confidence.bootstrap_interval(errors, self.level, trial.seed(self.seed))
+        return stats.interval(self.level)
+
+    # Trials a cell should end the next round with; `count` once it is done
+    def next_repetitions(self, count: int, interval: tuple[float, float] | None) -> int:
+        if count >= self.max_repetitions:
+            return count
+        if interval is None:
+            return count + 1
+        width = interval[1] - interval[0]
+        if width <= self.target_width:
+            return count
+        # The width shrinks with the square root of the number of trials
+        needed = numpy.ceil(count * (width / self.target_width) ** 2)
+        return int(min(self.max_repetitions, max(count + 1, min(2 * count, needed))))
+
+    # Task index --> true label, in store order
+    def true_labels(self) -> numpy.ndarray:
+        return self.parser.store.true_labels
+
+    # One EM step per subsample, using nothing but its own labels: every
+    # worker's weight is 2 * (agreement with that subsample's majority vote) - 1,
+    # and tied tasks agree with nobody. `workers` and `labels` are as in
+    # `evaluate_batch`. Returns weights shaped (trials, len(sizes), workers).
+    def estimated_weights(self, workers: numpy.ndarray, labels: numpy.ndarray, sizes: list[int]) -> numpy.ndarray:
+        num_workers = self.parser.store.num_workers
+        trials = labels.shape[0]
+        weights = numpy.empty((trials, len(sizes), num_workers))
+        # (Trial, worker index) --> flat index, so one bincount covers every trial
+        offsets = numpy.arange(trials)[:, None, None] * num_workers
+        for (column, size) in enumerate(sizes):
+            majority = numpy.sign(labels[..., :size].sum(axis=-1, dtype=numpy.int32))
+            index = (offsets + workers[..., :size]).ravel()
+            agree = (labels[..., :size] == majority[..., None]).ravel()
+            correct = numpy.bincount(index, weights=agree, minlength=trials * num_workers)
+            total = numpy.bincount(index, minlength=trials * num_workers)
+            accuracy = numpy.divide(correct, total, out=numpy.zeros(trials * num_workers), where=total > 0)
+            weights[:, column] = (2 * accuracy - 1).reshape(trials, num_workers)
+        return weights
+
+    # Score a stack of subsamples for several k at once. `labels` (and
+    # `workers`) are (trials, tasks, max k) in random order, so the first k
+    # entries of each task are a uniform k-subsample. Without `weights` this is
+    # majority vote, otherwise a vote weighted by worker index, with one weight
+    # per worker or one per (trial, k, worker) as from `estimated_weights`.
+    # Ties cost 0.5, as in `evaluate`. Returns errors shaped (trials, len(sizes)).
+    def evaluate_batch(self, labels: numpy.ndarray, sizes: list[int],
+                       workers: numpy.ndarray | None = None,
+                       weights: numpy.ndarray | None = None) -> numpy.ndarray:
+        assert max(sizes) <= labels.shape[-1]
+        if weights is None:
+            votes = numpy.cumsum(labels, axis=-1, dtype=numpy.int32)[..., numpy.asarray(sizes) - 1]
+            ties = 0
+        elif weights.ndim == 1:
+            votes = numpy.cumsum(labels * weights[workers], axis=-1)[..., numpy.asarray(sizes) - 1]
+            ties = aggregators.TIE_TOLERANCE
+        else:
+            trials = numpy.arange(labels.shape[0])[:, None, None]
+            votes = numpy.stack([(labels[..., :size] * weights[trials, column, workers[..., :size]]).sum(axis=-1)
+                                 for (column, size) in enumerate(sizes)], axis=-1)
+            ties = aggregators.TIE_TOLERANCE
+
+        truth = self.true_labels()[None, :, None]
+        aggregations = numpy.sign(votes)
+        aggregations[numpy.abs(votes) <= ties] = 0
+        incorrect = numpy.where(aggregations == 0, 0.5, aggregations != truth)
+        return incorrect.mean(axis=1)
+
+    # Batched counterpart of `run_trials` for every k in `sizes` at once. The
+    # subsamples for different k are nested prefixes of one random ordering.
+    # "Weighted Vote" uses `weights` if given, else `estimated_weights`.
+    def run_batched_trials(self, sizes: list[int], trials: int = defaults.REPITITIONS,
+                           methods: tuple[str, ...] = BATCHED_METHODS,
+                           weights: numpy.ndarray | None = None,
+                           rng: numpy.random.Generator | int | None = None) -> None:
+        if rng is None:
+            rng = self.seed
+        (workers, labels) = self.parser.generate_subsample_indices(max(sizes), trials, rng, return_labels=True)
+        for method in methods:
+            assert method in BATCHED_METHODS, f"{method} cannot be batched"
+            if method == "Weighted Vote":
+                errors = self.evaluate_batch(labels, sizes, workers, self.estimated_weights(workers, labels, sizes) if weights is None else weights)
+            else:
+                errors = self.evaluate_batch(labels, sizes)
+
+            if method not in self.errors:
+                self.errors[method] = {}
+                self.average_errors[method] = {}
+            for (column, size) in enumerate(sizes):
+                self.errors[method][size] = errors[:, column].tolist()
+                self.average_errors[method][size] = float(errors[:, column].mean())
+
+    def generate_extrapolated_dataset(self) -> None:
+        random.seed(Trial(0, 0, True).seed(self.seed))
+        with profiling.phase("generate_extrapolated_dataset"):
+            self.extrapolated_dataset = self.parser.generate_extrapolated_dataset()
+
+    # Process pool whose workers memory-map the parsed dataset (and the
+    # extrapolated one, if generated) instead of receiving pickled dicts
+    def make_pool(self, jobs: int, scratch: str) -> concurrent.futures.ProcessPoolExecutor:
+        dataset_dir = os.path.join(scratch, "dataset")
+        self.parser.store.save(dataset_dir)
+        extrapolated_dir = None
+        if self.extrapolated_dataset is not None:
+            extrapolated_dir = os.path.join(scratch, "extrapolated")
+            labelstore.LabelStore.from_dicts(self.extrapolated_dataset, self.answers).save(extrapolated_dir)
+        return concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_pool_worker,
+                                                      initargs=(dataset_dir, extrapolated_dir, self.seed, self.spectral_method,
+                                                                self.warm_start, self.methods, self.repetitions))
+
+    # Run `sizes` on every method and `extrapolated_sizes` on SVD, spreading
+    # the trials over `jobs` processes
+    def run(self, sizes: list[int], extrapolated_sizes: list[int] | None = None, jobs: int = 1) -> None:
+        if extrapolated_sizes is None or "SVD" not in self.methods:
+            extrapolated_sizes = []
+        scratch = tempfile.mkdtemp(prefix="evaluate-") if jobs > 1 else None
+        try:
+            # Generated before the pool starts, so its workers load it instead
+            # of each building their own
+            if jobs > 1 and extrapolated_sizes and self.extrapolated_dataset is None and self.needs_extrapolated_dataset(extrapolated_sizes):
+                self.generate_extrapolated_dataset()
+            pool = self.make_pool(jobs, scratch) if jobs > 1 else None
+            try:
+                for size in sizes:
+                    with profiling.phase(f"k = {size}"):
+                        self.run_trials(size, pool)
+                if extrapolated_sizes:
+                    self.run_extrapolated_trials(extrapolated_sizes, pool)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+        finally:
+            if scratch is not None:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+    # Whether any extrapolated trial of `sizes` is missing from the result cache
+    def needs_extrapolated_dataset(self, sizes: list[int]) -> bool:
+        if self.cache is None:
+            return True
+        # Adaptive runs may need anything up to the budget
+        repetitions = self.repetitions if self.target_width is None else self.max_repetitions
+        cells = [self.cell(Trial(size, iteration, True), "SVD") for size in sizes for iteration in range(repetitions)]
+        return len(self.cache.get_many(cells)) < len(cells)
+
+    def main(self, jobs: int = 1) -> None:
+        self.run(defaults.SIZES, defaults.EXTRAPOLATED_SIZES, jobs)
         print("Individual Trial Errors:")
         print(self.errors)
         print("Average Errors:")
         print(self.average_errors)
+        print("Confidence Intervals:")
+        print(self.confidence_intervals)
 
-        # Perform SVD on extrapolated samples
-        extrapolated_trial_errors: dict[int, list[float]] = {}
-        extrapolated_dataset: dict[str, dict[str, int]] = self.parser.generate_extrapolated_dataset()
-        extrapolated_sizes = [11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 22, 24, 26, 28, 30, 35, 40, 50, 60, 80, 100]
-        for size in extrapolated_sizes:
-            extrapolated_trial_errors[size] = []
-
-            for _ in range(REPITITIONS):
-                subsample = self.parser.generate_extrapolated_subsample(size)
-                good_worker = aggregators.SVDAggregator.find_good_worker(extrapolated_dataset, self.parser.data_by_task, subsample)
-                aggregations = aggregators.SVDAggregator.aggregate(extrapolated_dataset, subsample, good_worker)
-                extrapolated_trial_errors[size].append(self.evaluate(aggregations))
-        
-        average_extrapolated_errors: dict[int, float] = {}
-        for size in extrapolated_trial_errors:
-            total_error = 0
-            for error in extrapolated_trial_errors[size]:
-                total_error += error
-            average_extrapolated_errors[size] = total_error / REPITITIONS
-        
         print("Extraploated Trial Errors:")
-        print(extrapolated_trial_errors)
+        print(self.extrapolated_errors)
         print("Extrapolated SVD Errors:")
-        print(average_extrapolated_errors)
+        print(self.average_extrapolated_errors)
+        print("Extrapolated Confidence Intervals:")
+        print(self.extrapolated_confidence_intervals)
+
+# Evaluator owned by each pool worker process
+pool_evaluator: Evaluator | None = None
+
+def init_pool_worker(dataset_dir: str, extrapolated_dir: str | None, seed: int, spectral_method: str,
+                     warm_start: bool, methods: list[str], repetitions: int) -> None:
+    global pool_evaluator
+    parser = parse.RTEParser()
+    parser.set_store(labelstore.LabelStore.load(dataset_dir))
+    pool_evaluator = Evaluator(parser, seed, spectral_method, warm_start, methods, repetitions)
+    if extrapolated_dir is not None:
+        pool_evaluator.extrapolated_dataset = parse.WorkerView(labelstore.LabelStore.load(extrapolated_dir))
+
+def run_pooled_trial(trial: Trial, methods: list[str] | None = None) -> dict[str, float]:
+    return pool_evaluator.run_trial(trial, methods)
+
+def run_pooled_request(request: tuple[Trial, list[str]]) -> tuple[dict[str, float], dict[str, dict[str, int]]]:
+    return pool_evaluator.run_trial_request(request)
 
 if __name__ == "__main__":
-    e = Evaluator()
-    e.main()
\ No newline at end of file
+    import spectral
+    arguments = argparse.ArgumentParser(description="Evaluate aggregation methods on the RTE dataset.")
+    arguments.add_argument("--jobs", type=int, default=1, help="Number of worker processes to run trials on")
+    arguments.add_argument("--seed", type=int, default=None, help="Base seed for every trial's RNG")
+    arguments.add_argument("--spectral-method", default="auto", choices=spectral.METHODS, help="Solver for the SVD leading vector")
+    arguments.add_argument("--warm-start", action="store_true", help="Start each SVD trial's solver from the whole dataset's leading vector")
+    arguments.add_argument("--cache", metavar="PATH", help="SQLite file of trial results to reuse and extend")
+    arguments.add_argument("--cache-max-mb", type=float, default=None, help="Evict least recently used results beyond this size")
+    arguments.add_argument("--cache-shared", action="store_true", help="Let other processes use the cache at the same time")
+    arguments.add_argument("--target-width", type=float, default=None,
+                           help="Run trials until each confidence interval is at most this wide, instead of a fixed number")
+    arguments.add_argument("--min-repetitions", type=int, default=defaults.MIN_REPETITIONS, help="First round of trials in adaptive mode")
+    arguments.add_argument("--max-repetitions", type=int, default=defaults.MAX_REPETITIONS, help="Trial budget per method and k in adaptive mode")
+    arguments.add_argument("--interval", default="t", choices=confidence.INTERVALS, help="Student t (Welford) or bootstrap intervals")
+    arguments.add_argument("--level", type=float, default=confidence.LEVEL, help="Confidence level of the intervals")
+    arguments.add_argument("--profile", metavar="PATH", help="Write per-phase timings, counters and EM/SVD details here as JSON")
+    arguments.add_argument("--profile-memory", action="store_true", help="Also trace peak allocations per phase (slow)")
+    arguments.add_argument("--cprofile", metavar="PATH", help="Write a cProfile/pstats dump of the whole run here")
+    options = arguments.parse_args()
+    if not 0 < options.level < 1:
+        arguments.error("--level must be between 0 and 1")
+    if options.warm_start and options.spectral_method not in spectral.WARM_METHODS:
+        arguments.error(f"--warm-start needs --spectral-method {', '.join(spectral.WARM_METHODS)}")
+
+    if options.profile is not None or options.profile_memory:
+        profiling.enable(options.profile_memory)
+    if profiling.enabled() and options.jobs > 1:
+        print("Profiling only covers this process; trials run in worker processes are not included.")
+    profiler = cProfile.Profile() if options.cprofile is not None else None
+    if profiler is not None:
+        profiler.enable()
+
+    cache = None
+    if options.cache is not None:
+        import resultcache
+        max_mb = resultcache.DEFAULT_MAX_MB if options.cache_max_mb is None else options.cache_max_mb
+        cache = resultcache.ResultCache(options.cache, max_mb, options.cache_shared)
+    try:
+        e = Evaluator(seed=options.seed, spectral_method=options.spectral_method, warm_start=options.warm_start, cache=cache,
+                      target_width=options.target_width, min_repetitions=options.min_repetitions,
+                      max_repetitions=options.max_repetitions, interval=options.interval, level=options.level)
+        e.main(options.jobs)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(options.cprofile)
+    if profiling.enabled():
+        if options.profile is not None:
+            profiling.active.write_json(options.profile)
+        else:
+            print("Profile:")
+            print(json.dumps(profiling.active.to_json(), indent=2))
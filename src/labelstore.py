@@ -0,0 +1,213 @@
+import array
+import collections.abc
+import dataclasses
+import hashlib
+import json
+import numpy
+import os
+import shutil
+import tempfile
+
+# Compact storage for crowd labels. Worker and task IDs are interned into dense
+# integer indices and every label is one entry of three parallel COO arrays
+# (int32 worker, int32 task, int8 label). CSR views by worker and by task are
+# derived from the COO arrays on first use.
+
+# Bump whenever the on-disk layout written by `LabelStore.save` changes
+CACHE_VERSION = 1
+# Arrays written to `<name>.npy` inside a cache directory
+CACHE_ARRAYS = ("workers", "tasks", "labels", "true_labels")
+
+@dataclasses.dataclass
+class CSRView:
+    # The entries of row i live in indices[indptr[i]:indptr[i + 1]]
+    indptr: numpy.ndarray
+    # Column index of every entry (task index for worker rows and vice versa)
+    indices: numpy.ndarray
+    labels: numpy.ndarray
+
+    def row(self, index: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        start = self.indptr[index]
+        end = self.indptr[index + 1]
+        return (self.indices[start:end], self.labels[start:end])
+
+class LabelStore:
+    def __init__(self,
+                 worker_ids: list[str],
+                 task_ids: list[str],
+                 workers: numpy.ndarray,
+                 tasks: numpy.ndarray,
+                 labels: numpy.ndarray,
+                 true_labels: numpy.ndarray) -> None:
+        # Index --> ID
+        self.worker_ids: list[str] = worker_ids
+        self.task_ids: list[str] = task_ids
+        # ID --> Index
+        self.worker_index: dict[str, int] = {worker_id: index for index, worker_id in enumerate(worker_ids)}
+        self.task_index: dict[str, int] = {task_id: index for index, task_id in enumerate(task_ids)}
+
+        # One entry per label, in the order the labels were read
+        self.workers: numpy.ndarray = numpy.asarray(workers, dtype=numpy.int32)
+        self.tasks: numpy.ndarray = numpy.asarray(tasks, dtype=numpy.int32)
+        self.labels: numpy.ndarray = numpy.asarray(labels, dtype=numpy.int8)
+        # Task index --> True label
+        self.true_labels: numpy.ndarray = numpy.asarray(true_labels, dtype=numpy.int8)
+
+        self._by_worker: CSRView | None = None
+        self._by_task: CSRView | None = None
+
+    @property
+    def num_workers(self) -> int:
+        return len(self.worker_ids)
+
+    @property
+    def num_tasks(self) -> int:
+        return len(self.task_ids)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    # Rows are workers, indices are tasks
+    def by_worker(self) -> CSRView:
+        if self._by_worker is None:
+            self._by_worker = LabelStore.to_csr(self.workers, self.tasks, self.labels, self.num_workers)
+        return self._by_worker
+
+    # Rows are tasks, indices are workers
+    def by_task(self) -> CSRView:
+        if self._by_task is None:
+            self._by_task = LabelStore.to_csr(self.tasks, self.workers, self.labels, self.num_tasks)
+        return self._by_task
+
+    # Build a store from Worker ID --> Task ID --> Label and Task ID --> True Label
+    def from_dicts(data_by_worker: collections.abc.Mapping[str, collections.abc.Mapping[str, int]],
+                   true_labels: collections.abc.Mapping[str, int]) -> "LabelStore":
+        builder = LabelStoreBuilder()
+        for worker_id in data_by_worker:
+            labels = data_by_worker[worker_id]
+            for task_id in labels:
+                builder.add(worker_id, task_id, labels[task_id], true_labels[task_id])
+        return builder.build()
+
+    # Write the store as one .npy file per array plus the ID lists. `source` is
+    # stored alongside so readers can tell whether the cache is stale.
+    def save(self, directory: str, source: dict | None = None) -> None:
+        directory = os.path.abspath(directory)
+        parent = os.path.dirname(directory)
+        os.makedirs(parent, exist_ok=True)
+
+        # Fill a scratch directory first so readers never see a partial cache
+        scratch = tempfile.mkdtemp(dir=parent, prefix=".tmp-" + os.path.basename(directory))
+        try:
+            for name in CACHE_ARRAYS:
+                numpy.save(os.path.join(scratch, name + ".npy"), getattr(self, name))
+            with open(os.path.join(scratch, "ids.json"), "w") as file:
+                json.dump({"worker_ids": self.worker_ids, "task_ids": self.task_ids}, file)
+            with open(os.path.join(scratch, "meta.json"), "w") as file:
+                json.dump({"version": CACHE_VERSION, "source": source}, file)
+
+            # Swap the new cache in, moving any old one out of the way
+            stale = None
+            if os.path.exists(directory):
+                stale = tempfile.mkdtemp(dir=parent, prefix=".old-" + os.path.basename(directory))
+                os.rename(directory, os.path.join(stale, "cache"))
+            try:
+                os.rename(scratch, directory)
+            except OSError:
+                # Another process published a cache first; keep theirs
+                pass
+            if stale is not None:
+                shutil.rmtree(stale, ignore_errors=True)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    # Read a store written by `save`. With `mmap` the arrays are memory-mapped
+    # read-only instead of copied into memory.
+    def load(directory: str, mmap: bool = True) -> "LabelStore":
+        mode = "r" if mmap else None
+        arrays = [numpy.load(os.path.join(directory, name + ".npy"), mmap_mode=mode) for name in CACHE_ARRAYS]
+        with open(os.path.join(directory, "ids.json")) as file:
+            ids = json.load(file)
+        return LabelStore(ids["worker_ids"], ids["task_ids"], *arrays)
+
+    # Returns the metadata of a cache directory, or None if there is no usable cache
+    def read_metadata(directory: str) -> dict | None:
+        try:
+            with open(os.path.join(directory, "meta.json")) as file:
+                metadata = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if metadata.get("version") != CACHE_VERSION:
+            return None
+        return metadata
+
+    def write_metadata(directory: str, source: dict | None) -> None:
+        path = os.path.join(directory, "meta.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump({"version": CACHE_VERSION, "source": source}, file)
+        os.replace(path + ".tmp", path)
+
+    def to_csr(rows: numpy.ndarray, columns: numpy.ndarray, labels: numpy.ndarray, num_rows: int) -> CSRView:
+        # A stable sort keeps each row in the order its labels were read
+        order = numpy.argsort(rows, kind="stable")
+        indptr = numpy.zeros(num_rows + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(rows, minlength=num_rows), out=indptr[1:])
+        return CSRView(indptr, columns[order], labels[order])
+
+# Size, modification time and (optionally) SHA-256 of a source file
+def fingerprint_file(filepath: str, digest: bool = True) -> dict:
+    stat = os.stat(filepath)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if digest:
+        sha = hashlib.sha256()
+        with open(filepath, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        fingerprint["sha256"] = sha.hexdigest()
+    return fingerprint
+
+class LabelStoreBuilder:
+    # `worker_index` pre-assigns worker indices, e.g. to share them across shards
+    def __init__(self, worker_index: dict[str, int] | None = None) -> None:
+        # ID --> Index, in order of first appearance
+        self.worker_index: dict[str, int] = dict(worker_index) if worker_index is not None else {}
+        self.task_index: dict[str, int] = {}
+        self.workers = array.array("i")
+        self.tasks = array.array("i")
+        self.labels = array.array("b")
+        # The first true label seen for a task wins
+        self.true_labels = array.array("b")
+
+    def add(self, worker_id: str, task_id: str, label: int, true_label: int) -> None:
+        worker = self.worker_index.get(worker_id)
+        if worker is None:
+            worker = len(self.worker_index)
+            self.worker_index[worker_id] = worker
+
+        task = self.task_index.get(task_id)
+        if task is None:
+            task = len(self.task_index)
+            self.task_index[task_id] = task
+            self.true_labels.append(true_label)
+
+        self.workers.append(worker)
+        self.tasks.append(task)
+        self.labels.append(label)
+
+    def build(self) -> LabelStore:
+        workers = numpy.array(self.workers, dtype=numpy.int32)
+        tasks = numpy.array(self.tasks, dtype=numpy.int32)
+        labels = numpy.array(self.labels, dtype=numpy.int8)
+        true_labels = numpy.array(self.true_labels, dtype=numpy.int8)
+
+        # A worker labelling the same task twice keeps their last label
+        keys = tasks.astype(numpy.int64) * max(len(self.worker_index), 1) + workers
+        (_, last) = numpy.unique(keys[::-1], return_index=True)
+        if len(last) != len(keys):
+            keep = numpy.sort(len(keys) - 1 - last)
+            workers = workers[keep]
+            tasks = tasks[keep]
+            labels = labels[keep]
+
+        return LabelStore(list(self.worker_index), list(self.task_index),
+                          workers, tasks, labels, true_labels)
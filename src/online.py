@@ -0,0 +1,234 @@
+import abc
+import collections.abc
+import numpy
+
+# Aggregators that keep their estimates up to date as labels keep arriving,
+# instead of recomputing everything from a fixed subsample.
+
+MAX_ITERATIONS = 20
+# Pending labels are merged into the sorted arrays once they outnumber this
+# fraction of the labels already merged
+MERGE_FRACTION = 0.25
+MIN_PENDING = 4096
+
+# (Worker ID, Task ID, Given Label)
+Label = tuple[str, str, int]
+
+# Grow `array` along its first axis to hold at least `size` entries, doubling
+# the capacity so that repeated growth stays amortized O(1)
+def grow(array: numpy.ndarray, size: int, fill: float = 0) -> numpy.ndarray:
+    if size <= len(array):
+        return array
+    grown = numpy.full(max(size, 2 * len(array)), fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+# Labels grouped by task. Most labels live in CSR order; recent ones wait in a
+# small unsorted tail until there are enough of them to merge.
+class TaskLabels:
+    def __init__(self) -> None:
+        self.indptr = numpy.zeros(1, dtype=numpy.int64)
+        self.workers = numpy.zeros(0, dtype=numpy.int32)
+        self.labels = numpy.zeros(0, dtype=numpy.int8)
+        self.pending_tasks: list[numpy.ndarray] = []
+        self.pending_workers: list[numpy.ndarray] = []
+        self.pending_labels: list[numpy.ndarray] = []
+        self.num_pending = 0
+
+    def __len__(self) -> int:
+        return len(self.labels) + self.num_pending
+
+    def append(self, tasks: numpy.ndarray, workers: numpy.ndarray, labels: numpy.ndarray, num_tasks: int) -> None:
+        self.pending_tasks.append(tasks)
+        self.pending_workers.append(workers)
+        self.pending_labels.append(labels)
+        self.num_pending += len(tasks)
+        if self.num_pending > max(MIN_PENDING, MERGE_FRACTION * len(self.labels)):
+            self.merge(num_tasks)
+
+    def merge(self, num_tasks: int) -> None:
+        rows = numpy.repeat(numpy.arange(len(self.indptr) - 1, dtype=numpy.int32), numpy.diff(self.indptr))
+        (tasks, workers, labels) = self.pending()
+        tasks = numpy.concatenate([rows, tasks])
+        workers = numpy.concatenate([self.workers, workers])
+        labels = numpy.concatenate([self.labels, labels])
+
+        order = numpy.argsort(tasks, kind="stable")
+        self.indptr = numpy.zeros(num_tasks + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(tasks, minlength=num_tasks), out=self.indptr[1:])
+        self.workers = workers[order]
+        self.labels = labels[order]
+        self.pending_tasks = []
+        self.pending_workers = []
+        self.pending_labels = []
+        self.num_pending = 0
+
+    def pending(self) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        if self.num_pending == 0:
+            return (numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int8))
+        return (numpy.concatenate(self.pending_tasks),
+                numpy.concatenate(self.pending_workers),
+                numpy.concatenate(self.pending_labels))
+
+    # Every (task, worker, label) entry belonging to one of `tasks`
+    def for_tasks(self, tasks: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        merged = tasks[tasks < len(self.indptr) - 1]
+        starts = self.indptr[merged]
+        counts = self.indptr[merged + 1] - starts
+        # Index of every entry in the merged rows, built without a Python loop
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        entries = numpy.repeat(starts, counts) + offsets
+
+        (pending_tasks, pending_workers, pending_labels) = self.pending()
+        mask = numpy.isin(pending_tasks, tasks)
+        return (numpy.concatenate([numpy.repeat(merged, counts).astype(numpy.int32), pending_tasks[mask]]),
+                numpy.concatenate([self.workers[entries], pending_workers[mask]]),
+                numpy.concatenate([self.labels[entries], pending_labels[mask]]))
+
+class OnlineAggregator(abc.ABC):
+    def __init__(self) -> None:
+        # ID --> Index, in order of first appearance
+        self.worker_index: dict[str, int] = {}
+        self.task_index: dict[str, int] = {}
+        # Index --> ID
+        self.worker_ids: list[str] = []
+        self.task_ids: list[str] = []
+
+    @property
+    def num_workers(self) -> int:
+        return len(self.worker_ids)
+
+    @property
+    def num_tasks(self) -> int:
+        return len(self.task_ids)
+
+    # Each (worker, task) pair is expected to arrive once; a repeated pair
+    # counts as an extra label
+    @abc.abstractmethod
+    def add_labels(self, batch: collections.abc.Iterable[Label]) -> None:
+        pass
+
+    # Task index --> aggregation
+    @abc.abstractmethod
+    def estimates(self) -> numpy.ndarray:
+        pass
+
+    # Returns dictionary of Task ID --> Aggregation
+    def current_estimates(self) -> dict[str, int]:
+        return dict(zip(self.task_ids, self.estimates().tolist()))
+
+    # Map a batch onto task, worker and label arrays, interning unseen IDs
+    def intern(self, batch: collections.abc.Iterable[Label]) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        tasks: list[int] = []
+        workers: list[int] = []
+        labels: list[int] = []
+        for (worker_id, task_id, label) in batch:
+            worker = self.worker_index.get(worker_id)
+            if worker is None:
+                worker = len(self.worker_ids)
+                self.worker_index[worker_id] = worker
+                self.worker_ids.append(worker_id)
+            task = self.task_index.get(task_id)
+            if task is None:
+                task = len(self.task_ids)
+                self.task_index[task_id] = task
+                self.task_ids.append(task_id)
+            tasks.append(task)
+            workers.append(worker)
+            labels.append(label)
+
+        return (numpy.array(tasks, dtype=numpy.int32),
+                numpy.array(workers, dtype=numpy.int32),
+                numpy.array(labels, dtype=numpy.int8))
+
+# Running per-task label sums
+class OnlineMajorityVoteAggregator(OnlineAggregator):
+    def __init__(self) -> None:
+        super().__init__()
+        self.sums = numpy.zeros(0, dtype=numpy.int64)
+
+    def add_labels(self, batch: collections.abc.Iterable[Label]) -> None:
+        (tasks, _, labels) = self.intern(batch)
+        self.sums = grow(self.sums, self.num_tasks)
+        numpy.add.at(self.sums, tasks, labels)
+
+    def estimates(self) -> numpy.ndarray:
+        # Ties stay 0, which evaluation counts as half an error
+        return numpy.sign(self.sums[:self.num_tasks]).astype(numpy.int8)
+
+# EstimationMaximizationAggregator, warm-started from the previous worker weights
+# and task estimates. Each batch only re-estimates the tasks it touched and the
+# workers whose agreement counts changed as a result.
+class OnlineEstimationMaximizationAggregator(OnlineAggregator):
+    def __init__(self, rng: numpy.random.Generator | int | None = None) -> None:
+        super().__init__()
+        self.rng = numpy.random.default_rng(rng)
+        self.labels = TaskLabels()
+        # Task index --> aggregation (0 until the task has been estimated)
+        self.task_estimates = numpy.zeros(0, dtype=numpy.int8)
+        # Worker index --> # Labels agreeing with the current estimate
+        self.worker_correct = numpy.zeros(0, dtype=numpy.int64)
+        # Worker index --> # Labels on tasks that have an estimate
+        self.worker_total = numpy.zeros(0, dtype=numpy.int64)
+        # Worker index --> weight, 1 until a worker has labels
+        self.worker_weights = numpy.ones(0)
+        # EM iterations used by the last batch
+        self.iterations = 0
+
+    def add_labels(self, batch: collections.abc.Iterable[Label]) -> None:
+        (tasks, workers, labels) = self.intern(batch)
+        if len(tasks) == 0:
+            return
+        self.task_estimates = grow(self.task_estimates, self.num_tasks)
+        self.worker_correct = grow(self.worker_correct, self.num_workers)
+        self.worker_total = grow(self.worker_total, self.num_workers)
+        self.worker_weights = grow(self.worker_weights, self.num_workers, 1)
+
+        self.labels.append(tasks, workers, labels, self.num_tasks)
+        numpy.add.at(self.worker_total, workers, self.task_estimates[tasks] != 0)
+        numpy.add.at(self.worker_correct, workers, labels == self.task_estimates[tasks])
+
+        touched_tasks = numpy.unique(tasks)
+        self.update_weights(numpy.unique(workers))
+        self.iterations = 0
+        while self.iterations < MAX_ITERATIONS:
+            self.iterations += 1
+            changed = self.reestimate(touched_tasks)
+            if len(changed) == 0:
+                break
+            (_, changed_workers, _) = self.labels.for_tasks(changed)
+            self.update_weights(numpy.unique(changed_workers))
+
+    # Run weighted majority on `tasks`, keeping agreement counts in sync.
+    # Returns the tasks whose estimate changed.
+    def reestimate(self, tasks: numpy.ndarray) -> numpy.ndarray:
+        (entry_tasks, entry_workers, entry_labels) = self.labels.for_tasks(tasks)
+        # `tasks` is sorted, so this is each entry's position within it
+        positions = numpy.searchsorted(tasks, entry_tasks)
+        votes = numpy.bincount(positions, weights=entry_labels * self.worker_weights[entry_workers], minlength=len(tasks))
+
+        old = self.task_estimates[tasks]
+        new = numpy.sign(votes).astype(numpy.int8)
+        # Ties keep their previous estimate; unestimated ones get a random label
+        ties = new == 0
+        new[ties] = old[ties]
+        unresolved = numpy.flatnonzero(new == 0)
+        new[unresolved] = numpy.where(self.rng.random(len(unresolved)) < 0.5, -1, 1)
+
+        changed = tasks[new != old]
+        if len(changed) == 0:
+            return changed
+        before = self.task_estimates[entry_tasks]
+        self.task_estimates[tasks] = new
+        after = self.task_estimates[entry_tasks]
+        numpy.add.at(self.worker_correct, entry_workers, (entry_labels == after).astype(numpy.int64) - (entry_labels == before))
+        numpy.add.at(self.worker_total, entry_workers, (after != 0).astype(numpy.int64) - (before != 0))
+        return changed
+
+    def update_weights(self, workers: numpy.ndarray) -> None:
+        total = self.worker_total[workers]
+        accuracy = numpy.divide(self.worker_correct[workers], total, out=numpy.ones(len(workers)), where=total > 0)
+        self.worker_weights[workers] = 2 * accuracy - 1
+
+    def estimates(self) -> numpy.ndarray:
+        return self.task_estimates[:self.num_tasks].copy()
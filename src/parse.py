@@ -1,6 +1,14 @@
+import collections.abc
 import dataclasses
+import defaults
+import itertools
+import labelstore
+import numpy
 import random
 
+# Number of rows read from disk at a time when streaming a table
+DEFAULT_CHUNK_SIZE = 65536
+
 # Parse .tsv into python object
 class TableParser:
     def __init__(self):
@@ -8,69 +16,218 @@ class TableParser:
         self.data: list[list] = []
     
     def parse_tsv(self, filepath: str):
+        for chunk in self.iter_tsv(filepath):
+            self.data.extend(chunk)
+
+    # Yield the rows in lists of at most `chunk_size` without keeping them
+    def iter_tsv(self, filepath: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> collections.abc.Iterator[list[list[str]]]:
+        assert chunk_size > 0
         with open(filepath) as file:
             # Read the column names
             self.columns = file.readline().strip().split('\t')
 
-            # Read the values into the table
-            for line in file:
-                values = line.strip().split('\t')
-                self.data.append(values)
+            # Read the values a chunk at a time
+            while True:
+                lines = list(itertools.islice(file, chunk_size))
+                if not lines:
+                    return
+                yield [line.strip().split('\t') for line in lines if not line.isspace()]
 
 @dataclasses.dataclass
 class TaskEntry:
     true_label: int
     labels: dict[str, int]
 
+# Worker ID --> Task ID --> Given Label, read lazily from a LabelStore. A
+# worker's labels become a plain dict the first time they are looked up, so
+# later lookups cost no more than in the dicts the parser used to build.
+class WorkerView(dict):
+    def __init__(self, store: labelstore.LabelStore) -> None:
+        super().__init__()
+        self.store = store
+
+    def __missing__(self, worker_id: str) -> dict[str, int]:
+        (tasks, labels) = self.store.by_worker().row(self.store.worker_index[worker_id])
+        task_ids = self.store.task_ids
+        row = dict(zip([task_ids[task] for task in tasks.tolist()], labels.tolist()))
+        self[worker_id] = row
+        return row
+
+    # Every worker in the store counts, not only those looked up so far
+    def __contains__(self, worker_id: object) -> bool:
+        return worker_id in self.store.worker_index
+
+    def __iter__(self) -> collections.abc.Iterator[str]:
+        return iter(self.store.worker_ids)
+
+    def __len__(self) -> int:
+        return self.store.num_workers
+
+    def get(self, worker_id: str, default=None):
+        return self[worker_id] if worker_id in self else default
+
+    keys = collections.abc.Mapping.keys
+    items = collections.abc.Mapping.items
+    values = collections.abc.Mapping.values
+
+# Task ID --> (True Label, Worker ID --> Given Label), read lazily from a
+# LabelStore the same way as WorkerView
+class TaskView(dict):
+    def __init__(self, store: labelstore.LabelStore) -> None:
+        super().__init__()
+        self.store = store
+
+    def __missing__(self, task_id: str) -> TaskEntry:
+        task = self.store.task_index[task_id]
+        (workers, labels) = self.store.by_task().row(task)
+        worker_ids = self.store.worker_ids
+        entry = TaskEntry(int(self.store.true_labels[task]),
+                          dict(zip([worker_ids[worker] for worker in workers.tolist()], labels.tolist())))
+        self[task_id] = entry
+        return entry
+
+    def __contains__(self, task_id: object) -> bool:
+        return task_id in self.store.task_index
+
+    def __iter__(self) -> collections.abc.Iterator[str]:
+        return iter(self.store.task_ids)
+
+    def __len__(self) -> int:
+        return self.store.num_tasks
+
+    def get(self, task_id: str, default=None):
+        return self[task_id] if task_id in self else default
+
+    keys = collections.abc.Mapping.keys
+    items = collections.abc.Mapping.items
+    values = collections.abc.Mapping.values
+
 class RTEParser(TableParser):
-    def __init__(self):
+    # With `binary` off, labels are kept as the class codes found in the file
+    def __init__(self, binary: bool = True):
         super().__init__()
         
         # We don't need `!amt_annotation_ids`, and convert '0' labels to '-1'
         # Need to be able to access by `!amt_worker_ids` and `orig_id`
         # Renaming columns for convenience
+        self.binary = binary
+
+        # Labels with interned worker and task IDs
+        self.store: labelstore.LabelStore = labelstore.LabelStoreBuilder().build()
+
+        self._data_by_worker: WorkerView | None = None
+        self._data_by_task: TaskView | None = None
+
+    # Worker ID --> Task ID --> Given Label
+    @property
+    def data_by_worker(self) -> WorkerView:
+        if self._data_by_worker is None:
+            self._data_by_worker = WorkerView(self.store)
+        return self._data_by_worker
+
+    # Task ID --> (True Label, Worker ID --> Given Label)
+    @property
+    def data_by_task(self) -> TaskView:
+        if self._data_by_task is None:
+            self._data_by_task = TaskView(self.store)
+        return self._data_by_task
 
-        # Worker ID --> Task ID --> Given Label
-        self.data_by_worker: dict[str, dict[str, int]] = {}
-        # Task ID --> (True Label, Worker ID --> Given Label)
-        self.data_by_task: dict[str, TaskEntry] = {}
+    def set_store(self, store: labelstore.LabelStore) -> None:
+        self.store = store
+        self._data_by_worker = None
+        self._data_by_task = None
 
     # Apply filtering on data specific to Assignment 1
-    def parse(self, filepath: str):
-        super().parse_tsv(filepath)
+    def parse(self, filepath: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        # Rows go straight into the store; `self.data` is never filled
+        builder = labelstore.LabelStoreBuilder()
+        for (worker_id, task_id, given_label, true_label) in self.iter_labels(filepath, chunk_size):
+            builder.add(worker_id, task_id, given_label, true_label)
 
-        worker_id_index = self.columns.index("!amt_worker_ids")
-        task_id_index = self.columns.index("orig_id")
-        given_label_index = self.columns.index("response")
-        true_label_index = self.columns.index("gold")
-        
-        for entry in self.data:
-            worker_id = entry[worker_id_index]
-            task_id = entry[task_id_index]
-            given_label = int(entry[given_label_index])
-            true_label = int(entry[true_label_index])
-
-            # Convert 0's to -1's
-            if given_label == 0:
-                given_label = -1
-            if true_label == 0:
-                true_label = -1
-
-            # Place data into structures
-            if worker_id not in self.data_by_worker:
-                self.data_by_worker[worker_id] = {}
-            self.data_by_worker[worker_id][task_id] = given_label
-
-            if task_id not in self.data_by_task:
-                self.data_by_task[task_id] = TaskEntry(true_label, {})
-            self.data_by_task[task_id].labels[worker_id] = given_label
+        self.set_store(builder.build())
+
+    # Same as `parse`, but reuse a binary cache of the store when it is still
+    # fresh. The cache defaults to `<filepath>.cache` (`<filepath>.raw.cache`
+    # for non-binary labels) and is rebuilt whenever the source file's contents
+    # change, or when it was written with the other `binary` setting. Returns
+    # True if the cache was used.
+    def parse_cached(self, filepath: str, cache_dir: str | None = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> bool:
+        if cache_dir is None:
+            cache_dir = filepath + (".cache" if self.binary else ".raw.cache")
+
+        metadata = labelstore.LabelStore.read_metadata(cache_dir)
+        if metadata is not None and metadata["source"] is not None and metadata["source"].get("binary") == self.binary:
+            cached = metadata["source"]
+            current = labelstore.fingerprint_file(filepath, digest=False)
+            fresh = cached["size"] == current["size"] and cached["mtime_ns"] == current["mtime_ns"]
+
+            # Only hash when the cheap checks disagree, e.g. after a `touch`
+            if not fresh and cached["size"] == current["size"]:
+                current = labelstore.fingerprint_file(filepath)
+                fresh = cached["sha256"] == current["sha256"]
+                if fresh:
+                    current["binary"] = self.binary
+                    labelstore.LabelStore.write_metadata(cache_dir, current)
+
+            if fresh:
+                try:
+                    self.set_store(labelstore.LabelStore.load(cache_dir))
+                    return True
+                except (OSError, ValueError, KeyError):
+                    # Unreadable cache; fall through and rebuild it
+                    pass
+
+        source = labelstore.fingerprint_file(filepath)
+        source["binary"] = self.binary
+        self.parse(filepath, chunk_size)
+        self.store.save(cache_dir, source)
+        return False
+
+    # Yield (Worker ID, Task ID, Given Label, True Label) for every row of the file
+    def iter_labels(self, filepath: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> collections.abc.Iterator[tuple[str, str, int, int]]:
+        for chunk in self.iter_label_chunks(filepath, chunk_size):
+            yield from chunk
+
+    # Same as `iter_labels`, but a list of at most `chunk_size` rows at a time
+    def iter_label_chunks(self, filepath: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> collections.abc.Iterator[list[tuple[str, str, int, int]]]:
+        indices = None
+        for chunk in self.iter_tsv(filepath, chunk_size):
+            # The header has been read once the first chunk arrives
+            if indices is None:
+                indices = (self.columns.index("!amt_worker_ids"),
+                           self.columns.index("orig_id"),
+                           self.columns.index("response"),
+                           self.columns.index("gold"))
+            (worker_id_index, task_id_index, given_label_index, true_label_index) = indices
+
+            if not self.binary:
+                yield [(entry[worker_id_index],
+                        entry[task_id_index],
+                        int(entry[given_label_index]),
+                        int(entry[true_label_index]))
+                       for entry in chunk]
+                continue
+
+            yield [(entry[worker_id_index],
+                    entry[task_id_index],
+                    RTEParser.convert_label(int(entry[given_label_index])),
+                    RTEParser.convert_label(int(entry[true_label_index])))
+                   for entry in chunk]
+
+    # Convert 0's to -1's
+    def convert_label(label: int) -> int:
+        if label == 0:
+            return -1
+        return label
     
     def get_workers_for_task(self, task_id: str) -> list[str]:
-        return list(self.data_by_task[task_id].labels.keys())
+        (workers, _) = self.store.by_task().row(self.store.task_index[task_id])
+        worker_ids = self.store.worker_ids
+        return [worker_ids[worker] for worker in workers.tolist()]
 
     # Dictionary of Task ID --> {Worker ID,...}
     def generate_subsample(self, size: int) -> dict[str, set[str]]:
-        assert(size <= 10)
+        assert(size <= defaults.MAX_SIZE)
         subsample: dict[str, set[str]] = {}
 
         # For each task
@@ -105,15 +262,14 @@ class RTEParser(TableParser):
         extended_data_by_worker: dict[str, dict[str, int]] = {}
         for worker_id in self.data_by_worker:
             extended_data_by_worker[worker_id] = {}
-            remaining_tasks = set(self.data_by_task.keys())
 
             # Copy existing data
             for task_id in self.data_by_worker[worker_id]:
                 extended_data_by_worker[worker_id][task_id] = self.data_by_worker[worker_id][task_id]
-                remaining_tasks.remove(task_id)
-            
-            # Choose correct synthetic tasks
-            remaining_tasks = list(remaining_tasks)
+
+            # Choose correct synthetic tasks. Remaining tasks keep the dataset's
+            # order, so the choices do not depend on the string hash seed.
+            remaining_tasks = [task_id for task_id in self.data_by_task if task_id not in extended_data_by_worker[worker_id]]
             tasks_to_choose = int(len(remaining_tasks) * accuracies[worker_id])
             while tasks_to_choose > 0:
                 choice = random.randint(0, len(remaining_tasks) - 1)
@@ -138,7 +294,7 @@ class RTEParser(TableParser):
         return extended_data_by_worker
     
     def generate_extrapolated_subsample(self, size: int) -> dict[str, set[str]]:
-        subsample: dict[str, set[str]] = self.generate_subsample(10)
+        subsample: dict[str, set[str]] = self.generate_subsample(defaults.MAX_SIZE)
 
         for task_id in self.data_by_task:
             workers = list(self.data_by_worker.keys())
@@ -158,6 +314,63 @@ class RTEParser(TableParser):
         
         return subsample
 
+    # Batched `generate_subsample`: Task index --> `size` distinct worker indices
+    # who labelled that task, shaped (tasks, size), or (trials, tasks, size) when
+    # `trials` is given. With `return_labels` the matching labels are returned too.
+    def generate_subsample_indices(self, size: int,
+                                   trials: int | None = None,
+                                   rng: numpy.random.Generator | int | None = None,
+                                   return_labels: bool = False) -> numpy.ndarray | tuple[numpy.ndarray, numpy.ndarray]:
+        rng = numpy.random.default_rng(rng)
+        by_task = self.store.by_task()
+        counts = numpy.diff(by_task.indptr)
+        assert(self.store.num_tasks == 0 or size <= counts.min())
+
+        # Give every label a random key and sort within each task; the first
+        # `size` entries of each task are then a uniform sample without replacement
+        rows = numpy.repeat(numpy.arange(self.store.num_tasks, dtype=numpy.float64), counts)
+        keys = rng.random((1 if trials is None else trials, len(rows)))
+        order = numpy.argsort(rows + keys, axis=-1)
+        entries = order[:, by_task.indptr[:-1, None] + numpy.arange(size)]
+
+        workers = by_task.indices[entries]
+        labels = by_task.labels[entries]
+        if trials is None:
+            (workers, labels) = (workers[0], labels[0])
+        if return_labels:
+            return (workers, labels)
+        return workers
+
+    # Batched `generate_extrapolated_subsample`: every real label of a task is
+    # kept, topped up with other workers drawn uniformly from the whole pool
+    def generate_extrapolated_subsample_indices(self, size: int,
+                                                trials: int | None = None,
+                                                rng: numpy.random.Generator | int | None = None) -> numpy.ndarray:
+        rng = numpy.random.default_rng(rng)
+        assert(defaults.MAX_SIZE <= size <= self.store.num_workers)
+        base = self.generate_subsample_indices(defaults.MAX_SIZE, 1 if trials is None else trials, rng)
+
+        # One trial's (tasks, workers) keys at a time, so memory does not grow
+        # with `trials`. Chosen workers get a key below every random one so they
+        # always make the cut.
+        workers = numpy.empty((base.shape[0], self.store.num_tasks, size), dtype=numpy.int32)
+        for (trial, chosen) in enumerate(base):
+            keys = rng.random((self.store.num_tasks, self.store.num_workers))
+            numpy.put_along_axis(keys, chosen.astype(numpy.intp), -1.0, axis=-1)
+            workers[trial] = numpy.argpartition(keys, size - 1, axis=-1)[:, :size]
+
+        if trials is None:
+            return workers[0]
+        return workers
+
+    # Convert sampled worker indices for one trial into Task ID --> {Worker ID,...}
+    def indices_to_subsample(self, workers: numpy.ndarray) -> dict[str, set[str]]:
+        worker_ids = self.store.worker_ids
+        subsample: dict[str, set[str]] = {}
+        for (task_id, row) in zip(self.store.task_ids, workers.tolist()):
+            subsample[task_id] = {worker_ids[worker] for worker in row}
+        return subsample
+
 if __name__ == "__main__":
     p = RTEParser()
     p.parse("rte.standardized.tsv")
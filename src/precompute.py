@@ -0,0 +1,119 @@
+import collections
+import collections.abc
+import labelstore
+import numpy
+import parse
+import scipy.sparse
+
+# Per-dataset precomputation shared by every trial on the same dataset: the
+# global worker/task index maps, a dense label table and scratch buffers for
+# the tasks x workers matrix. Datasets are identified by the objects passed in
+# and are assumed not to change once cached.
+
+# Datasets kept at once; the least recently used one is dropped first
+CACHE_SIZE = 4
+# Datasets with at most this many (task, worker) cells keep a dense label table
+DENSE_LIMIT = 1 << 26
+
+class DatasetCache:
+    def __init__(self, data_by_worker: collections.abc.Mapping[str, collections.abc.Mapping[str, int]],
+                 data_by_task: collections.abc.Mapping[str, parse.TaskEntry]) -> None:
+        # Kept so that their ids cannot be reused while this entry is alive
+        self.data_by_worker = data_by_worker
+        self.data_by_task = data_by_task
+
+        if isinstance(data_by_worker, parse.WorkerView):
+            store = data_by_worker.store
+        else:
+            true_labels = {task_id: data_by_task[task_id].true_label for task_id in data_by_task}
+            store = labelstore.LabelStore.from_dicts(data_by_worker, true_labels)
+        self.store = store
+        # ID --> Index
+        self.worker_index = store.worker_index
+        self.task_index = store.task_index
+
+        # Task index --> Worker index --> label (0 if none), when small enough
+        self.dense_labels: numpy.ndarray | None = None
+        if store.num_tasks * store.num_workers <= DENSE_LIMIT:
+            self.dense_labels = numpy.zeros((store.num_tasks, store.num_workers), dtype=numpy.int8)
+            self.dense_labels[store.tasks, store.workers] = store.labels
+
+        # (Rows, labels) --> (data, indices, indptr) buffers reused by `matrix`
+        self.buffers: dict[tuple[int, int], tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]] = {}
+
+    # Flatten a subsample into (task index per row, row per label, worker index
+    # per label), with rows in the subsample's task order and each row's
+    # workers in index order rather than the order of the set
+    def subsample_indices(self, subsample: dict[str, set[str]]) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        worker_index = self.worker_index
+        tasks = numpy.fromiter((self.task_index[task_id] for task_id in subsample), dtype=numpy.int32, count=len(subsample))
+        counts = numpy.fromiter((len(workers) for workers in subsample.values()), dtype=numpy.int64, count=len(subsample))
+        workers = numpy.fromiter((worker_index[worker_id] for workers in subsample.values() for worker_id in workers),
+                                 dtype=numpy.int32, count=int(counts.sum()))
+        rows = numpy.repeat(numpy.arange(len(tasks), dtype=numpy.int32), counts)
+        return (tasks, rows, workers[numpy.lexsort((workers, rows))])
+
+    # Label of every (task, worker) entry
+    def labels(self, tasks: numpy.ndarray, workers: numpy.ndarray) -> numpy.ndarray:
+        if self.dense_labels is not None:
+            return self.dense_labels[tasks, workers]
+        (task_ids, worker_ids) = (self.store.task_ids, self.store.worker_ids)
+        return numpy.fromiter((self.data_by_worker[worker_ids[worker]][task_ids[task]]
+                               for (task, worker) in zip(tasks.tolist(), workers.tolist())),
+                              dtype=numpy.int8, count=len(tasks))
+
+    # Same choice as SVDAggregator.find_good_worker: the first worker, in
+    # dataset order, who is right on more than half of their subsample labels
+    def find_good_worker(self, tasks: numpy.ndarray, rows: numpy.ndarray, workers: numpy.ndarray) -> str | None:
+        num_workers = self.store.num_workers
+        entry_tasks = tasks[rows]
+        correct = self.labels(entry_tasks, workers) == self.store.true_labels[entry_tasks]
+        worker_correct = numpy.bincount(workers, weights=correct, minlength=num_workers)
+        worker_total = numpy.bincount(workers, minlength=num_workers)
+
+        good = numpy.flatnonzero(worker_correct * 2 > worker_total)
+        if len(good) == 0:
+            return None
+        # Worker indices follow the order of `data_by_worker`
+        return self.store.worker_ids[good[0]]
+
+    # Rows x workers matrix of the subsample labels, with every dataset worker
+    # as a column. Its arrays are reused by the next call of the same size, so
+    # the matrix is only valid until then.
+    def matrix(self, rows: numpy.ndarray, workers: numpy.ndarray, labels: numpy.ndarray, num_rows: int) -> scipy.sparse.csr_matrix:
+        key = (num_rows, len(labels))
+        buffers = self.buffers.get(key)
+        if buffers is None:
+            buffers = (numpy.empty(len(labels)), numpy.empty(len(labels), dtype=numpy.int32), numpy.zeros(num_rows + 1, dtype=numpy.int32))
+            self.buffers[key] = buffers
+        (data, indices, indptr) = buffers
+
+        # `subsample_indices` lists labels row by row, so counts give the row pointers
+        numpy.cumsum(numpy.bincount(rows, minlength=num_rows), out=indptr[1:])
+        data[:] = labels
+        indices[:] = workers
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape=(num_rows, self.store.num_workers), copy=False)
+
+    # (Task indices, labels) of everything the worker labelled in the dataset
+    def worker_labels(self, worker_id: str) -> tuple[numpy.ndarray, numpy.ndarray]:
+        return self.store.by_worker().row(self.worker_index[worker_id])
+
+# (id(data_by_worker), id(data_by_task)) --> cache, least recently used first
+caches: collections.OrderedDict[tuple[int, int], DatasetCache] = collections.OrderedDict()
+
+def get(data_by_worker: collections.abc.Mapping[str, collections.abc.Mapping[str, int]],
+        data_by_task: collections.abc.Mapping[str, parse.TaskEntry]) -> DatasetCache:
+    key = (id(data_by_worker), id(data_by_task))
+    cache = caches.get(key)
+    if cache is not None:
+        caches.move_to_end(key)
+        return cache
+
+    cache = DatasetCache(data_by_worker, data_by_task)
+    caches[key] = cache
+    while len(caches) > CACHE_SIZE:
+        caches.popitem(last=False)
+    return cache
+
+def clear() -> None:
+    caches.clear()
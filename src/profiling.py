@@ -0,0 +1,164 @@
+import contextlib
+import dataclasses
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Opt-in instrumentation for the evaluation pipeline. Code wraps each phase in
+# `with profiling.phase(name):` and reports details such as EM iterations or
+# matrix sizes with `profiling.record(name, ...)`. Until `enable` is called
+# (or ENVIRONMENT_VARIABLE is set) those calls only check one global and
+# return, so they can stay in the code permanently.
+
+# "1" turns profiling on; "memory" also traces peak allocations per phase,
+# which slows everything down considerably
+ENVIRONMENT_VARIABLE = "CROWD_PROFILE"
+# Events kept per record name; later ones are only counted
+MAX_EVENTS = 1000
+
+@dataclasses.dataclass
+class PhaseStats:
+    calls: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    # Largest traced allocation peak above the phase's starting point (memory mode only)
+    peak_bytes: int | None = None
+    # Process peak resident set size when the phase last finished
+    peak_rss_mb: float | None = None
+
+class Profiler:
+    def __init__(self, memory: bool = False) -> None:
+        self.memory = memory
+        # Phase name --> stats, nested phases are named "outer/inner"
+        self.phases: dict[str, PhaseStats] = {}
+        # Counter name --> total
+        self.counters: dict[str, float] = {}
+        # Record name --> first MAX_EVENTS events
+        self.events: dict[str, list[dict]] = {}
+        # Record name --> number of events
+        self.event_counts: dict[str, int] = {}
+        # Names of the open phases, innermost last
+        self.stack: list[str] = []
+        # [starting allocation, peak so far] of each open phase, since
+        # tracemalloc only keeps one global peak
+        self.memory_stack: list[list[int]] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        path = "/".join(self.stack + [name])
+        if self.memory:
+            self.start_memory()
+        self.stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stack.pop()
+            stats = self.phases.get(path)
+            if stats is None:
+                stats = self.phases[path] = PhaseStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.peak_rss_mb = peak_rss_mb()
+            if self.memory:
+                peak = self.stop_memory()
+                stats.peak_bytes = peak if stats.peak_bytes is None else max(stats.peak_bytes, peak)
+
+    def start_memory(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        (current, peak) = tracemalloc.get_traced_memory()
+        # Hand the enclosing phase the peak it has reached, then start a fresh one
+        if self.memory_stack:
+            self.memory_stack[-1][1] = max(self.memory_stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        self.memory_stack.append([current, current])
+
+    # Returns the phase's peak above its starting allocation
+    def stop_memory(self) -> int:
+        (_, peak) = tracemalloc.get_traced_memory()
+        (start, running) = self.memory_stack.pop()
+        peak = max(peak, running)
+        if self.memory_stack:
+            self.memory_stack[-1][1] = max(self.memory_stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        return peak - start
+
+    def count(self, name: str, amount: float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name: str, fields: dict) -> None:
+        self.event_counts[name] = self.event_counts.get(name, 0) + 1
+        events = self.events.setdefault(name, [])
+        if len(events) < MAX_EVENTS:
+            events.append(fields)
+
+    def to_json(self) -> dict:
+        return {
+            "memory": self.memory,
+            "phases": {name: dataclasses.asdict(stats) for (name, stats) in self.phases.items()},
+            "counters": self.counters,
+            "events": {name: {"count": self.event_counts[name], "events": events}
+                       for (name, events) in self.events.items()}
+        }
+
+    def write_json(self, filepath: str) -> None:
+        with open(filepath, "w") as file:
+            json.dump(self.to_json(), file, indent=2)
+            file.write("\n")
+
+# The profiler in use, or None while profiling is off
+active: Profiler | None = None
+# Shared no-op context returned by `phase` while profiling is off
+DISABLED_PHASE = contextlib.nullcontext()
+
+def enable(memory: bool = False) -> Profiler:
+    global active
+    active = Profiler(memory)
+    return active
+
+# Returns the profiler that was in use, if any
+def disable() -> Profiler | None:
+    global active
+    profiler = active
+    active = None
+    if profiler is not None and profiler.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profiler
+
+def enabled() -> bool:
+    return active is not None
+
+def phase(name: str):
+    if active is None:
+        return DISABLED_PHASE
+    return active.phase(name)
+
+def count(name: str, amount: float = 1) -> None:
+    if active is not None:
+        active.count(name, amount)
+
+def record(name: str, **fields) -> None:
+    if active is not None:
+        active.record(name, fields)
+
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak / (1 << 20)
+    return peak / (1 << 10)
+
+if os.environ.get(ENVIRONMENT_VARIABLE, "") not in ("", "0"):
+    enable(memory=os.environ[ENVIRONMENT_VARIABLE] == "memory")
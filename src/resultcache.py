@@ -0,0 +1,149 @@
+import dataclasses
+import hashlib
+import json
+import labelstore
+import sqlite3
+import time
+import zlib
+
+# Persistent per-trial results for evaluation sweeps. Each cell is one method
+# on one trial, keyed by everything its result depends on: the dataset's
+# contents, the method and its version, k, whether the subsample was
+# extrapolated, the evaluator's seed and the trial number. Cells live in a
+# SQLite file, so several processes can share one cache.
+
+DEFAULT_MAX_MB = 512
+# Rough per-row overhead added to the stored blob size when enforcing the bound
+ROW_OVERHEAD = 128
+# Seconds a writer waits for another process's lock in concurrent mode
+BUSY_TIMEOUT = 60.0
+
+@dataclasses.dataclass(frozen=True)
+class Cell:
+    dataset: str
+    method: str
+    version: str
+    size: int
+    extrapolated: bool
+    seed: int
+    iteration: int
+
+    def key(self) -> str:
+        return json.dumps(dataclasses.astuple(self))
+
+@dataclasses.dataclass
+class CellResult:
+    error: float
+    # Task ID --> Aggregation, if it was stored
+    aggregations: dict[str, int] | None = None
+
+# SHA-256 over a store's arrays and IDs, so equal data gives equal keys no
+# matter which file or process it came from
+def fingerprint_store(store: labelstore.LabelStore) -> str:
+    digest = hashlib.sha256()
+    for name in labelstore.CACHE_ARRAYS:
+        array = getattr(store, name)
+        digest.update(name.encode())
+        digest.update(str(array.dtype).encode())
+        digest.update(array.tobytes())
+    digest.update(json.dumps([store.worker_ids, store.task_ids]).encode())
+    return digest.hexdigest()
+
+class ResultCache:
+    # `concurrent` switches SQLite to write-ahead logging with a long busy
+    # timeout so parallel sweeps can read and write the same file; otherwise
+    # this process holds an exclusive lock for as long as the cache is open
+    def __init__(self, path: str, max_mb: float = DEFAULT_MAX_MB, concurrent: bool = False) -> None:
+        self.path = path
+        self.max_bytes = int(max_mb * (1 << 20))
+        self.concurrent = concurrent
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT if concurrent else 5.0, isolation_level=None)
+        if concurrent:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        else:
+            self.connection.execute("PRAGMA locking_mode=EXCLUSIVE")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS cells (
+                                       key TEXT PRIMARY KEY,
+                                       error REAL NOT NULL,
+                                       aggregations BLOB,
+                                       size INTEGER NOT NULL,
+                                       last_used REAL NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cells_last_used ON cells (last_used)")
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "ResultCache":
+        return self
+
+    def __exit__(self, *exception) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM cells").fetchone()[0]
+
+    def total_bytes(self) -> int:
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cells").fetchone()[0]
+
+    # Returns the stored result of every cell that is present, marking them used
+    def get_many(self, cells: list[Cell], aggregations: bool = False) -> dict[Cell, CellResult]:
+        results: dict[Cell, CellResult] = {}
+        keys = {cell.key(): cell for cell in cells}
+        columns = "key, error, aggregations" if aggregations else "key, error, NULL"
+        key_list = list(keys)
+        # Stay below SQLite's limit on bound parameters
+        for start in range(0, len(key_list), 500):
+            batch = key_list[start:start + 500]
+            query = f"SELECT {columns} FROM cells WHERE key IN ({', '.join('?' * len(batch))})"
+            for (key, error, blob) in self.connection.execute(query, batch):
+                stored = None if blob is None else json.loads(zlib.decompress(blob))
+                results[keys[key]] = CellResult(error, stored)
+        if results:
+            now = time.time()
+            self.write(lambda: self.connection.executemany("UPDATE cells SET last_used = ? WHERE key = ?",
+                                                           [(now, cell.key()) for cell in results]))
+        return results
+
+    def get(self, cell: Cell, aggregations: bool = False) -> CellResult | None:
+        return self.get_many([cell], aggregations).get(cell)
+
+    # Store results, replacing older ones for the same cells, then evict the
+    # least recently used cells beyond the size bound
+    def put_many(self, results: dict[Cell, CellResult]) -> None:
+        now = time.time()
+        rows = []
+        for (cell, result) in results.items():
+            blob = None if result.aggregations is None else zlib.compress(json.dumps(result.aggregations).encode())
+            rows.append((cell.key(), result.error, blob, ROW_OVERHEAD + (0 if blob is None else len(blob)), now))
+        self.write(lambda: self.connection.executemany(
+            "INSERT OR REPLACE INTO cells (key, error, aggregations, size, last_used) VALUES (?, ?, ?, ?, ?)", rows))
+        self.evict()
+
+    def put(self, cell: Cell, result: CellResult) -> None:
+        self.put_many({cell: result})
+
+    def evict(self) -> None:
+        def delete_oldest() -> None:
+            excess = self.total_bytes() - self.max_bytes
+            if excess <= 0:
+                return
+            freed = 0
+            doomed: list[str] = []
+            for (key, size) in self.connection.execute("SELECT key, size FROM cells ORDER BY last_used, key"):
+                if freed >= excess:
+                    break
+                doomed.append(key)
+                freed += size
+            self.connection.executemany("DELETE FROM cells WHERE key = ?", [(key,) for key in doomed])
+        self.write(delete_oldest)
+
+    # Run `change` in one write transaction. BEGIN IMMEDIATE takes the write
+    # lock up front, so concurrent writers queue up instead of deadlocking.
+    def write(self, change) -> None:
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            change()
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
@@ -0,0 +1,442 @@
+import aggregators
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import json
+import numpy
+import parse
+import precompute
+import time
+import zlib
+
+# Aggregation over HTTP (TCP or a Unix socket) on a dataset that stays parsed
+# in memory. Requests that arrive within `batch_window` of each other form one
+# batch: identical requests are computed once, majority votes are read from a
+# vector computed at startup, all EM requests run as one block-diagonal EM and
+# the batch itself runs on an executor so the event loop keeps accepting
+# connections.
+#
+#   POST /aggregate  {"method": "SVDAggregator", "tasks": ["123", ...]}
+#   GET  /metrics
+#
+# Leaving out "tasks" aggregates every task.
+
+METHODS = ("MajorityVoteAggregator", "EstimationMaximizationAggregator", "SVDAggregator")
+# Seconds the first request of a batch waits for others to join it
+BATCH_WINDOW = 0.005
+MAX_BATCH = 256
+# Latencies kept per method for the percentiles
+LATENCY_WINDOW = 10000
+MAX_BODY = 1 << 24
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+# A request the service cannot answer, reported back as a 400
+class RequestError(ValueError):
+    pass
+
+@dataclasses.dataclass
+class PendingRequest:
+    method: str
+    # Sorted, distinct task indices
+    tasks: numpy.ndarray
+    future: asyncio.Future
+
+# Recent latencies per method and the percentiles over them
+class LatencyTracker:
+    def __init__(self, window: int = LATENCY_WINDOW) -> None:
+        self.window = window
+        # Method --> most recent latencies in seconds
+        self.samples: dict[str, collections.deque] = {}
+        # Method --> requests answered
+        self.counts: dict[str, int] = {}
+
+    def add(self, method: str, seconds: float) -> None:
+        if method not in self.samples:
+            self.samples[method] = collections.deque(maxlen=self.window)
+            self.counts[method] = 0
+        self.samples[method].append(seconds)
+        self.counts[method] += 1
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        summary: dict[str, dict[str, float]] = {}
+        everything = [seconds for samples in self.samples.values() for seconds in samples]
+        for (method, samples) in list(self.samples.items()) + [("all", everything)]:
+            if len(samples) == 0:
+                continue
+            (p50, p99) = numpy.percentile(numpy.fromiter(samples, dtype=numpy.float64), [50, 99])
+            summary[method] = {
+                "count": self.counts[method] if method in self.counts else sum(self.counts.values()),
+                "p50_ms": float(p50) * 1000,
+                "p99_ms": float(p99) * 1000
+            }
+        return summary
+
+class AggregationService:
+    def __init__(self, parser: parse.RTEParser,
+                 batch_window: float = BATCH_WINDOW,
+                 max_batch: int = MAX_BATCH,
+                 executor: concurrent.futures.Executor | None = None,
+                 seed: int | None = None) -> None:
+        self.parser = parser
+        self.store = parser.store
+        self.cache = precompute.get(parser.data_by_worker, parser.data_by_task)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        # Batches run one at a time, so a single thread is enough and keeps
+        # the shared matrix buffers safe
+        self.executor = executor if executor is not None else concurrent.futures.ThreadPoolExecutor(1)
+        # Drawn once if not given, so every request still gets a fixed generator
+        self.seed = seed if seed is not None else int(numpy.random.SeedSequence().entropy)
+
+        # Task index --> majority vote over every label (0 on ties)
+        self.majority = numpy.sign(numpy.bincount(self.store.tasks, weights=self.store.labels,
+                                                  minlength=self.store.num_tasks)).astype(numpy.int8)
+
+        self.latencies = LatencyTracker()
+        # Requests in each of the most recent batches
+        self.batch_sizes: collections.deque = collections.deque(maxlen=LATENCY_WINDOW)
+        self.num_batches = 0
+        self.queue: asyncio.Queue | None = None
+        self.batcher: asyncio.Task | None = None
+        self.server: asyncio.AbstractServer | None = None
+
+    # Listen on `path` (a Unix socket) if given, otherwise on host:port. Port 0
+    # picks a free port; see `address`.
+    async def start(self, host: str = "127.0.0.1", port: int = 0, path: str | None = None) -> None:
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.create_task(self.run_batches())
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.batcher is not None:
+            self.batcher.cancel()
+            try:
+                await self.batcher
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown()
+
+    # Returns Task ID --> Aggregation for `task_ids` (every task if None)
+    async def aggregate(self, method: str, task_ids: list[str] | None = None) -> dict[str, int]:
+        start = time.perf_counter()
+        request = PendingRequest(method, self.resolve_tasks(method, task_ids), asyncio.get_running_loop().create_future())
+        await self.queue.put(request)
+        estimates = await request.future
+        self.latencies.add(method, time.perf_counter() - start)
+        return estimates
+
+    def resolve_tasks(self, method: str, task_ids: list[str] | None) -> numpy.ndarray:
+        if method not in METHODS:
+            raise RequestError(f"Unknown method {method}; expected one of {', '.join(METHODS)}")
+        if task_ids is None:
+            return numpy.arange(self.store.num_tasks, dtype=numpy.int32)
+        if not isinstance(task_ids, list):
+            raise RequestError("tasks must be a list of task IDs")
+        unknown = [task_id for task_id in task_ids if task_id not in self.store.task_index]
+        if unknown:
+            raise RequestError(f"Unknown tasks: {', '.join(map(str, unknown[:10]))}")
+        if len(task_ids) == 0:
+            raise RequestError("tasks must not be empty")
+        return numpy.unique(numpy.fromiter((self.store.task_index[task_id] for task_id in task_ids),
+                                           dtype=numpy.int32, count=len(task_ids)))
+
+    async def run_batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.num_batches += 1
+            self.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.compute_batch, batch)
+            except Exception as error:
+                results = [error] * len(batch)
+            for (request, result) in zip(batch, results):
+                if request.future.done():
+                    continue
+                if isinstance(result, Exception):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+
+    # Returns Task ID --> Aggregation (or the error) for each request, in order
+    def compute_batch(self, batch: list[PendingRequest]) -> list[dict[str, int] | Exception]:
+        # Identical requests share one computation
+        unique: dict[tuple[str, bytes], numpy.ndarray] = {}
+        for request in batch:
+            unique.setdefault((request.method, request.tasks.tobytes()), request.tasks)
+
+        # (Method, tasks) --> Task index --> aggregation, aligned with the tasks
+        estimates: dict[tuple[str, bytes], numpy.ndarray | Exception] = {}
+        em_keys = [key for key in unique if key[0] == "EstimationMaximizationAggregator"]
+        if em_keys:
+            em_estimates = self.stacked_em([unique[key] for key in em_keys])
+            estimates.update(zip(em_keys, em_estimates))
+        for (key, tasks) in unique.items():
+            if key[0] == "MajorityVoteAggregator":
+                estimates[key] = self.majority[tasks]
+            elif key[0] == "SVDAggregator":
+                try:
+                    estimates[key] = self.svd(tasks)
+                except RequestError as error:
+                    estimates[key] = error
+
+        task_ids = self.store.task_ids
+        results: list[dict[str, int] | Exception] = []
+        for request in batch:
+            result = estimates[(request.method, request.tasks.tobytes())]
+            if isinstance(result, Exception):
+                results.append(result)
+            else:
+                results.append(dict(zip([task_ids[task] for task in request.tasks.tolist()], result.tolist())))
+        return results
+
+    # (Row per label, worker index, label) for every label of `tasks`, rows
+    # numbered by position in `tasks`
+    def task_entries(self, tasks: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        by_task = self.store.by_task()
+        starts = by_task.indptr[tasks]
+        counts = by_task.indptr[tasks + 1] - starts
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        entries = numpy.repeat(starts, counts) + offsets
+        rows = numpy.repeat(numpy.arange(len(tasks), dtype=numpy.int32), counts)
+        return (rows, by_task.indices[entries], by_task.labels[entries])
+
+    # Generator for the EM tie-breaks of one request, derived from the service
+    # seed and the requested tasks, so answers do not depend on batching
+    def request_rng(self, tasks: numpy.ndarray) -> numpy.random.Generator:
+        return numpy.random.default_rng([self.seed, zlib.crc32(tasks.tobytes())])
+
+    # EM on several task subsets at once. Each subset gets its own copy of
+    # every worker, so the stacked problem is block diagonal. Every block
+    # converges on its own and is then frozen: later iterations only cover the
+    # blocks still changing, and each block returns what
+    # VectorizedEstimationMaximizationAggregator would with `request_rng`.
+    def stacked_em(self, subsets: list[numpy.ndarray]) -> list[numpy.ndarray]:
+        import scipy.sparse
+        num_workers = self.store.num_workers
+        (all_rows, all_workers, all_labels) = ([], [], [])
+        row_offset = 0
+        for (block, tasks) in enumerate(subsets):
+            (rows, workers, labels) = self.task_entries(tasks)
+            all_rows.append(rows + row_offset)
+            all_workers.append(workers + block * num_workers)
+            all_labels.append(labels)
+            row_offset += len(tasks)
+        (rows, workers, labels) = (numpy.concatenate(all_rows), numpy.concatenate(all_workers), numpy.concatenate(all_labels))
+        # Block --> first row and first label
+        bounds = numpy.cumsum([0] + [len(tasks) for tasks in subsets])
+        label_bounds = numpy.cumsum([0] + [len(block_labels) for block_labels in all_labels])
+        rngs = [self.request_rng(tasks) for tasks in subsets]
+
+        # Rows are numbered block by block, so this matrix's rows are the stacked tasks
+        matrix = scipy.sparse.csr_matrix((labels.astype(numpy.float64), (rows, workers)), shape=(row_offset, len(subsets) * num_workers))
+        worker_weights = numpy.ones(len(subsets) * num_workers)
+        estimate = numpy.zeros(row_offset, dtype=numpy.int8)
+        active = list(range(len(subsets)))
+        (active_labels, active_matrix) = (numpy.arange(len(labels)), matrix)
+
+        iterations = 0
+        while(iterations < aggregators.MAX_ITERATIONS):
+            votes = active_matrix @ worker_weights
+            changed: list[int] = []
+            position = 0
+            for block in active:
+                (start, end) = (bounds[block], bounds[block + 1])
+                block_votes = votes[position:position + end - start]
+                position += end - start
+                block_estimate = numpy.sign(block_votes).astype(numpy.int8)
+                ties = numpy.flatnonzero(numpy.abs(block_votes) <= aggregators.TIE_TOLERANCE)
+                block_estimate[ties] = numpy.where(rngs[block].random(len(ties)) < 0.5, -1, 1)
+                if not numpy.array_equal(block_estimate, estimate[start:end]):
+                    estimate[start:end] = block_estimate
+                    changed.append(block)
+
+            # Converged blocks keep their estimates and drop out of the problem
+            if len(changed) < len(active):
+                active = changed
+                if not active:
+                    break
+                active_rows = numpy.concatenate([numpy.arange(bounds[block], bounds[block + 1]) for block in active])
+                active_labels = numpy.concatenate([numpy.arange(label_bounds[block], label_bounds[block + 1]) for block in active])
+                active_matrix = matrix[active_rows]
+            worker_weights = aggregators.VectorizedEstimationMaximizationAggregator.update_weights(
+                rows[active_labels], workers[active_labels], labels[active_labels], estimate, len(subsets) * num_workers)
+            iterations += 1
+
+        return [estimate[bounds[block]:bounds[block + 1]] for block in range(len(subsets))]
+
+    def svd(self, tasks: numpy.ndarray) -> numpy.ndarray:
+        (rows, workers, _) = self.task_entries(tasks)
+        good_worker = self.cache.find_good_worker(tasks, rows, workers)
+        if good_worker is None:
+            raise RequestError("No worker is right on more than half of these tasks")
+        aggregations = aggregators.SVDAggregator.aggregate_cached(self.cache, tasks, rows, workers, good_worker)
+        return numpy.fromiter(aggregations.values(), dtype=numpy.int8, count=len(tasks))
+
+    def metrics(self) -> dict:
+        sizes = numpy.fromiter(self.batch_sizes, dtype=numpy.float64)
+        return {
+            "latency": self.latencies.summary(),
+            "batches": self.num_batches,
+            "batch_size": {
+                "mean": float(sizes.mean()) if len(sizes) else 0.0,
+                "max": int(sizes.max()) if len(sizes) else 0
+            }
+        }
+
+    # Returns (HTTP status, JSON response)
+    async def route(self, verb: str, target: str, body: bytes) -> tuple[int, dict]:
+        if verb == "GET" and target == "/metrics":
+            return (200, self.metrics())
+        if verb != "POST" or target != "/aggregate":
+            return (404, {"error": f"No route for {verb} {target}"})
+        try:
+            payload = json.loads(body or b"{}")
+            if not isinstance(payload, dict):
+                raise RequestError("Request body must be a JSON object")
+            estimates = await self.aggregate(payload.get("method"), payload.get("tasks"))
+        except (RequestError, json.JSONDecodeError) as error:
+            return (400, {"error": str(error)})
+        return (200, {"method": payload["method"], "estimates": estimates})
+
+    # Minimal HTTP/1.1 with keep-alive: one JSON request body, one JSON response
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                (verb, target, _) = request_line.decode("latin-1").split(" ", 2)
+                headers: dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    (name, value) = line.decode("latin-1").split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    (status, response) = (413, {"error": "Request body too large"})
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    try:
+                        (status, response) = await self.route(verb, target, body)
+                    except Exception as error:
+                        (status, response) = (500, {"error": repr(error)})
+
+                close = length > MAX_BODY or headers.get("connection", "").lower() == "close"
+                data = json.dumps(response).encode()
+                head = f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                if close:
+                    head += "Connection: close\r\n"
+                writer.write(head.encode("latin-1") + b"\r\n" + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+# Client for one service, over TCP or a Unix socket, with one keep-alive connection
+class ServiceClient:
+    def __init__(self, host: str = "127.0.0.1", port: int | None = None, path: str | None = None) -> None:
+        assert port is not None or path is not None, "Need a port or a Unix socket path"
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+
+    async def connect(self) -> None:
+        if self.path is not None:
+            (self.reader, self.writer) = await asyncio.open_unix_connection(self.path)
+        else:
+            (self.reader, self.writer) = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+    # Returns (HTTP status, JSON response)
+    async def request(self, verb: str, target: str, payload: dict | None = None) -> tuple[int, dict]:
+        if self.writer is None:
+            await self.connect()
+        body = b"" if payload is None else json.dumps(payload).encode()
+        self.writer.write(f"{verb} {target} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n"
+                          f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if not line.strip():
+                break
+            (name, value) = line.decode("latin-1").split(":", 1)
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        return (status, json.loads(await self.reader.readexactly(length)))
+
+    # Returns Task ID --> Aggregation
+    async def aggregate(self, method: str, tasks: list[str] | None = None) -> dict[str, int]:
+        payload: dict = {"method": method}
+        if tasks is not None:
+            payload["tasks"] = tasks
+        (status, response) = await self.request("POST", "/aggregate", payload)
+        if status != 200:
+            raise RuntimeError(f"Aggregation failed ({status}): {response['error']}")
+        return response["estimates"]
+
+    async def metrics(self) -> dict:
+        return (await self.request("GET", "/metrics"))[1]
+
+async def serve(options: argparse.Namespace) -> None:
+    parser = parse.RTEParser()
+    parser.parse_cached(options.dataset)
+    service = AggregationService(parser, options.batch_window, options.max_batch, seed=options.seed)
+    await service.start(options.host, options.port, options.unix)
+    print(f"Serving {options.dataset} on {options.unix or service.address()}")
+    try:
+        await service.server.serve_forever()
+    finally:
+        await service.close()
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description="Serve label aggregation over HTTP.")
+    arguments.add_argument("--dataset", default="rte.standardized.tsv")
+    arguments.add_argument("--host", default="127.0.0.1")
+    arguments.add_argument("--port", type=int, default=8518)
+    arguments.add_argument("--unix", metavar="PATH", help="Listen on this Unix socket instead of TCP")
+    arguments.add_argument("--batch-window", type=float, default=BATCH_WINDOW, help="Seconds to wait for requests to batch together")
+    arguments.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    arguments.add_argument("--seed", type=int, default=None, help="Seed for EM tie-breaking")
+    options = arguments.parse_args()
+    try:
+        asyncio.run(serve(options))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,267 @@
+import aggregators
+import collections.abc
+import json
+import labelstore
+import math
+import numpy
+import os
+import parse
+import shutil
+import spectral
+import tempfile
+import zlib
+
+# Out-of-core aggregation. Labels are partitioned by task into shards, each a
+# LabelStore directory on disk, and every aggregator streams over the shards
+# one at a time. Only one shard's labels plus O(tasks) estimates and
+# O(workers) statistics are ever held in memory, so peak memory is set by the
+# shard size chosen when partitioning.
+
+MANIFEST = "manifest.json"
+# Rough in-memory cost of one label while its shard is being aggregated
+BYTES_PER_LABEL = 64
+DEFAULT_MEMORY_LIMIT_MB = 256
+
+def write_manifest(directory: str, shards: list[str], num_tasks: int, num_workers: int) -> None:
+    with open(os.path.join(directory, MANIFEST), "w") as file:
+        json.dump({"shards": shards, "num_tasks": num_tasks, "num_workers": num_workers}, file)
+
+class ShardedDataset:
+    def __init__(self, directory: str) -> None:
+        with open(os.path.join(directory, MANIFEST)) as file:
+            manifest = json.load(file)
+        self.directory = directory
+        self.shard_names: list[str] = manifest["shards"]
+        self.num_tasks: int = manifest["num_tasks"]
+        self.num_workers: int = manifest["num_workers"]
+
+    def __len__(self) -> int:
+        return len(self.shard_names)
+
+    # Memory-map one shard at a time. Every shard indexes workers globally.
+    def shards(self) -> collections.abc.Iterator[labelstore.LabelStore]:
+        for name in self.shard_names:
+            yield labelstore.LabelStore.load(os.path.join(self.directory, name))
+
+    def worker_ids(self) -> list[str]:
+        return next(self.shards()).worker_ids if self.shard_names else []
+
+    # Returns dictionary of Task ID --> Aggregation for per-shard results
+    def to_dict(self, estimates: list[numpy.ndarray]) -> dict[str, int]:
+        result: dict[str, int] = {}
+        for (shard, shard_estimates) in zip(self.shards(), estimates):
+            result.update(zip(shard.task_ids, shard_estimates.tolist()))
+        return result
+
+    # Split an in-memory store into shards of consecutive tasks
+    def from_store(store: labelstore.LabelStore, directory: str, tasks_per_shard: int) -> "ShardedDataset":
+        assert tasks_per_shard > 0
+        os.makedirs(directory, exist_ok=True)
+        by_task = store.by_task()
+        shards: list[str] = []
+        for start in range(0, store.num_tasks, tasks_per_shard):
+            end = min(start + tasks_per_shard, store.num_tasks)
+            (first, last) = (by_task.indptr[start], by_task.indptr[end])
+            tasks = numpy.repeat(numpy.arange(end - start, dtype=numpy.int32), numpy.diff(by_task.indptr[start:end + 1]))
+            shard = labelstore.LabelStore(store.worker_ids, store.task_ids[start:end],
+                                          by_task.indices[first:last], tasks, by_task.labels[first:last],
+                                          store.true_labels[start:end])
+            name = f"shard-{len(shards):05d}"
+            shard.save(os.path.join(directory, name))
+            shards.append(name)
+
+        write_manifest(directory, shards, store.num_tasks, store.num_workers)
+        return ShardedDataset(directory)
+
+    # Partition an RTE-style TSV without ever loading it whole. Rows are routed
+    # to shards by a hash of their task ID. Unless `num_shards` is given, enough
+    # shards are made for one to fit in `memory_limit_mb`.
+    def partition_tsv(filepath: str, directory: str,
+                      num_shards: int | None = None,
+                      memory_limit_mb: float = DEFAULT_MEMORY_LIMIT_MB,
+                      chunk_size: int = parse.DEFAULT_CHUNK_SIZE) -> "ShardedDataset":
+        if num_shards is None:
+            num_shards = ShardedDataset.shards_for_limit(filepath, memory_limit_mb)
+        os.makedirs(directory, exist_ok=True)
+        scratch = tempfile.mkdtemp(dir=directory, prefix=".partition-")
+        try:
+            # Pass 1: spill rows to one text file per shard, interning workers
+            # globally. Rows are buffered per shard and appended a file at a
+            # time, so only one spill file is ever open however many shards.
+            worker_index: dict[str, int] = {}
+            buffers: list[list[str]] = [[] for _ in range(num_shards)]
+            buffered = 0
+            for chunk in parse.RTEParser().iter_label_chunks(filepath, chunk_size):
+                for (worker_id, task_id, given_label, true_label) in chunk:
+                    if worker_id not in worker_index:
+                        worker_index[worker_id] = len(worker_index)
+                    shard = zlib.crc32(task_id.encode()) % num_shards
+                    buffers[shard].append(f"{worker_id}\t{task_id}\t{given_label}\t{true_label}\n")
+                buffered += len(chunk)
+                if buffered >= chunk_size:
+                    ShardedDataset.flush_spills(scratch, buffers)
+                    buffered = 0
+            ShardedDataset.flush_spills(scratch, buffers)
+
+            # Pass 2: turn each spill file into a shard that shares the worker indices
+            shards: list[str] = []
+            num_tasks = 0
+            for shard in range(num_shards):
+                path = os.path.join(scratch, f"{shard}.tsv")
+                if not os.path.exists(path):
+                    continue
+                builder = labelstore.LabelStoreBuilder(worker_index)
+                with open(path) as spill:
+                    for line in spill:
+                        (worker_id, task_id, given_label, true_label) = line.rstrip("\n").split("\t")
+                        builder.add(worker_id, task_id, int(given_label), int(true_label))
+                store = builder.build()
+                if store.num_tasks == 0:
+                    continue
+                name = f"shard-{len(shards):05d}"
+                store.save(os.path.join(directory, name))
+                shards.append(name)
+                num_tasks += store.num_tasks
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        write_manifest(directory, shards, num_tasks, len(worker_index))
+        return ShardedDataset(directory)
+
+    # Append each shard's buffered rows to its spill file and empty the buffers
+    def flush_spills(scratch: str, buffers: list[list[str]]) -> None:
+        for (shard, lines) in enumerate(buffers):
+            if not lines:
+                continue
+            with open(os.path.join(scratch, f"{shard}.tsv"), "a") as spill:
+                spill.writelines(lines)
+            lines.clear()
+
+    # Estimate the label count from the file size and the first lines' length
+    def shards_for_limit(filepath: str, memory_limit_mb: float) -> int:
+        with open(filepath, "rb") as file:
+            file.readline()
+            sample = file.readlines(1 << 16)
+        if not sample:
+            return 1
+        line_length = sum(len(line) for line in sample) / len(sample)
+        labels = os.path.getsize(filepath) / line_length
+        return max(1, math.ceil(labels * BYTES_PER_LABEL / (memory_limit_mb * (1 << 20))))
+
+# The aggregators below return one int8 array of estimates per shard, aligned
+# with that shard's tasks. `ShardedDataset.to_dict` maps them back to task IDs.
+
+class ShardedMajorityVoteAggregator:
+    def aggregate(dataset: ShardedDataset) -> list[numpy.ndarray]:
+        estimates: list[numpy.ndarray] = []
+        for shard in dataset.shards():
+            sums = numpy.bincount(shard.tasks, weights=shard.labels, minlength=shard.num_tasks)
+            # Ties stay 0, which evaluation counts as half an error
+            estimates.append(numpy.sign(sums).astype(numpy.int8))
+        return estimates
+
+# VectorizedEstimationMaximizationAggregator with a per-shard E-step and a
+# global M-step that sums worker agreement counts over all shards
+class ShardedEstimationMaximizationAggregator:
+    def aggregate(dataset: ShardedDataset,
+                  rng: numpy.random.Generator | int | None = None) -> list[numpy.ndarray]:
+        rng = numpy.random.default_rng(rng)
+        worker_weights = numpy.ones(dataset.num_workers)
+        old_estimates: list[numpy.ndarray] | None = None
+
+        iterations = 0
+        while(iterations < aggregators.MAX_ITERATIONS):
+            estimates: list[numpy.ndarray] = []
+            worker_correct = numpy.zeros(dataset.num_workers)
+            worker_total = numpy.zeros(dataset.num_workers)
+            converged = old_estimates is not None
+
+            for (index, shard) in enumerate(dataset.shards()):
+                # E-step for this shard's tasks
+                votes = numpy.bincount(shard.tasks, weights=shard.labels * worker_weights[shard.workers], minlength=shard.num_tasks)
+                estimate = numpy.sign(votes).astype(numpy.int8)
+                ties = numpy.flatnonzero(numpy.abs(votes) <= aggregators.TIE_TOLERANCE)
+                estimate[ties] = numpy.where(rng.random(len(ties)) < 0.5, -1, 1)
+                estimates.append(estimate)
+                if converged and not numpy.array_equal(estimate, old_estimates[index]):
+                    converged = False
+
+                # Partial sums for the M-step
+                worker_correct += numpy.bincount(shard.workers, weights=shard.labels == estimate[shard.tasks], minlength=dataset.num_workers)
+                worker_total += numpy.bincount(shard.workers, minlength=dataset.num_workers)
+
+            if converged:
+                return estimates
+            old_estimates = estimates
+            # M-step over every shard's counts
+            accuracy = numpy.divide(worker_correct, worker_total, out=numpy.zeros(dataset.num_workers), where=worker_total > 0)
+            worker_weights = 2 * accuracy - 1
+            iterations += 1
+
+        return old_estimates
+
+# SVDAggregator by power iteration on M^T M, streaming M one shard at a time.
+# Only the workers-long right singular vector is kept between passes.
+class ShardedSVDAggregator:
+    # Returns the ID of the first worker (by index) who is right more than half
+    # the time, or None if nobody is, like SVDAggregator.find_good_worker
+    def find_good_worker(dataset: ShardedDataset) -> str | None:
+        worker_correct = numpy.zeros(dataset.num_workers)
+        worker_total = numpy.zeros(dataset.num_workers)
+        for shard in dataset.shards():
+            worker_correct += numpy.bincount(shard.workers, weights=shard.labels == shard.true_labels[shard.tasks], minlength=dataset.num_workers)
+            worker_total += numpy.bincount(shard.workers, minlength=dataset.num_workers)
+        good = numpy.flatnonzero(worker_correct * 2 > worker_total)
+        if len(good) == 0:
+            return None
+        return dataset.worker_ids()[good[0]]
+
+    # Without a `good_worker` the leading vector's sign is kept as found
+    def aggregate(dataset: ShardedDataset, good_worker: str | None,
+                  rng: numpy.random.Generator | int | None = None,
+                  tolerance: float = spectral.TOLERANCE,
+                  max_iterations: int = spectral.MAX_ITERATIONS) -> list[numpy.ndarray]:
+        rng = numpy.random.default_rng(rng)
+
+        # Start from M^T v0 for the same random v0 the in-memory power iteration uses
+        start = numpy.random.default_rng(0)
+        vector = numpy.zeros(dataset.num_workers)
+        for shard in dataset.shards():
+            task_vector = start.standard_normal(shard.num_tasks)
+            vector += numpy.bincount(shard.workers, weights=shard.labels * task_vector[shard.tasks], minlength=dataset.num_workers)
+        vector = spectral.normalize(vector)
+
+        norm = 0.0
+        for _ in range(max_iterations):
+            # One pass: M y per shard, then accumulate M^T (M y)
+            next_vector = numpy.zeros(dataset.num_workers)
+            squared_norm = 0.0
+            for shard in dataset.shards():
+                task_vector = numpy.bincount(shard.tasks, weights=shard.labels * vector[shard.workers], minlength=shard.num_tasks)
+                squared_norm += float(numpy.dot(task_vector, task_vector))
+                next_vector += numpy.bincount(shard.workers, weights=shard.labels * task_vector[shard.tasks], minlength=dataset.num_workers)
+            norm = numpy.sqrt(squared_norm)
+            next_vector = spectral.normalize(next_vector)
+            if numpy.linalg.norm(next_vector - vector) < tolerance:
+                vector = next_vector
+                break
+            vector = next_vector
+
+        # Left singular vector M y / |M y| a shard at a time, compared against the good worker
+        good = dataset.worker_ids().index(good_worker) if good_worker is not None else -1
+        estimates: list[numpy.ndarray] = []
+        agreement = 0
+        for shard in dataset.shards():
+            task_vector = numpy.bincount(shard.tasks, weights=shard.labels * vector[shard.workers], minlength=shard.num_tasks)
+            estimate = numpy.sign(task_vector).astype(numpy.int8)
+            ties = numpy.flatnonzero(numpy.abs(task_vector) <= spectral.ZERO_TOLERANCE * norm)
+            estimate[ties] = numpy.where(rng.random(len(ties)) < 0.5, -1, 1)
+            estimates.append(estimate)
+
+            mine = shard.workers == good
+            agreement += int(numpy.dot(shard.labels[mine].astype(numpy.int64), estimate[shard.tasks[mine]]))
+
+        # Return properly signed estimate
+        if agreement < 0:
+            estimates = [-estimate for estimate in estimates]
+        return estimates
@@ -0,0 +1,184 @@
+import dataclasses
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+
+# Leading left singular vector of a (sparse) tasks x workers label matrix M,
+# i.e. the top eigenvector of M M^T, without ever forming M M^T.
+
+# Matrices with at most this many tasks use the dense eigendecomposition
+DENSE_THRESHOLD = 200
+TOLERANCE = 1e-10
+MAX_ITERATIONS = 1000
+# Vector entries this close to 0 carry no sign information
+ZERO_TOLERANCE = 1e-12
+METHODS = ("auto", "dense", "power", "lanczos", "randomized")
+# Extra random directions sketched alongside the leading one by "randomized"
+OVERSAMPLING = 10
+
+@dataclasses.dataclass
+class SpectralResult:
+    # Unit-length leading left singular vector, one entry per task
+    vector: numpy.ndarray
+    # Leading eigenvalue of M M^T (the squared top singular value)
+    value: float
+    iterations: int
+    converged: bool
+    method: str
+
+# `start` is an initial guess at the vector, e.g. the one found for a similar
+# matrix earlier. The dense method has no use for it.
+def leading_vector(matrix: scipy.sparse.spmatrix | numpy.ndarray,
+                   method: str = "auto",
+                   tolerance: float = TOLERANCE,
+                   max_iterations: int = MAX_ITERATIONS,
+                   start: numpy.ndarray | None = None) -> SpectralResult:
+    assert method in METHODS, f"Unknown spectral method {method}"
+    if method == "auto":
+        method = "dense" if matrix.shape[0] <= DENSE_THRESHOLD else "power"
+    # svds needs k = 1 < min(shape)
+    if method == "lanczos" and min(matrix.shape) < 2:
+        method = "dense"
+
+    if method == "dense":
+        return dense_leading_vector(matrix)
+    elif method == "power":
+        return power_iteration(scipy.sparse.csr_matrix(matrix), tolerance, max_iterations, start)
+    elif method == "randomized":
+        return randomized_leading_vector(scipy.sparse.csr_matrix(matrix), tolerance, max_iterations, start)
+    else:
+        return lanczos_leading_vector(scipy.sparse.csr_matrix(matrix), tolerance, max_iterations, start)
+
+# The original approach: eigendecompose the dense tasks x tasks matrix M M^T.
+# `eigh` is used since the matrix is symmetric, which keeps the output real.
+def dense_leading_vector(matrix: scipy.sparse.spmatrix | numpy.ndarray) -> SpectralResult:
+    if scipy.sparse.issparse(matrix):
+        matrix = matrix.toarray()
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    (eigenvalues, eigenvectors) = numpy.linalg.eigh(matrix @ matrix.T)
+    # Eigenvalues come back in ascending order
+    return SpectralResult(eigenvectors[:, -1], float(eigenvalues[-1]), 1, True, "dense")
+
+def power_iteration(matrix: scipy.sparse.csr_matrix,
+                    tolerance: float,
+                    max_iterations: int,
+                    start: numpy.ndarray | None = None) -> SpectralResult:
+    transpose = matrix.T.tocsr()
+    if start is None:
+        # Fixed seed so that repeated runs on the same input agree
+        start = numpy.random.default_rng(0).standard_normal(matrix.shape[0])
+    vector = normalize(start)
+    value = 0.0
+
+    # M M^T is positive semi-definite, so the iterates never flip sign
+    for iteration in range(1, max_iterations + 1):
+        product = matrix @ (transpose @ vector)
+        value = float(numpy.linalg.norm(product))
+        if value == 0:
+            # M is all zeros; any vector is an eigenvector
+            return SpectralResult(vector, 0.0, iteration, True, "power")
+        next_vector = product / value
+        if numpy.linalg.norm(next_vector - vector) < tolerance:
+            return SpectralResult(next_vector, value, iteration, True, "power")
+        vector = next_vector
+
+    return SpectralResult(vector, value, max_iterations, False, "power")
+
+# Truncated Lanczos bidiagonalization through scipy's svds. Iterations are
+# the number of M M^T products it needed.
+def lanczos_leading_vector(matrix: scipy.sparse.csr_matrix,
+                           tolerance: float,
+                           max_iterations: int,
+                           start: numpy.ndarray | None = None) -> SpectralResult:
+    # svds iterates on the smaller of M M^T and M^T M, so it wants a start of that size
+    if start is None:
+        v0 = numpy.random.default_rng(0).standard_normal(min(matrix.shape))
+    elif matrix.shape[0] > matrix.shape[1]:
+        v0 = matrix.T @ start
+    else:
+        v0 = start
+    matrix = matrix.astype(numpy.float64)
+    transpose = matrix.T.tocsr()
+    products = [0]
+
+    def matvec(vector: numpy.ndarray) -> numpy.ndarray:
+        products[0] += 1
+        return matrix @ vector
+
+    operator = scipy.sparse.linalg.LinearOperator(matrix.shape, matvec=matvec, rmatvec=lambda vector: transpose @ vector,
+                                                  dtype=numpy.float64)
+    try:
+        (left, singular_values, _) = scipy.sparse.linalg.svds(operator, k=1, tol=tolerance, maxiter=max_iterations,
+                                                              v0=v0 if numpy.any(v0) else None)
+    except scipy.sparse.linalg.ArpackNoConvergence:
+        return power_iteration(matrix, tolerance, max_iterations, start)
+    return SpectralResult(left[:, 0], float(singular_values[0] ** 2), products[0], True, "lanczos")
+
+# Randomized range finder with subspace iteration (Halko, Martinsson and Tropp):
+# M is multiplied by a block of 1 + OVERSAMPLING vectors at a time, which
+# converges in fewer passes over M than single-vector power iteration.
+def randomized_leading_vector(matrix: scipy.sparse.csr_matrix,
+                              tolerance: float,
+                              max_iterations: int,
+                              start: numpy.ndarray | None = None,
+                              oversampling: int = OVERSAMPLING) -> SpectralResult:
+    (rows, columns) = matrix.shape
+    rank = max(1, min(1 + oversampling, rows, columns))
+    transpose = matrix.T.tocsr()
+    basis = matrix @ numpy.random.default_rng(0).standard_normal((columns, rank))
+    if start is not None:
+        basis[:, 0] = start
+    (basis, _) = numpy.linalg.qr(basis)
+
+    vector = numpy.zeros(rows)
+    value = 0.0
+    for iteration in range(1, max_iterations + 1):
+        (basis, _) = numpy.linalg.qr(matrix @ numpy.linalg.qr(transpose @ basis)[0])
+        # The leading singular pair of the small projection B = Q^T M gives M's
+        (left, singular_values, _) = numpy.linalg.svd((transpose @ basis).T, full_matrices=False)
+        next_vector = basis @ left[:, 0]
+        value = float(singular_values[0] ** 2)
+        if value == 0:
+            # M is all zeros; any vector is an eigenvector
+            return SpectralResult(normalize(next_vector), 0.0, iteration, True, "randomized")
+        # The SVD's sign is arbitrary; line it up with the previous iterate
+        if numpy.dot(next_vector, vector) < 0:
+            next_vector = -next_vector
+        if numpy.linalg.norm(next_vector - vector) < tolerance:
+            return SpectralResult(next_vector, value, iteration, True, "randomized")
+        vector = next_vector
+
+    return SpectralResult(vector, value, max_iterations, False, "randomized")
+
+# Methods that converge faster from a good `start`. "dense" ignores it, and
+# ARPACK only takes it as the first Lanczos vector and still builds a full
+# Krylov basis, so "lanczos" gains nothing from it.
+WARM_METHODS = ("auto", "power", "randomized")
+
+# Solves a sequence of similar matrices, such as repeated trials over the same
+# tasks, starting each one from the previous leading vector
+class WarmStart:
+    def __init__(self, method: str = "power",
+                 tolerance: float = TOLERANCE,
+                 max_iterations: int = MAX_ITERATIONS) -> None:
+        assert method in WARM_METHODS, f"Spectral method {method} cannot be warm-started"
+        self.method = method
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        # Leading vector of the last matrix solved
+        self.vector: numpy.ndarray | None = None
+        # Iterations each solve took, in order
+        self.iterations: list[int] = []
+
+    def solve(self, matrix: scipy.sparse.spmatrix | numpy.ndarray) -> SpectralResult:
+        start = self.vector if self.vector is not None and len(self.vector) == matrix.shape[0] else None
+        result = leading_vector(matrix, self.method, self.tolerance, self.max_iterations, start)
+        self.vector = result.vector
+        self.iterations.append(result.iterations)
+        return result
+
+def normalize(vector: numpy.ndarray) -> numpy.ndarray:
+    norm = numpy.linalg.norm(vector)
+    if norm == 0:
+        return numpy.full(len(vector), 1 / numpy.sqrt(max(len(vector), 1)))
+    return vector / norm
@@ -0,0 +1,148 @@
+import collections.abc
+import dataclasses
+import labelstore
+import numpy
+import os
+import shards as shards_module
+
+# Vectorized generator of synthetic crowd labels at production scale. Tasks are
+# produced a block at a time and written straight into a LabelStore, sharded
+# LabelStore directories or an RTE-style TSV, so no per-label Python objects
+# are ever built.
+
+MODELS = ("one-coin", "two-coin")
+DEFAULT_BLOCK_SIZE = 65536
+# Workers x tasks-in-block random keys drawn at once when assigning workers
+ASSIGNMENT_KEYS = 1 << 22
+
+# One block of consecutive tasks and their labels
+@dataclasses.dataclass
+class SyntheticBlock:
+    # Index of the block's first task
+    task_offset: int
+    # Block task index --> true label
+    true_labels: numpy.ndarray
+    # One entry per label; tasks are block indices, workers are global
+    tasks: numpy.ndarray
+    workers: numpy.ndarray
+    labels: numpy.ndarray
+
+class CrowdSimulator:
+    def __init__(self, tasks: int, workers: int, redundancy: int,
+                 model: str = "one-coin",
+                 accuracy: tuple[float, float] = (7.0, 3.0),
+                 class_balance: float = 0.5,
+                 seed: int | None = None) -> None:
+        assert model in MODELS, f"Unknown worker model {model}"
+        assert 0 < redundancy <= workers, "Redundancy must be between 1 and the number of workers"
+        self.num_tasks = tasks
+        self.num_workers = workers
+        self.redundancy = redundancy
+        self.model = model
+        # Beta(alpha, beta) that worker accuracies are drawn from
+        self.accuracy = accuracy
+        # P(true label = 1)
+        self.class_balance = class_balance
+        # Worker parameters and every block get their own stream derived from this
+        self.entropy = numpy.random.SeedSequence(seed).entropy
+
+        rng = numpy.random.default_rng(numpy.random.SeedSequence(self.entropy, spawn_key=(0,)))
+        # Worker index --> P(label = 1 | truth = 1)
+        self.sensitivity: numpy.ndarray = rng.beta(accuracy[0], accuracy[1], workers)
+        # Worker index --> P(label = -1 | truth = -1); one coin means both are the same
+        if model == "one-coin":
+            self.specificity: numpy.ndarray = self.sensitivity
+        else:
+            self.specificity = rng.beta(accuracy[0], accuracy[1], workers)
+
+    # Worker index --> expected accuracy under the class balance
+    def worker_accuracies(self) -> numpy.ndarray:
+        return self.class_balance * self.sensitivity + (1 - self.class_balance) * self.specificity
+
+    def worker_ids(self) -> list[str]:
+        return [f"W{worker}" for worker in range(self.num_workers)]
+
+    def task_ids(self, start: int, end: int) -> list[str]:
+        return [str(task) for task in range(start, end)]
+
+    # Same seed and block size always give the same labels
+    def blocks(self, block_size: int = DEFAULT_BLOCK_SIZE) -> collections.abc.Iterator[SyntheticBlock]:
+        assert block_size > 0
+        for start in range(0, self.num_tasks, block_size):
+            rng = numpy.random.default_rng(numpy.random.SeedSequence(self.entropy, spawn_key=(1, start // block_size)))
+            count = min(block_size, self.num_tasks - start)
+            true_labels = numpy.where(rng.random(count) < self.class_balance, 1, -1).astype(numpy.int8)
+
+            workers = self.assign(rng, count)
+            tasks = numpy.repeat(numpy.arange(count, dtype=numpy.int32), self.redundancy)
+            truth = true_labels[tasks]
+            # Each worker is right with probability given by their coin for this class
+            correct_probability = numpy.where(truth == 1, self.sensitivity[workers], self.specificity[workers])
+            labels = numpy.where(rng.random(len(workers)) < correct_probability, truth, -truth).astype(numpy.int8)
+
+            yield SyntheticBlock(start, true_labels, tasks, workers, labels)
+
+    # `redundancy` distinct workers for each of `count` tasks, flattened task by task
+    def assign(self, rng: numpy.random.Generator, count: int) -> numpy.ndarray:
+        if self.redundancy * self.redundancy < self.num_workers:
+            return CrowdSimulator.assign_floyd(rng, count, self.num_workers, self.redundancy).ravel()
+
+        # Dense redundancy: the smallest `redundancy` of one random key per worker
+        chosen: list[numpy.ndarray] = []
+        rows = max(1, ASSIGNMENT_KEYS // self.num_workers)
+        for start in range(0, count, rows):
+            keys = rng.random((min(rows, count - start), self.num_workers))
+            chosen.append(numpy.argpartition(keys, self.redundancy - 1, axis=1)[:, :self.redundancy])
+        if not chosen:
+            return numpy.zeros(0, dtype=numpy.int32)
+        return numpy.concatenate(chosen).astype(numpy.int32).ravel()
+
+    # Floyd's algorithm run for every task at once: O(count * size^2) instead of
+    # O(count * population)
+    def assign_floyd(rng: numpy.random.Generator, count: int, population: int, size: int) -> numpy.ndarray:
+        chosen = numpy.zeros((count, size), dtype=numpy.int32)
+        for (column, limit) in enumerate(range(population - size, population)):
+            candidates = rng.integers(0, limit + 1, count, dtype=numpy.int32)
+            taken = (chosen[:, :column] == candidates[:, None]).any(axis=1)
+            chosen[:, column] = numpy.where(taken, limit, candidates)
+        return chosen
+
+    def to_store(self, block_size: int = DEFAULT_BLOCK_SIZE) -> labelstore.LabelStore:
+        blocks = list(self.blocks(block_size))
+        if not blocks:
+            empty = numpy.zeros(0, dtype=numpy.int32)
+            return labelstore.LabelStore(self.worker_ids(), [], empty, empty, empty, empty)
+        return labelstore.LabelStore(self.worker_ids(), self.task_ids(0, self.num_tasks),
+                                     numpy.concatenate([block.workers for block in blocks]),
+                                     numpy.concatenate([block.tasks + block.task_offset for block in blocks]),
+                                     numpy.concatenate([block.labels for block in blocks]),
+                                     numpy.concatenate([block.true_labels for block in blocks]))
+
+    # Write one LabelStore directory per `tasks_per_shard` tasks plus a
+    # manifest.json listing them. Every shard shares the global worker IDs.
+    # Returns the shard directories.
+    def write_shards(self, directory: str, tasks_per_shard: int = DEFAULT_BLOCK_SIZE) -> list[str]:
+        os.makedirs(directory, exist_ok=True)
+        worker_ids = self.worker_ids()
+        shards: list[str] = []
+        for block in self.blocks(tasks_per_shard):
+            name = f"shard-{len(shards):05d}"
+            store = labelstore.LabelStore(worker_ids, self.task_ids(block.task_offset, block.task_offset + len(block.true_labels)),
+                                          block.workers, block.tasks, block.labels, block.true_labels)
+            store.save(os.path.join(directory, name))
+            shards.append(name)
+
+        shards_module.write_manifest(directory, shards, self.num_tasks, self.num_workers)
+        return [os.path.join(directory, name) for name in shards]
+
+    # RTE-style TSV (labels written as 0/1) that RTEParser can read
+    def write_tsv(self, filepath: str, block_size: int = DEFAULT_BLOCK_SIZE) -> None:
+        index = 0
+        with open(filepath, "w") as file:
+            file.write("!amt_annotation_ids\t!amt_worker_ids\torig_id\tresponse\tgold\n")
+            for block in self.blocks(block_size):
+                responses = (block.labels > 0).astype(numpy.int8).tolist()
+                gold = (block.true_labels > 0).astype(numpy.int8).tolist()
+                for (task, worker, response) in zip(block.tasks.tolist(), block.workers.tolist(), responses):
+                    file.write(f"{index}\tW{worker}\t{block.task_offset + task}\t{response}\t{gold[task]}\n")
+                    index += 1
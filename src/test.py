@@ -1,8 +1,41 @@
 import parse
+import active
 import aggregators
+import asyncio
+import benchmark
+import cli
+import confidence
 import evaluate
+import json
+import labelstore
+import multiprocessing
+import numpy
+import online
+import os
+import precompute
+import profiling
+import random
+import resultcache
+import service
+import shards
+import shutil
+import spectral
+import subprocess
+import sys
+import synthetic
+import tempfile
 import unittest
 
+# NumPy generator that makes the same uniform draws as `random` will from its
+# current state: both use MT19937 and build doubles from two 32-bit outputs the
+# same way, so tie-breaks match between the dictionary and array aggregators
+def mirror_random() -> numpy.random.Generator:
+    (_, internal, _) = random.getstate()
+    bit_generator = numpy.random.MT19937()
+    bit_generator.state = {"bit_generator": "MT19937",
+                           "state": {"key": numpy.array(internal[:-1], dtype=numpy.uint32), "pos": internal[-1]}}
+    return numpy.random.Generator(bit_generator)
+
 class Tester(unittest.TestCase):
     # Sanity check that we parsed correctly. We expect 10 labels per task, 800 tasks
     def test_parse(self):
@@ -17,9 +50,724 @@ class Tester(unittest.TestCase):
         self.assertTrue(num_tasks == 800,
                         f"Had {num_tasks} tasks; expected 800.")
 
-    def test_extrapolation(self):
+    # The compact store should hold the same labels as the dictionary views
+    def test_label_store(self):
+        p = parse.RTEParser()
+        p.parse("rte.standardized.tsv")
+        store = p.store
+
+        self.assertTrue(len(store) == 8000, f"Had {len(store)} labels; expected 8000.")
+        self.assertTrue(store.labels.dtype == numpy.int8)
+        self.assertTrue(store.workers.dtype == numpy.int32 and store.tasks.dtype == numpy.int32)
+
+        by_task = store.by_task()
+        for task_id in p.data_by_task:
+            (workers, labels) = by_task.row(store.task_index[task_id])
+            entry = p.data_by_task[task_id]
+            self.assertTrue(entry.true_label == store.true_labels[store.task_index[task_id]])
+            for worker, label in zip(workers.tolist(), labels.tolist()):
+                worker_id = store.worker_ids[worker]
+                self.assertTrue(entry.labels[worker_id] == label)
+                self.assertTrue(p.data_by_worker[worker_id][task_id] == label)
+
+        total = 0
+        for worker_id in p.data_by_worker:
+            total += len(p.data_by_worker[worker_id])
+        self.assertTrue(total == 8000)
+
+        # Rows are handed out as plain dicts, and unread ones still count as keys
+        fresh = parse.WorkerView(store)
+        self.assertTrue(len(fresh) == len(fresh.keys()) == store.num_workers and store.worker_ids[-1] in fresh)
+        self.assertTrue(type(fresh[store.worker_ids[0]]) is dict and fresh.get("no such worker") is None)
+
+    # Streaming in small chunks should give the same store and keep no table
+    def test_streaming_parse(self):
+        p = parse.RTEParser()
+        p.parse("rte.standardized.tsv")
+        streamed = parse.RTEParser()
+        streamed.parse("rte.standardized.tsv", chunk_size=7)
+
+        self.assertTrue(len(streamed.data) == 0)
+        self.assertTrue(streamed.store.worker_ids == p.store.worker_ids)
+        self.assertTrue(streamed.store.task_ids == p.store.task_ids)
+        self.assertTrue(numpy.array_equal(streamed.store.labels, p.store.labels))
+
+        chunks = list(parse.RTEParser().iter_label_chunks("rte.standardized.tsv", chunk_size=3000))
+        self.assertTrue([len(chunk) for chunk in chunks] == [3000, 3000, 2000])
+
+    # The binary cache should be reused until the source file's contents change
+    def test_parse_cached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "rte.tsv")
+            shutil.copy("rte.standardized.tsv", source)
+
+            p = parse.RTEParser()
+            self.assertFalse(p.parse_cached(source))
+            cached = parse.RTEParser()
+            self.assertTrue(cached.parse_cached(source))
+            self.assertTrue(isinstance(cached.store.labels.base, numpy.memmap))
+            self.assertTrue(cached.store.task_ids == p.store.task_ids)
+            self.assertTrue(numpy.array_equal(cached.store.labels, p.store.labels))
+            self.assertTrue(cached.data_by_task["266"].labels == p.data_by_task["266"].labels)
+
+            # Touching the file alone should not invalidate the cache
+            os.utime(source, ns=(0, 0))
+            self.assertTrue(parse.RTEParser().parse_cached(source))
+
+            # A cache directory shared by both label modes is only reused by the mode that wrote it
+            shared = os.path.join(directory, "shared.cache")
+            self.assertFalse(parse.RTEParser().parse_cached(source, shared))
+            raw = parse.RTEParser(binary=False)
+            self.assertFalse(raw.parse_cached(source, shared))
+            self.assertTrue(set(raw.store.labels.tolist()) == {0, 1})
+            self.assertTrue(parse.RTEParser(binary=False).parse_cached(source, shared))
+
+            with open(source, "a") as file:
+                file.write("extra\tAEX5NCH03LWSG\tnew_task\t0\t1\n")
+            stale = parse.RTEParser()
+            self.assertFalse(stale.parse_cached(source))
+            self.assertTrue(len(stale.store) == 8001)
+            self.assertTrue(stale.data_by_worker["AEX5NCH03LWSG"]["new_task"] == -1)
+
+    # Given the same tie-breaking draws, the vectorized EM should match the dictionary version exactly
+    def test_vectorized_em_parity(self):
+        p = parse.RTEParser()
+        p.parse_cached("rte.standardized.tsv")
+
+        for size in range(1, 11):
+            random.seed(size)
+            subsample = p.generate_subsample(size)
+            rng = mirror_random()
+            expected = aggregators.EstimationMaximizationAggregator.aggregate(p.data_by_worker, subsample)
+            actual = aggregators.VectorizedEstimationMaximizationAggregator.aggregate(p.data_by_worker, subsample, rng)
+            self.assertTrue(actual == expected, f"Vectorized EM disagreed with k = {size}")
+
+        # Ties are broken by the seeded generator, so runs are reproducible
+        subsample = p.generate_subsample(10)
+        first = aggregators.VectorizedEstimationMaximizationAggregator.aggregate(p.data_by_worker, subsample, 42)
+        second = aggregators.VectorizedEstimationMaximizationAggregator.aggregate(p.data_by_worker, subsample, 42)
+        self.assertTrue(first == second)
+
+    # The sparse solvers should find the same top eigenvector as the dense path
+    def test_spectral_engine(self):
+        p = parse.RTEParser()
+        p.parse_cached("rte.standardized.tsv")
+        random.seed(0)
+        subsample = p.generate_subsample(10)
+        good = aggregators.SVDAggregator.find_good_worker(p.data_by_worker, p.data_by_task, subsample)
+
+        (_, _, matrix) = aggregators.SVDAggregator.convert_to_sparse_matrix(p.data_by_worker, subsample)
+        self.assertTrue(matrix.shape == (800, 164) and matrix.nnz == 8000)
+        dense = spectral.leading_vector(matrix, "dense")
+        for method in ["power", "lanczos", "randomized"]:
+            result = spectral.leading_vector(matrix, method)
+            self.assertTrue(result.converged)
+            self.assertTrue(abs(result.value - dense.value) < 1e-6 * dense.value)
+            self.assertTrue(abs(abs(numpy.dot(result.vector, dense.vector)) - 1) < 1e-6)
+
+        expected = aggregators.SVDAggregator.aggregate(p.data_by_worker, subsample, good, "dense")
+        for method in ["auto", "power", "lanczos", "randomized"]:
+            answer = aggregators.SVDAggregator.aggregate(p.data_by_worker, subsample, good, method)
+            self.assertTrue(answer == expected, f"{method} disagreed with the dense path")
+
+        # Warm starts from the previous trial's vector converge to the same
+        # answers in fewer iterations, and signs still follow the good worker
+        subsamples = [subsample]
+        for seed in range(1, 4):
+            random.seed(seed)
+            subsamples.append(p.generate_subsample(10))
+        for method in ["power", "randomized"]:
+            solver = spectral.WarmStart(method)
+            cold: list[int] = []
+            for trial in subsamples:
+                good = aggregators.SVDAggregator.find_good_worker(p.data_by_worker, p.data_by_task, trial)
+                expected = aggregators.SVDAggregator.aggregate(p.data_by_worker, trial, good, "dense")
+                (_, _, matrix) = aggregators.SVDAggregator.convert_to_sparse_matrix(p.data_by_worker, trial)
+                cold.append(spectral.leading_vector(matrix, method).iterations)
+                answer = aggregators.SVDAggregator.aggregate(p.data_by_worker, trial, good, solver=solver)
+                self.assertTrue(answer == expected, f"warm {method} disagreed with the dense path")
+            self.assertTrue(solver.iterations[0] == cold[0] and sum(solver.iterations[1:]) < sum(cold[1:]))
+
+        # The evaluator starts every SVD trial from its whole dataset's leading
+        # vector instead, so warm results do not depend on the order trials run in
+        trials = [evaluate.Trial(3, 0), evaluate.Trial(5, 1), evaluate.Trial(12, 0, True), evaluate.Trial(20, 1, True)]
+        results = []
+        for (warm_start, order) in [(True, 1), (True, -1), (False, 1)]:
+            e = evaluate.Evaluator(seed=3, methods=["SVD"], warm_start=warm_start)
+            e.generate_extrapolated_dataset()
+            results.append(e.map_trials(trials[::order])[::order])
+        self.assertTrue(results[0] == results[1] == results[2])
+
+    # Seeded trials should not depend on how many processes run them
+    def test_parallel_trials(self):
+        serial = evaluate.Evaluator(seed=7)
+        serial.generate_extrapolated_dataset()
+        serial.run_trials(3)
+        trials = [evaluate.Trial(size, 0, True) for size in [11, 20]]
+        serial_extrapolated = serial.map_trials(trials)
+
+        parallel = evaluate.Evaluator(seed=7)
+        parallel.generate_extrapolated_dataset()
+        with tempfile.TemporaryDirectory() as scratch:
+            with parallel.make_pool(2, scratch) as pool:
+                parallel.run_trials(3, pool)
+                parallel_extrapolated = parallel.map_trials(trials, pool)
+
+        self.assertTrue(serial.errors == parallel.errors)
+        self.assertTrue(serial.average_errors == parallel.average_errors)
+        self.assertTrue(serial_extrapolated == parallel_extrapolated)
+
+        # Nor on the string hash seed, so workers need not be forked
+        script = ("import sys; sys.path.insert(0, 'src'); import evaluate; "
+                  "e = evaluate.Evaluator(seed=7); e.generate_extrapolated_dataset(); "
+                  "print(e.map_trials([evaluate.Trial(3, 0), evaluate.Trial(11, 0, True), evaluate.Trial(20, 0, True)]))")
+        for hash_seed in ["1", "2"]:
+            environment = dict(os.environ, PYTHONHASHSEED=hash_seed)
+            output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True, env=environment).stdout
+            self.assertTrue(output.strip() == str([serial.map_trials([evaluate.Trial(3, 0)])[0]] + serial_extrapolated))
+
+        # Extrapolated trials with --jobs 2, and on a pool started before the
+        # extrapolated dataset existed, whose workers then build it themselves
+        expected = evaluate.Evaluator(seed=7, methods=["SVD"], repetitions=2)
+        expected.run([], [11, 20])
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            cli.main(["--methods", "svd", "--sizes", "1", "--extrapolated-sizes", "11", "20", "--repetitions", "2",
+                      "--seed", "7", "--jobs", "2", "--format", "json", "--output", output])
+            with open(output) as file:
+                report = json.load(file)
+            self.assertTrue(report["extrapolated_errors"]["SVD"] == {str(size): expected.extrapolated_errors[size] for size in [11, 20]})
+
+            late = evaluate.Evaluator(expected.parser, seed=7, methods=["SVD"], repetitions=2)
+            with late.make_pool(2, directory) as pool:
+                late.run_extrapolated_trials([11, 20], pool)
+            self.assertTrue(late.extrapolated_errors == expected.extrapolated_errors)
+
+    # Batched samples should be distinct workers who labelled the task, reproducible by seed
+    def test_batched_subsample(self):
+        p = parse.RTEParser()
+        p.parse_cached("rte.standardized.tsv")
+
+        (workers, labels) = p.generate_subsample_indices(4, trials=3, rng=5, return_labels=True)
+        self.assertTrue(workers.shape == (3, 800, 4) and labels.shape == (3, 800, 4))
+        self.assertTrue(numpy.array_equal(workers, p.generate_subsample_indices(4, trials=3, rng=5)))
+        for trial in range(3):
+            subsample = p.indices_to_subsample(workers[trial])
+            for (task, task_id) in enumerate(subsample):
+                self.assertTrue(len(subsample[task_id]) == 4)
+                for (worker, label) in zip(workers[trial][task].tolist(), labels[trial][task].tolist()):
+                    self.assertTrue(p.data_by_worker[p.store.worker_ids[worker]][task_id] == label)
+
+        extrapolated = p.generate_extrapolated_subsample_indices(15, rng=5)
+        self.assertTrue(extrapolated.shape == (800, 15))
+        subsample = p.indices_to_subsample(extrapolated)
+        for task_id in subsample:
+            self.assertTrue(len(subsample[task_id]) == 15)
+            self.assertTrue(set(p.get_workers_for_task(task_id)) <= subsample[task_id])
+
+    # Online aggregators should match their batch counterparts as labels arrive
+    def test_online_aggregation(self):
+        p = parse.RTEParser()
+        p.parse_cached("rte.standardized.tsv")
+        e = evaluate.Evaluator(p)
+        (workers, labels) = p.generate_subsample_indices(9, rng=9, return_labels=True)
+        subsample = p.indices_to_subsample(workers)
+
+        # One batch holding the whole subsample is a cold EM run
+        batch = []
+        for (task_id, row, row_labels) in zip(p.store.task_ids, workers.tolist(), labels.tolist()):
+            for (worker, label) in zip(row, row_labels):
+                batch.append((p.store.worker_ids[worker], task_id, label))
+        em = online.OnlineEstimationMaximizationAggregator(0)
+        em.add_labels(batch)
+        expected = aggregators.VectorizedEstimationMaximizationAggregator.aggregate(p.data_by_worker, subsample, 0)
+        self.assertTrue(em.current_estimates() == expected)
+
+        # Feeding one label per task at a time warm-starts from the previous batch
+        em = online.OnlineEstimationMaximizationAggregator(0)
+        majority = online.OnlineMajorityVoteAggregator()
+        for index in range(9):
+            batch = [(p.store.worker_ids[row[index]], task_id, row_labels[index])
+                     for (task_id, row, row_labels) in zip(p.store.task_ids, workers.tolist(), labels.tolist())]
+            em.add_labels(batch)
+            majority.add_labels(batch)
+
+        self.assertTrue(majority.current_estimates() == aggregators.MajorityVoteAggregator.aggregate(p.data_by_worker, subsample))
+        error = e.evaluate(em.current_estimates())
+        self.assertTrue(abs(error - e.evaluate(expected)) < 0.03, f"Online EM error was {error}")
+
+    # A tiny benchmark run should report every metric and flag slowdowns
+    def test_benchmark(self):
+        results = benchmark.run_benchmarks([50], 20, 3, ["parse", "MajorityVoteAggregator"])
+        self.assertTrue([result.case for result in results] == ["parse", "MajorityVoteAggregator"])
+        for result in results:
+            self.assertTrue(result.labels == 150 and result.seconds > 0 and result.labels_per_second > 0)
+
+        baseline = json.loads(json.dumps(benchmark.to_json(results)))
+        self.assertTrue(benchmark.find_regressions(results, baseline) == [])
+        for entry in baseline["results"]:
+            entry["seconds"] /= 10
+        self.assertTrue(len(benchmark.find_regressions(results, baseline)) == 2)
+
+    # Synthetic labels should follow the configured assignment and worker models
+    def test_synthetic_generator(self):
+        simulator = synthetic.CrowdSimulator(20000, 50, 5, seed=3)
+        store = simulator.to_store(block_size=6000)
+        self.assertTrue(len(store) == 100000 and store.num_tasks == 20000)
+        (_, counts) = numpy.unique(store.tasks, return_counts=True)
+        self.assertTrue((counts == 5).all())
+        keys = store.tasks.astype(numpy.int64) * 50 + store.workers
+        self.assertTrue(len(numpy.unique(keys)) == len(keys))
+
+        correct = numpy.bincount(store.workers, weights=store.labels == store.true_labels[store.tasks], minlength=50)
+        accuracy = correct / numpy.bincount(store.workers, minlength=50)
+        self.assertTrue(numpy.abs(accuracy - simulator.worker_accuracies()).max() < 0.05)
+        self.assertTrue(numpy.array_equal(store.labels, simulator.to_store(block_size=6000).labels))
+
+        # Redundancy close to the worker count takes the dense assignment path
+        dense = synthetic.CrowdSimulator(100, 10, 8, seed=3).to_store()
+        self.assertTrue(all(len(set(dense.workers[dense.tasks == task].tolist())) == 8 for task in range(100)))
+
+        # Two coins: accuracy on positive tasks follows the sensitivity
+        simulator = synthetic.CrowdSimulator(20000, 50, 5, model="two-coin", seed=3)
+        store = simulator.to_store()
+        positive = store.true_labels[store.tasks] == 1
+        sensitivity = numpy.bincount(store.workers[positive], weights=store.labels[positive] == 1, minlength=50) / \
+            numpy.bincount(store.workers[positive], minlength=50)
+        self.assertTrue(numpy.abs(sensitivity - simulator.sensitivity).max() < 0.08)
+
+        with tempfile.TemporaryDirectory() as directory:
+            shards = simulator.write_shards(directory, tasks_per_shard=7000)
+            self.assertTrue(len(shards) == 3)
+            loaded = [labelstore.LabelStore.load(shard) for shard in shards]
+            self.assertTrue(sum(shard.num_tasks for shard in loaded) == 20000)
+            self.assertTrue(loaded[1].task_ids[0] == "7000" and loaded[1].worker_ids == store.worker_ids)
+
+    # Streaming over on-disk shards should reproduce the in-memory aggregators
+    def test_sharded_aggregation(self):
+        p = parse.RTEParser()
+        p.parse_cached("rte.standardized.tsv")
+        everything = p.indices_to_subsample(p.generate_subsample_indices(10, rng=0))
+
+        with tempfile.TemporaryDirectory() as directory:
+            dataset = shards.ShardedDataset.from_store(p.store, os.path.join(directory, "by_range"), 300)
+            self.assertTrue(len(dataset) == 3 and dataset.num_tasks == 800)
+
+            majority = dataset.to_dict(shards.ShardedMajorityVoteAggregator.aggregate(dataset))
+            self.assertTrue(majority == aggregators.MajorityVoteAggregator.aggregate(p.data_by_worker, everything))
+
+            em = dataset.to_dict(shards.ShardedEstimationMaximizationAggregator.aggregate(dataset, 4))
+            self.assertTrue(em == aggregators.VectorizedEstimationMaximizationAggregator.aggregate(p.data_by_worker, everything, 4))
+
+            good = shards.ShardedSVDAggregator.find_good_worker(dataset)
+            svd = dataset.to_dict(shards.ShardedSVDAggregator.aggregate(dataset, good))
+            self.assertTrue(svd == aggregators.SVDAggregator.aggregate(p.data_by_worker, everything, good, "power"))
+
+            # Gold labels nobody gave leave no good worker, and the vector's sign is kept
+            store = p.store
+            unanswered = labelstore.LabelStore(store.worker_ids, store.task_ids, store.workers, store.tasks, store.labels,
+                                               numpy.zeros(store.num_tasks, dtype=numpy.int8))
+            nobody = shards.ShardedDataset.from_store(unanswered, os.path.join(directory, "nobody"), 300)
+            self.assertTrue(shards.ShardedSVDAggregator.find_good_worker(nobody) is None)
+            unsigned = nobody.to_dict(shards.ShardedSVDAggregator.aggregate(nobody, None))
+            self.assertTrue(unsigned == svd or unsigned == {task_id: -estimate for (task_id, estimate) in svd.items()})
+            unanswered_tasks = {task_id: parse.TaskEntry(0, entry.labels) for (task_id, entry) in p.data_by_task.items()}
+            self.assertTrue(aggregators.SVDAggregator.find_good_worker(p.data_by_worker, unanswered_tasks, everything) is None)
+            self.assertTrue(set(aggregators.SVDAggregator.aggregate(p.data_by_worker, everything, None, "power").values()) <= {-1, 1})
+
+            # Hash-partitioning the TSV itself gives the same answers
+            hashed = shards.ShardedDataset.partition_tsv("rte.standardized.tsv", os.path.join(directory, "by_hash"), num_shards=4)
+            self.assertTrue(len(hashed) == 4 and hashed.num_tasks == 800 and hashed.num_workers == 164)
+            self.assertTrue(hashed.to_dict(shards.ShardedMajorityVoteAggregator.aggregate(hashed)) == majority)
+
+            # More shards than the process may hold files open, spilled in small chunks
+            script = ("import resource, sys; sys.path.insert(0, 'src'); import shards; "
+                      "resource.setrlimit(resource.RLIMIT_NOFILE, (64, resource.getrlimit(resource.RLIMIT_NOFILE)[1])); "
+                      f"d = shards.ShardedDataset.partition_tsv('rte.standardized.tsv', {os.path.join(directory, 'many')!r}, num_shards=200, chunk_size=500); "
+                      "print(d.num_tasks, d.num_workers)")
+            output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+            self.assertTrue(output.split() == ["800", "164"])
+            many = shards.ShardedDataset(os.path.join(directory, "many"))
+            self.assertTrue(many.to_dict(shards.ShardedMajorityVoteAggregator.aggregate(many)) == majority)
+
+    # Dawid-Skene should handle more than two classes and agree across label encodings
+    def test_dawid_skene(self):
+        rng = numpy.random.default_rng(0)
+        (num_tasks, num_workers, num_classes, size) = (3000, 60, 3, 5)
+        truth = rng.integers(0, num_classes, num_tasks)
+        accuracy = rng.uniform(0.35, 0.95, num_workers)
+        tasks = numpy.repeat(numpy.arange(num_tasks), size)
+        workers = rng.integers(0, num_workers, num_tasks * size)
+        labels = numpy.where(rng.random(len(tasks)) < accuracy[workers], truth[tasks], rng.integers(0, num_classes, len(tasks)))
+
+        result = aggregators.DawidSkeneAggregator.aggregate_arrays(tasks, workers, labels, num_tasks, num_workers, num_classes)
+        self.assertTrue(result.converged)
+        self.assertTrue(result.posteriors.shape == (num_tasks, num_classes) and result.confusion.shape == (num_workers, num_classes, num_classes))
+        self.assertTrue(numpy.allclose(result.posteriors.sum(axis=1), 1) and numpy.allclose(result.confusion.sum(axis=2), 1))
+        votes = numpy.zeros((num_tasks, num_classes))
+        numpy.add.at(votes, (tasks, labels), 1)
+        self.assertTrue((result.posteriors.argmax(axis=1) != truth).mean() < (votes.argmax(axis=1) != truth).mean())
+        # A single iteration still reports its M-step
+        single = aggregators.DawidSkeneAggregator.aggregate_arrays(tasks, workers, labels, num_tasks, num_workers, num_classes, max_iterations=1)
+        self.assertTrue(single.iterations == 1 and not single.converged and single.confusion.shape == result.confusion.shape)
+
+        # Raw 0/1 labels and folded -1/1 labels describe the same classes
+        p = parse.RTEParser()
+        p.parse_cached("rte.standardized.tsv")
+        raw = parse.RTEParser(binary=False)
+        raw.parse_cached("rte.standardized.tsv")
+        self.assertTrue(set(raw.store.labels.tolist()) == {0, 1})
+        subsample = raw.indices_to_subsample(raw.generate_subsample_indices(10, rng=0))
+        folded = aggregators.DawidSkeneAggregator.aggregate(p.data_by_worker, subsample)
+        unfolded = aggregators.DawidSkeneAggregator.aggregate(raw.data_by_worker, subsample)
+        self.assertTrue(all(folded[task_id] == 2 * unfolded[task_id] - 1 for task_id in folded))
+
+    # Batched scoring should match scoring each trial's aggregation one by one
+    def test_batched_evaluation(self):
+        e = evaluate.Evaluator(seed=0)
+        p = e.parser
+        (workers, labels) = p.generate_subsample_indices(10, trials=4, rng=1, return_labels=True)
+        sizes = [1, 2, 5, 10]
+        weights = e.estimated_weights(workers, labels, sizes)
+        majority = e.evaluate_batch(labels, sizes)
+        weighted = e.evaluate_batch(labels, sizes, workers, weights)
+        self.assertTrue(majority.shape == (4, 4) and weights.shape == (4, 4, p.store.num_workers))
+
+        for trial in range(4):
+            for (column, size) in enumerate(sizes):
+                subsample = p.indices_to_subsample(workers[trial][:, :size])
+                majority_vote = aggregators.MajorityVoteAggregator.aggregate(p.data_by_worker, subsample)
+                expected = e.evaluate(majority_vote)
+                self.assertTrue(abs(majority[trial, column] - expected) < 1e-12)
+
+                # One EM weight update from the subsample's majority vote, with ties left as 0
+                worker_weights = aggregators.EstimationMaximizationAggregator.update_weights(p.data_by_worker, subsample, majority_vote)
+                aggregation = {}
+                for task_id in subsample:
+                    vote = sum(p.data_by_worker[worker_id][task_id] * worker_weights[worker_id] for worker_id in subsample[task_id])
+                    aggregation[task_id] = 0 if abs(vote) <= aggregators.TIE_TOLERANCE else int(numpy.sign(vote))
+                self.assertTrue(abs(weighted[trial, column] - e.evaluate(aggregation)) < 1e-12)
+
+        # Fixed weights given by the caller are looked up by worker index
+        fixed = numpy.linspace(-1, 1, p.store.num_workers)
+        self.assertTrue(numpy.array_equal(e.evaluate_batch(labels, sizes, workers, fixed),
+                                          e.evaluate_batch(labels, sizes, workers, numpy.broadcast_to(fixed, weights.shape))))
+
+        e.run_batched_trials(list(range(1, 11)), trials=50)
+        self.assertTrue(len(e.errors["Majority Vote"][3]) == 50 and len(e.errors["Weighted Vote"][3]) == 50)
+
+    # Profiling records phases and EM/SVD details only while it is enabled
+    def test_profiling(self):
+        e = evaluate.Evaluator(seed=0)
+        self.assertTrue(profiling.phase("parse") is profiling.DISABLED_PHASE)
+        e.run_trial(evaluate.Trial(3, 0))
+        self.assertFalse(profiling.enabled())
+
+        profiler = profiling.enable(memory=True)
+        try:
+            e.run_trial(evaluate.Trial(3, 0))
+            with profiling.phase("outer"):
+                with profiling.phase("inner"):
+                    buffer = numpy.ones(1 << 20)
+                del buffer
+        finally:
+            self.assertTrue(profiling.disable() is profiler)
+
+        report = json.loads(json.dumps(profiler.to_json()))
+        for phase in ["subsample", "evaluate", "Majority Vote", "SVD/convert_to_matrix", "SVD/leading_vector"]:
+            self.assertTrue(report["phases"][phase]["calls"] >= 1)
+        self.assertTrue(report["phases"]["evaluate"]["calls"] == 3)
+        self.assertTrue(report["counters"]["trials"] == 1)
+        self.assertTrue(report["events"]["EstimationMaximizationAggregator"]["events"][0]["converged"])
+        self.assertTrue(report["events"]["SVD matrix"]["events"][0] == {"tasks": 800, "workers": 164, "labels": 2400})
+        # The inner allocation counts towards both phases
+        self.assertTrue(report["phases"]["outer/inner"]["peak_bytes"] >= 8 << 20)
+        self.assertTrue(report["phases"]["outer"]["peak_bytes"] >= 8 << 20)
+
+    # The per-dataset cache picks the same good worker and SVD signs as the
+    # dictionary code, and keeps a bounded number of datasets
+    def test_precompute_cache(self):
         p = parse.RTEParser()
         p.parse("rte.standardized.tsv")
+        random.seed(0)
+        extrapolated = p.generate_extrapolated_dataset()
+        for (data, subsample) in [(p.data_by_worker, p.generate_subsample(3)),
+                                  (p.data_by_worker, p.generate_subsample(10)),
+                                  (extrapolated, p.generate_extrapolated_subsample(20))]:
+            cache = precompute.get(data, p.data_by_task)
+            self.assertTrue(precompute.get(data, p.data_by_task) is cache)
+            (tasks, rows, workers) = cache.subsample_indices(subsample)
+            good_worker = cache.find_good_worker(tasks, rows, workers)
+            self.assertTrue(good_worker == aggregators.SVDAggregator.find_good_worker(data, p.data_by_task, subsample))
+
+            random.seed(1)
+            expected = aggregators.SVDAggregator.aggregate(data, subsample, good_worker)
+            random.seed(1)
+            self.assertTrue(aggregators.SVDAggregator.aggregate_cached(cache, tasks, rows, workers, good_worker) == expected)
+
+        # Matrix buffers are reused between calls of the same size
+        labels = cache.labels(tasks[rows], workers)
+        first = cache.matrix(rows, workers, labels, len(tasks))
+        second = cache.matrix(rows, workers, labels, len(tasks))
+        self.assertTrue(numpy.shares_memory(first.data, second.data) and first.shape == (800, 164))
+        self.assertTrue(abs(first.toarray().sum(axis=1) - numpy.array([sum(extrapolated[w][t] for w in subsample[t]) for t in subsample])).max() == 0)
+
+        precompute.clear()
+        views = [parse.WorkerView(p.store) for _ in range(precompute.CACHE_SIZE + 1)]
+        for view in views:
+            precompute.get(view, p.data_by_task)
+        self.assertTrue(len(precompute.caches) == precompute.CACHE_SIZE)
+        self.assertTrue(next(iter(precompute.caches.values())).data_by_worker is views[1])
+        precompute.clear()
+
+    # Concurrent requests are batched and match the in-process aggregators
+    def test_service(self):
+        p = parse.RTEParser()
+        p.parse("rte.standardized.tsv")
+        tasks = p.store.task_ids[:300]
+        subsample = {task_id: set(p.data_by_task[task_id].labels) for task_id in tasks}
+
+        async def run() -> tuple[list, dict, int]:
+            server = service.AggregationService(p, batch_window=0.05, seed=0)
+            await server.start()
+            (_, port) = server.address()
+            clients = [service.ServiceClient(port=port) for _ in range(6)]
+            try:
+                results = await asyncio.gather(
+                    clients[0].aggregate("MajorityVoteAggregator", tasks),
+                    clients[1].aggregate("EstimationMaximizationAggregator", tasks),
+                    clients[2].aggregate("EstimationMaximizationAggregator", tasks[:100]),
+                    clients[3].aggregate("SVDAggregator", tasks),
+                    clients[4].aggregate("MajorityVoteAggregator"))
+                (status, error) = await clients[5].request("POST", "/aggregate", {"method": "Nope"})
+                self.assertTrue(status == 400 and "Unknown method" in error["error"])
+                return (results, await clients[0].metrics(), server.num_batches)
+            finally:
+                for client in clients:
+                    await client.close()
+                await server.close()
+
+        ((majority, em, em_small, svd, everything), metrics, batches) = asyncio.run(run())
+        # Requests usually share one batch, but a slow connection may miss the window
+        self.assertTrue(1 <= batches <= 5)
+        self.assertTrue(majority == aggregators.MajorityVoteAggregator.aggregate(p.data_by_worker, subsample))
+        self.assertTrue(len(everything) == 800)
+
+        # Each EM block gives exactly what running alone with its request's generator does
+        server = service.AggregationService(p, seed=0)
+        subsets = [numpy.arange(300, dtype=numpy.int32), numpy.arange(100, dtype=numpy.int32), numpy.arange(50, 450, dtype=numpy.int32)]
+        stacked = server.stacked_em(subsets)
+        for (estimates, tasks_in_block) in [(em, subsets[0]), (em_small, subsets[1])] + list(zip(stacked, subsets)):
+            task_ids = [p.store.task_ids[task] for task in tasks_in_block.tolist()]
+            expected = aggregators.VectorizedEstimationMaximizationAggregator.aggregate(
+                p.data_by_worker, {task_id: set(p.data_by_task[task_id].labels) for task_id in task_ids}, rng=server.request_rng(tasks_in_block))
+            if isinstance(estimates, dict):
+                self.assertTrue(list(estimates) == task_ids and estimates == expected)
+            else:
+                self.assertTrue(estimates.tolist() == [expected[task_id] for task_id in task_ids])
+        server.executor.shutdown()
+
+        good_worker = aggregators.SVDAggregator.find_good_worker(p.data_by_worker, p.data_by_task, subsample)
+        self.assertTrue(svd == aggregators.SVDAggregator.aggregate(p.data_by_worker, subsample, good_worker))
+        self.assertTrue(metrics["latency"]["all"]["count"] == 5)
+        self.assertTrue(metrics["latency"]["all"]["p99_ms"] >= metrics["latency"]["all"]["p50_ms"] > 0)
+
+    # The CLI writes one row per trial and leaves SciPy unloaded unless SVD runs
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.csv")
+            cli.main(["--methods", "majority", "em", "--sizes", "1", "3", "--repetitions", "2", "--seed", "0", "--output", output])
+            with open(output) as file:
+                rows = file.read().splitlines()
+            self.assertTrue(rows[0] == "method,k,extrapolated,trial,error" and len(rows) == 1 + 2 * 2 * 2)
+
+            e = evaluate.Evaluator(seed=0, methods=["Majority Vote"], repetitions=2)
+            e.run_trials(3)
+            self.assertTrue(f"Majority Vote,3,0,1,{e.errors['Majority Vote'][3][1]}" in rows)
+
+            script = ("import sys; sys.path.insert(0, 'src'); import cli; "
+                      f"cli.main(['--methods', 'majority', '--sizes', '1', '--repetitions', '1', '--format', 'json', '--output', {output!r}]); "
+                      "print(sorted(module for module in ('scipy', 'spectral', 'precompute') if module in sys.modules))")
+            loaded = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+            self.assertTrue(loaded.strip() == "[]")
+
+            # Checking arguments loads no NumPy without SVD, and never reads the dataset
+            script = ("import sys; sys.path.insert(0, 'src'); import cli; "
+                      "cli.parse_arguments(['--methods', 'majority', 'em', '--sizes', '1', '3', '--interval', 'bootstrap']); "
+                      "print('numpy' in sys.modules); "
+                      "cli.parse_arguments(['--extrapolated-sizes', '11', '--dataset', 'missing.tsv']); "
+                      "print(sorted(module for module in ('parse', 'labelstore') if module in sys.modules))")
+            loaded = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+            self.assertTrue(loaded.split("\n")[:2] == ["False", "[]"], loaded)
+
+            # k values outside what each kind of subsample can draw are rejected up front
+            for (flags, message) in [(["--sizes", "11"], "--sizes must be between 1 and 10"),
+                                     (["--methods", "svd", "--extrapolated-sizes", "10"], "between 11 and 164"),
+                                     (["--methods", "svd", "--extrapolated-sizes", "165"], "between 11 and 164"),
+                                     (["--methods", "svd", "--spectral-method", "qr"], "--spectral-method must be one of auto"),
+                                     (["--methods", "svd", "--spectral-method", "lanczos", "--warm-start"], "--warm-start needs")]:
+                rejected = subprocess.run([sys.executable, "src/cli.py"] + flags, capture_output=True, text=True)
+                self.assertTrue(rejected.returncode == 2 and message in rejected.stderr, rejected.stderr)
+            with open(output) as file:
+                self.assertTrue(list(json.load(file)["average_errors"]) == ["Majority Vote"])
+
+    # Cached trials are reused, only missing cells are computed, and the cache
+    # stays within its size bound
+    def test_result_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "results.sqlite")
+            fresh = evaluate.Evaluator(seed=5, repetitions=3)
+            fresh.run([1, 4], [12])
+
+            with resultcache.ResultCache(path) as cache:
+                first = evaluate.Evaluator(fresh.parser, seed=5, methods=["Majority Vote", "Estimation Maximization"],
+                                           repetitions=3, cache=cache)
+                first.run([1, 4], [12])
+                self.assertTrue(len(cache) == 2 * 2 * 3 and first.extrapolated_dataset is None)
+
+                profiler = profiling.enable()
+                try:
+                    second = evaluate.Evaluator(fresh.parser, seed=5, repetitions=3, cache=cache)
+                    second.run([1, 4], [12])
+                finally:
+                    profiling.disable()
+                self.assertTrue(profiler.counters["cached cells"] == 12 and profiler.counters["computed cells"] == 2 * 3 + 3)
+                self.assertTrue(second.errors == fresh.errors and second.average_errors == fresh.average_errors)
+                self.assertTrue(second.extrapolated_errors == fresh.extrapolated_errors)
+
+                # Cached aggregations score to the cached error
+                cell = second.cell(evaluate.Trial(4, 2), "SVD")
+                stored = cache.get(cell, aggregations=True)
+                self.assertTrue(stored.error == second.evaluate(stored.aggregations) == fresh.errors["SVD"][4][2])
+
+                # Warm-started SVD trials do not depend on what ran before them, so
+                # their cells are reused too, and hold the same errors as cold ones
+                warm = evaluate.Evaluator(fresh.parser, seed=5, methods=["SVD"], repetitions=3, warm_start=True, cache=cache)
+                warm.run([4])
+                profiler = profiling.enable()
+                try:
+                    rerun = evaluate.Evaluator(fresh.parser, seed=5, methods=["SVD"], repetitions=3, warm_start=True, cache=cache)
+                    rerun.run([4])
+                finally:
+                    profiling.disable()
+                self.assertTrue(profiler.counters["cached cells"] == 3 and profiler.counters["computed cells"] == 0)
+                self.assertTrue(warm.cell(evaluate.Trial(4, 0), "SVD") != second.cell(evaluate.Trial(4, 0), "SVD"))
+                self.assertTrue(rerun.errors["SVD"][4] == warm.errors["SVD"][4] == fresh.errors["SVD"][4])
+
+            # A tight bound keeps the most recently used cells
+            with resultcache.ResultCache(path, max_mb=0.002) as cache:
+                cells = [resultcache.Cell("d", "m", "1", 1, False, 0, iteration) for iteration in range(20)]
+                for cell in cells:
+                    cache.put(cell, resultcache.CellResult(0.5))
+                    cache.get(cells[0])
+                self.assertTrue(cache.total_bytes() <= 0.002 * (1 << 20))
+                self.assertTrue(cells[0] in cache.get_many(cells) and cells[-1] in cache.get_many(cells))
+                self.assertTrue(cells[1] not in cache.get_many(cells))
+
+            # Writers in several processes can share one cache
+            def write(start: int) -> None:
+                with resultcache.ResultCache(path, concurrent=True) as cache:
+                    for iteration in range(start, start + 25):
+                        cache.put(resultcache.Cell("shared", "m", "1", 1, False, 0, iteration), resultcache.CellResult(0.25))
+            context = multiprocessing.get_context("fork")
+            writers = [context.Process(target=write, args=(start,)) for start in (0, 25, 50)]
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join()
+                self.assertTrue(writer.exitcode == 0)
+            with resultcache.ResultCache(path, concurrent=True) as cache:
+                shared = [resultcache.Cell("shared", "m", "1", 1, False, 0, iteration) for iteration in range(75)]
+                self.assertTrue(len(cache.get_many(shared)) == 75)
+
+    # Welford statistics match NumPy, and adaptive runs spend more trials on
+    # noisy cells while keeping the seeded errors of a fixed run
+    def test_adaptive_trials(self):
+        values = [random.random() for _ in range(50)]
+        stats = confidence.RunningStats()
+        stats.extend(values)
+        self.assertTrue(numpy.isclose(stats.mean, numpy.mean(values)) and numpy.isclose(stats.variance(), numpy.var(values, ddof=1)))
+        # Tabulated two-sided 95% critical values
+        for (degrees, expected) in [(2, 4.303), (3, 3.182), (4, 2.776), (5, 2.571), (30, 2.042)]:
+            self.assertTrue(abs(confidence.t_quantile(0.975, degrees) - expected) < 0.0005, degrees)
+        self.assertTrue(abs(confidence.t_cdf(confidence.t_quantile(0.9, 7), 7) - 0.9) < 1e-12)
+        (low, high) = stats.interval()
+        (boot_low, boot_high) = confidence.bootstrap_interval(values, rng=0)
+        self.assertTrue(low < stats.mean < high and boot_low < stats.mean < boot_high)
+        self.assertTrue(abs((high - low) - (boot_high - boot_low)) < 0.3 * (high - low))
+
+        fixed = evaluate.Evaluator(seed=3, methods=["Majority Vote", "Estimation Maximization"], repetitions=40)
+        fixed.run([1, 5])
+        adaptive = evaluate.Evaluator(fixed.parser, seed=3, methods=["Majority Vote", "Estimation Maximization"],
+                                      target_width=0.01, min_repetitions=4, max_repetitions=40)
+        adaptive.run([1, 5])
+        for method in adaptive.methods:
+            for size in [1, 5]:
+                errors = adaptive.errors[method][size]
+                (low, high) = adaptive.confidence_intervals[method][size]
+                self.assertTrue(errors == fixed.errors[method][size][:len(errors)])
+                self.assertTrue(high - low <= 0.01 or len(errors) == 40)
+
+        # A cell asks for trials in proportion to its squared interval width
+        self.assertTrue(adaptive.next_repetitions(40, (0.0, 1.0)) == 40 and adaptive.next_repetitions(4, None) == 5)
+        self.assertTrue(adaptive.next_repetitions(10, (0.0, 0.01)) == 10)
+        self.assertTrue(adaptive.next_repetitions(10, (0.0, 0.012)) == 15 and adaptive.next_repetitions(10, (0.0, 0.05)) == 20)
+
+        # On synthetic errors with known spread, the quiet cell stops after its
+        # first round and the noisy one runs until its interval is narrow enough
+        spread = {1: 0.002, 5: 0.02}
+        synthetic = evaluate.Evaluator(fixed.parser, seed=3, methods=["Majority Vote"],
+                                       target_width=0.01, min_repetitions=4, max_repetitions=200)
+        synthetic.run_trial = lambda trial, methods, aggregations=None: {
+            method: float(numpy.random.default_rng(trial.seed(3)).normal(0.2, spread[trial.size])) for method in methods}
+        synthetic.run([1, 5])
+        (quiet, noisy) = (synthetic.errors["Majority Vote"][1], synthetic.errors["Majority Vote"][5])
+        (low, high) = synthetic.confidence_intervals["Majority Vote"][5]
+        self.assertTrue(len(quiet) == 4 and high - low <= 0.01)
+        # Normal errors need about (2 * 1.96 * 0.02 / 0.01) ** 2 = 61 trials
+        self.assertTrue(40 <= len(noisy) <= 100)
+
+        bootstrap = evaluate.Evaluator(fixed.parser, seed=3, methods=["Majority Vote"], interval="bootstrap",
+                                       target_width=0.02, min_repetitions=4, max_repetitions=40)
+        bootstrap.run([1])
+        (low, high) = bootstrap.confidence_intervals["Majority Vote"][1]
+        self.assertTrue(low <= bootstrap.average_errors["Majority Vote"][1] <= high)
+
+    # Active labeling should stay consistent with batch aggregation, never ask a
+    # worker twice, and beat spreading the same budget evenly
+    def test_active_labeling(self):
+        p = parse.RTEParser()
+        p.parse_cached("rte.standardized.tsv")
+        budget = 4 * p.store.num_tasks
+        for strategy in active.STRATEGIES:
+            simulator = active.ActiveSimulator(p.store, strategy, rng=1)
+            points = simulator.run(budget)
+            uniform = active.ActiveSimulator(p.store, strategy, uniform=True, rng=1).run(budget)
+            self.assertTrue(points[0] == uniform[0] and points[-1].labels == uniform[-1].labels == budget)
+            self.assertTrue(all(before.labels < after.labels for (before, after) in zip(points, points[1:])))
+
+            pairs = set(zip(simulator.tasks[:simulator.num_labels].tolist(), simulator.workers[:simulator.num_labels].tolist()))
+            self.assertTrue(len(pairs) == budget and (simulator.drawn <= simulator.available).all())
+
+        # Every strategy beats the even spread on a crowd that follows the one-coin model
+        crowd = synthetic.CrowdSimulator(1000, 60, 10, seed=1).to_store()
+        for strategy in active.STRATEGIES:
+            error = active.ActiveSimulator(crowd, strategy, rng=1).run(4 * crowd.num_tasks)[-1].error
+            uniform_error = active.ActiveSimulator(crowd, strategy, uniform=True, rng=1).run(4 * crowd.num_tasks)[-1].error
+            self.assertTrue(error < uniform_error, f"{strategy} did not beat the even spread")
+
+        # Incremental majority votes match a batch run on the labels drawn
+        simulator = active.ActiveSimulator(p.store, "majority", rng=1)
+        simulator.run(budget)
+        subsample: dict[str, set[str]] = {}
+        for (task, worker) in zip(simulator.tasks[:budget].tolist(), simulator.workers[:budget].tolist()):
+            subsample.setdefault(p.store.task_ids[task], set()).add(p.store.worker_ids[worker])
+        expected = aggregators.MajorityVoteAggregator.aggregate(p.data_by_worker, subsample)
+        self.assertTrue(dict(zip(p.store.task_ids, simulator.estimates().tolist())) == expected)
+
+    def test_extrapolation(self):
+        p = parse.RTEParser()
+        p.parse_cached("rte.standardized.tsv")
         extrapolated = p.generate_extrapolated_dataset()
 
         self.assertTrue(len(extrapolated) == 164)
@@ -43,7 +791,7 @@ class Tester(unittest.TestCase):
     
     def test_perfect_svd(self):
         p = parse.RTEParser()
-        p.parse("rte.standardized.tsv")
+        p.parse_cached("rte.standardized.tsv")
         perfect = {} # This will contain the actual labels for every worker
 
         for worker_id in p.data_by_worker: